@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+'''
+Micro-benchmark of the menus' userdata storage, TimeoutDefaultDict, against its previous implementation
+
+The previous one subclassed cachetools.TTLCache and walked its private linked list to reset an entry's expiration
+on every access, the current one moves the entry to the end of an OrderedDict. Both are filled to maxsize
+entries with ttl=300 and their existing keys are accessed in a scattered order, like many users' updates
+
+    python3 benchmark_userdata.py                       # 10, 100, 1k and 10k entries
+    python3 benchmark_userdata.py --sizes 50000         # Custom sizes
+'''
+
+import timeit
+import argparse
+
+import cachetools  # python3 -m pip install cachetools
+
+from bot_utils import TimeoutDefaultDict
+
+
+######################################################################
+# Baseline
+######################################################################
+
+class TTLCacheTimeoutDefaultDict(cachetools.TTLCache):
+    ''' TimeoutDefaultDict before it was rewritten, kept as the benchmark's baseline '''
+
+    def __init__(self, maxsize, ttl, *args, default_factory=dict, reset_on_access=True, **kwargs):
+        super().__init__(maxsize, ttl, *args, **kwargs)
+        self.default_factory = default_factory
+        self.reset_on_access = reset_on_access
+
+    def reset_expiration(self, key):
+        root = self._TTLCache__root
+        curr = root.next
+        while curr is not root:
+            if curr.key == key:
+                with self.timer as time:
+                    curr.expires = time + self.ttl
+                return curr.expires
+            curr = curr.next
+
+    def __setitem__(self, key, value):
+        ret = super().__setitem__(key, value)
+
+        if self.reset_on_access:
+            self.reset_expiration(key)
+
+        return ret
+
+    def __getitem__(self, key):
+        try:
+            ret = super().__getitem__(key)
+        except KeyError:
+            self.__setitem__(key, self.default_factory())
+            return super().__getitem__(key)
+
+        else:
+            if self.reset_on_access:
+                self.reset_expiration(key)
+            return ret
+
+
+######################################################################
+# Benchmark
+######################################################################
+
+IMPLEMENTATIONS = (('old', TTLCacheTimeoutDefaultDict), ('new', TimeoutDefaultDict))
+
+# Accesses timed per run, the baseline gets slow with many entries
+MAX_ACCESSES = 20000
+MIN_ACCESSES = 2000
+
+
+def measure_access(cls, size, accesses, repeat=3, ttl=300):
+    ''' Best seconds per access of existing keys in a full cls(maxsize=size) '''
+
+    storage = cls(maxsize=size, ttl=ttl, default_factory=dict)
+    for key in range(size):
+        storage[key]
+
+    # A step coprime with size visits every key in a scattered order
+    step = 7 if size % 7 else 11
+    keys = [(i * step) % size for i in range(accesses)]
+
+    def access():
+        for key in keys:
+            storage[key]
+
+    return min(timeit.repeat(access, number=1, repeat=repeat)) / accesses
+
+
+def benchmark(sizes=(10, 100, 1000, 10000)):
+    print(f'{"entries":>8} {"old (us/access)":>17} {"new (us/access)":>17} {"speedup":>8}')
+
+    results = []
+    for size in sizes:
+        accesses = MAX_ACCESSES if size <= 1000 else MIN_ACCESSES
+        old, new = (measure_access(cls, size, accesses) for _, cls in IMPLEMENTATIONS)
+        results.append((size, old, new))
+        print(f'{size:8} {old * 1e6:17.2f} {new * 1e6:17.2f} {old / new:7.1f}x')
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000], help='Entries to fill with')
+    args = parser.parse_args()
+
+    benchmark(sizes=args.sizes)
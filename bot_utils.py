@@ -9,13 +9,20 @@ import subprocess
 import types
 import inspect
 import logging
-
-import cachetools  # python3 -m pip install cachetools
+import asyncio
+import threading
+import itertools
+import datetime
+import collections
+import collections.abc
 
 # python3 -m pip install python-telegram-bot
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
+from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, Update
+from telegram.error import RetryAfter, BadRequest
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
+    CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
     ConversationHandler,
@@ -26,6 +33,18 @@ from telegram.ext import (
 
 import config
 import transmission_utils
+from tracing import TRACER
+
+
+__all__ = [
+    'UninitializedClass', 'UNINITIALIZED', 'get_used_size', 'get_free_size', 'execute_shell', 'random_string',
+    'random_identifier', 'to_camel_case', 'flatten_layout', 'map_layout', 'call_callback',
+    'TimeoutDefaultDict', 'new_userdata_storage', 'log_on_call', 'REMOVE_MARKUP', 'get_text', 'get_userid',
+    'repr_action', 'is_cancel', 'MESSAGE_MAX_LENGTH', 'pack_messages', 'truncate_message', 'RateLimiter', 'SendQueue',
+    'SEND_QUEUE', 'get_chat_id', 'reply', 'reply_lines', 'multi_reply', 'PerUserUpdateProcessor', 'Watch',
+    'WatchRegistry', 'WATCHES', 'ListPrompt', 'Menu', 'menus_to_states', 'AuthenticatedMenu',
+    'iter_torrent_reprs', 'iter_torrent_files', 'TorrentFiles', 'TorrentMenu', 'AuthenticatedTorrentMenu',
+]
 
 
 # Enable logging
@@ -96,54 +115,135 @@ async def call_callback(callback, *args, **kwargs):
     if inspect.iscoroutinefunction(callback):
         return await callback(*args, **kwargs)
 
-    return callback(*args, **kwargs)
+    # Sync callbacks are mostly Transmission RPCs, don't block other users' updates
+    ret = await asyncio.to_thread(callback, *args, **kwargs)
+
+    # Lambdas forwarding to async callbacks return their coroutine
+    if inspect.isawaitable(ret):
+        return await ret
+
+    return ret
+
+class TimeoutDefaultDict(collections.abc.MutableMapping):
+    '''
+    A dict whose entries expire ttl seconds after they were last set (or accessed if reset_on_access),
+    missing keys are created with default_factory()
+
+    Entries are kept in expiration order so touching an entry is moving it to the end,
+    and expired entries are swept lazily from the front. When maxsize entries are alive
+    the least recently used one is evicted.
 
-class TimeoutDefaultDict(cachetools.TTLCache):
-    def __init__(self, maxsize, ttl, *args, default_factory=dict, reset_on_access=True, **kwargs):
-        super().__init__(maxsize, ttl, *args, **kwargs)
+    stats counts hits, misses (created entries), expirations and evictions
+    '''
+
+    def __init__(self, maxsize, ttl, default_factory=dict, reset_on_access=True, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
         self.default_factory = default_factory
         self.reset_on_access = reset_on_access
+        self.timer = timer
+
+        # Sync menu callbacks run in threads (see call_callback)
+        self.lock = threading.RLock()
+        self._data = collections.OrderedDict()  # key -> [value, expiration time]
+        self.stats = collections.Counter(hits=0, misses=0, expirations=0, evictions=0)
+
+    def expire(self, now=None):
+        ''' Remove the expired entries, returns how many were removed '''
 
-    def reset_expiration(self, key):
-        # TODO: Don't rely on TTLCache API
+        if now is None:
+            now = self.timer()
 
-        root = self._TTLCache__root
-        curr = root.next
-        while curr is not root:
-            if curr.key == key:
-                with self.timer as time:
-                    curr.expires = time + self.ttl
-                return curr.expires
-            curr = curr.next
+        expired = 0
+        with self.lock:
+            while self._data:
+                key, (value, expires) = next(iter(self._data.items()))
+                if expires > now:
+                    break
+
+                del self._data[key]
+                expired += 1
+
+            self.stats['expirations'] += expired
+
+        return expired
 
     def __setitem__(self, key, value):
-        ret = super().__setitem__(key, value)
+        now = self.timer()
 
-        if self.reset_on_access:
-            self.reset_expiration(key)
-            
-        return ret
+        with self.lock:
+            self.expire(now)
+
+            if key in self._data:
+                self._data.move_to_end(key)
+
+            elif self.maxsize is not None and len(self._data) >= self.maxsize:
+                evicted_key, _ = self._data.popitem(last=False)
+                self.stats['evictions'] += 1
+                LOGGER.warning(f'Evicted {evicted_key} from userdata with {self.maxsize} entries before it expired')
+
+            self._data[key] = [value, now + self.ttl]
 
     def __getitem__(self, key):
-        try:
-            ret = super().__getitem__(key)
-        except KeyError:
-            self.__setitem__(key, self.default_factory())
-            return super().__getitem__(key)
+        now = self.timer()
+
+        with self.lock:
+            self.expire(now)
+
+            entry = self._data.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                value = self.default_factory()
+                self[key] = value
+                return value
+
+            self.stats['hits'] += 1
 
-        else:
             if self.reset_on_access:
-                self.reset_expiration(key)
-            return ret
+                entry[1] = now + self.ttl
+                self._data.move_to_end(key)
+
+            return entry[0]
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self._data[key]
+
+    def get(self, key, default=None):
+        # Don't create missing entries like __getitem__ does
+        with self.lock:
+            return self[key] if key in self else default
+
+    def __contains__(self, key):
+        with self.lock:
+            self.expire()
+            return key in self._data
+
+    def __iter__(self):
+        with self.lock:
+            self.expire()
+            return iter(list(self._data))
 
-def new_userdata_storage(timeout=None, maxsize=128, reset_on_access=True):
+    def __len__(self):
+        with self.lock:
+            self.expire()
+            return len(self._data)
+
+    def __repr__(self):
+        return f'<TimeoutDefaultDict {len(self)}/{self.maxsize} entries ttl={self.ttl} {dict(self.stats)}>'
+
+def new_userdata_storage(timeout=None, maxsize=getattr(config, 'USERDATA_MAXSIZE', 4096), reset_on_access=True):
     if timeout is None:
         timeout = 5 * 60
 
     return TimeoutDefaultDict(maxsize=maxsize, ttl=timeout, default_factory=dict, reset_on_access=reset_on_access)
 
-def log_on_call(enter_msg=None, exit_msg=None):
-    # TODO: Figure out
+def log_on_call(enter_msg=None, exit_msg=None, name=None, kind='step'):
+    '''
+    Log entering/exiting an update handler and trace it as a span linked to the update
+
+    Pass False as both messages to only trace
+    '''
 
     def decorator(func):
 
@@ -154,13 +254,16 @@ def log_on_call(enter_msg=None, exit_msg=None):
             l_enter_msg = enter_msg
             l_exit_msg = exit_msg
 
+        span_name = name or (l_enter_msg.replace('entered ', '', 1) if l_enter_msg else func.__name__)
+
         @functools.wraps(func)
         async def wrapper(update, *args, **kwargs):
             if l_enter_msg:
                 msg = repr_action(update, l_enter_msg)
                 LOGGER.info(msg)
-            
-            ret = await func(update, *args, **kwargs)
+
+            with TRACER.span(span_name, kind, update_id=getattr(update, 'update_id', None)):
+                ret = await func(update, *args, **kwargs)
 
             if l_exit_msg:
                 msg = repr_action(update, l_exit_msg)
@@ -198,8 +301,179 @@ def is_cancel(update):
     except:
         return False
 
+MESSAGE_MAX_LENGTH = 4096
+
+def pack_messages(texts, max_length=MESSAGE_MAX_LENGTH, separator='\n'):
+    ''' Join texts into as few messages as possible under max_length, splitting texts which are too long on their own '''
+
+    messages = []
+    current = ''
+
+    for text in texts:
+        text = str(text)
+
+        while len(text) > max_length:
+            if current:
+                messages.append(current)
+                current = ''
+
+            messages.append(text[:max_length])
+            text = text[max_length:]
+
+        if current and len(current) + len(separator) + len(text) <= max_length:
+            current += separator + text
+        else:
+            if current:
+                messages.append(current)
+            current = text
+
+    if current:
+        messages.append(current)
+
+    return messages
+
+def truncate_message(text, max_length=MESSAGE_MAX_LENGTH, separator='\n'):
+    ''' Cut text at a separator so it fits in max_length, ending it with how many non-empty lines were cut '''
+
+    text = str(text)
+    if len(text) <= max_length:
+        return text
+
+    lines = text.split(separator)
+
+    def make_marker(kept):
+        return f'{separator}… ({sum(1 for line in lines[kept:] if line.strip())} more lines)'
+
+    kept = length = 0
+    for line in lines:
+        new_length = length + (len(separator) if kept else 0) + len(line)
+        if new_length + len(make_marker(kept + 1)) > max_length:
+            break
+        kept, length = kept + 1, new_length
+
+    if not kept:
+        # Even the first line doesn't fit, cut inside it
+        marker = f'{separator}… (cut)'
+        return text[:max_length - len(marker)] + marker
+
+    return text[:length] + make_marker(kept)
+
+
+class RateLimiter(object):
+    ''' Token bucket allowing burst sends and then rate sends per second '''
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.paused_until = 0
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def delay(self):
+        ''' Take a token, returns how long to wait before sending '''
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= 1
+
+        wait = 0 if self.tokens >= 0 else -self.tokens / self.rate
+        return max(wait, self.paused_until - now)
+
+
+class SendQueue(object):
+    '''
+    Send Telegram messages in order per chat without blocking the handlers which queued them
+
+    Each chat with queued messages has a worker task which sends them one by one
+    under a per chat and a global rate limit, and waits out RetryAfter flood errors.
+    Workers exit once their chat's queue is empty.
+    '''
+
+    def __init__(self,
+                 chat_rate=getattr(config, 'TELEGRAM_CHAT_RATE', 1), chat_burst=getattr(config, 'TELEGRAM_CHAT_BURST', 3),
+                 global_rate=getattr(config, 'TELEGRAM_GLOBAL_RATE', 30),
+                 max_retries=5):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_limiter = RateLimiter(global_rate, burst=global_rate)
+        self.max_retries = max_retries
+
+        self.queues = {}  # chat id -> collections.deque of (send coroutine function, args, kwargs)
+        self.limiters = TimeoutDefaultDict(maxsize=None, ttl=60,
+                                           default_factory=lambda: RateLimiter(self.chat_rate, burst=self.chat_burst))
+        self.workers = {}  # chat id -> asyncio.Task
+
+    def put(self, chat_id, send, *args, **kwargs):
+        self.queues.setdefault(chat_id, collections.deque()).append((send, args, kwargs))
+
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.get_running_loop().create_task(self._worker(chat_id))
+
+    async def join(self):
+        ''' Wait until every queued message was sent '''
+
+        while self.workers:
+            await asyncio.gather(*self.workers.values(), return_exceptions=True)
+
+    async def _worker(self, chat_id):
+        queue = self.queues[chat_id]
+
+        try:
+            while queue:
+                send, args, kwargs = queue.popleft()
+                await self._send(chat_id, send, *args, **kwargs)
+        finally:
+            del self.workers[chat_id]
+            if not queue:
+                self.queues.pop(chat_id, None)
+
+    async def _send(self, chat_id, send, *args, **kwargs):
+        limiter = self.limiters[chat_id]
+
+        for attempt in range(self.max_retries):
+            await asyncio.sleep(max(limiter.delay(), self.global_limiter.delay()))
+
+            try:
+                with TRACER.span(f'send {getattr(send, "__name__", send)}', 'telegram', chat=chat_id, attempt=attempt):
+                    return await send(*args, **kwargs)
+
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, datetime.timedelta):
+                    retry_after = retry_after.total_seconds()
+
+                LOGGER.warning(f'Flood limited sending to chat {chat_id}, retrying in {retry_after}s')
+
+                # Flood limits are usually for the whole bot
+                self.global_limiter.pause(retry_after)
+
+            except Exception:
+                LOGGER.exception(f'Failed sending message to chat {chat_id}')
+                return
+
+        LOGGER.error(f'Dropped message to chat {chat_id} after {self.max_retries} flood limited attempts')
+
+SEND_QUEUE = SendQueue()
+
+def get_chat_id(update):
+    return update.message.chat_id
+
 async def reply(update: Update, text: str, reply_markup=None):
-    await update.message.reply_text(text, reply_markup=reply_markup)
+    ''' Queue a reply, it's sent in order with the chat's other replies after the handler continues '''
+
+    SEND_QUEUE.put(get_chat_id(update), update.message.reply_text, text, reply_markup=reply_markup)
+
+async def reply_lines(update: Update, lines, reply_markup=None, separator='\n'):
+    ''' Reply with lines packed into as few messages as possible, the markup is sent with the last message '''
+
+    messages = pack_messages(lines, separator=separator)
+
+    for i, message in enumerate(messages):
+        await reply(update, message, reply_markup=reply_markup if i == len(messages) - 1 else None)
 
 async def multi_reply(update: Update, label: str, 
                       values, with_index=False,
@@ -207,19 +481,370 @@ async def multi_reply(update: Update, label: str,
 
     # Check if values is wanted iterable
     if isinstance(values, (list, map, types.GeneratorType)):
+        lines = []
 
         for i, v in enumerate(values):
             sublabel = f'[{i}]' if with_index else ''
-            await reply(update, f"{label}{sublabel} = {v}", reply_markup=reply_markup)
+            lines.append(f"{label}{sublabel} = {v}")
+
+        await reply_lines(update, lines, reply_markup=reply_markup)
 
     else:
         await reply(update, f"{label} = {values}", reply_markup=reply_markup)
 
 
 
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    '''
+    Process updates concurrently while each user's updates are processed one at a time in arrival order,
+    so one user's slow command doesn't delay everyone and conversation states stay consistent
+
+    max_concurrent_updates bounds the updates being processed, max_pending_updates bounds the ones
+    accepted from Telegram (including those waiting for their user's previous update)
+    '''
+
+    def __init__(self, max_concurrent_updates=getattr(config, 'UPDATE_CONCURRENCY', 8),
+                 max_pending_updates=getattr(config, 'UPDATE_MAX_PENDING', 256)):
+        # The base semaphore is held while waiting for the user's turn, so it only bounds pending updates
+        super().__init__(max_pending_updates)
+        self.running = asyncio.Semaphore(max_concurrent_updates)
+        self.user_locks = {}  # user or chat id -> [asyncio.Lock, waiting updates]
+
+    @staticmethod
+    def get_key(update):
+        if not isinstance(update, Update):
+            return None
+
+        if update.effective_user is not None:
+            return update.effective_user.id
+
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+
+    async def do_process_update(self, update, coroutine):
+        key = self.get_key(update)
+
+        if key is None:
+            async with self.running:
+                await coroutine
+            return
+
+        # asyncio.Lock wakes waiters in FIFO order which keeps the user's updates ordered
+        entry = self.user_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+
+        try:
+            async with entry[0]:
+                async with self.running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.user_locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+class Watch(object):
+    ''' A status message edited in place by WatchRegistry '''
+
+    def __init__(self, watch_id, key, chat_id, userid, render_cb, interval, lifetime):
+        self.watch_id = watch_id
+        self.key = key
+        self.chat_id = chat_id
+        self.userid = userid
+        self.render_cb = render_cb
+
+        self.interval = interval
+        self.next_refresh = time.monotonic() + interval
+        self.expires = time.monotonic() + lifetime
+
+        self.message = None
+        self.text = None
+
+    def __repr__(self):
+        return f'<Watch {self.watch_id} {self.key} chat={self.chat_id} interval={self.interval}>'
+
+
+class WatchRegistry(object):
+    '''
+    Status messages (torrent progress, convertion progress..) which are sent once and edited in place
+
+    A single refresh loop task serves every watch, watches with the same key share one render_cb() call per tick.
+    A watch whose text didn't change backs off its refresh interval up to max_interval, a change resets it.
+    The message's inline keyboard refreshes or stops the watch through handle_callback_query()
+    '''
+
+    CALLBACK_PATTERN = r'^watch:'
+
+    def __init__(self, send_queue: SendQueue = SEND_QUEUE,
+                 interval=getattr(config, 'WATCH_INTERVAL', 5),
+                 max_interval=getattr(config, 'WATCH_MAX_INTERVAL', 60),
+                 lifetime=getattr(config, 'WATCH_LIFETIME', 30 * 60),
+                 tick=1):
+        self.send_queue = send_queue
+        self.interval = interval
+        self.max_interval = max_interval
+        self.lifetime = lifetime
+        self.tick = tick
+
+        self.watches = {}  # watch id -> Watch
+        self.loop_task = None
+
+    @staticmethod
+    async def render(render_cb):
+        # Renders usually make RPCs, keep them off the event loop
+        if inspect.iscoroutinefunction(render_cb):
+            text = await render_cb()
+        else:
+            text = await asyncio.to_thread(render_cb)
+
+        # Show that the text was cut instead of silently dropping its end (e.g. the last torrents)
+        return truncate_message(text) or '(empty)'
+
+    def create_markup(self, watch):
+        return InlineKeyboardMarkup([[
+            InlineKeyboardButton('Refresh', callback_data=f'watch:refresh:{watch.watch_id}'),
+            InlineKeyboardButton('Stop', callback_data=f'watch:stop:{watch.watch_id}'),
+        ]])
+
+    async def start(self, update, key, render_cb):
+        ''' Send render_cb()'s text and keep it updated, replacing the chat's previous watch of key '''
+
+        chat_id = get_chat_id(update)
+
+        for other in list(self.watches.values()):
+            if other.chat_id == chat_id and other.key == key:
+                self.stop(other)
+
+        watch = Watch(random_string(), key, chat_id, get_userid(update), render_cb, self.interval, self.lifetime)
+        watch.text = await self.render(render_cb)
+        self.watches[watch.watch_id] = watch
+
+        self.send_queue.put(chat_id, self._send_message, update, watch)
+
+        if self.loop_task is None or self.loop_task.done():
+            self.loop_task = asyncio.get_running_loop().create_task(self._refresh_loop())
+
+        return watch
+
+    def stop(self, watch, footer='(stopped watching)'):
+        if self.watches.pop(watch.watch_id, None) is None:
+            return
+
+        text = truncate_message(watch.text, MESSAGE_MAX_LENGTH - len(footer) - 1)
+        self.send_queue.put(watch.chat_id, self._edit_message, watch, f'{text}\n{footer}', None)
+
+    async def _send_message(self, update, watch):
+        watch.message = await update.message.reply_text(watch.text, reply_markup=self.create_markup(watch))
+
+    async def _edit_message(self, watch, text, reply_markup):
+        if watch.message is None:
+            return
+
+        try:
+            await watch.message.edit_text(text[:MESSAGE_MAX_LENGTH], reply_markup=reply_markup)
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                raise
+
+    async def _refresh_loop(self):
+        while self.watches:
+            await asyncio.sleep(self.tick)
+            await self.refresh_due()
+
+    async def refresh_due(self, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        due = [watch for watch in self.watches.values() if watch.next_refresh <= now or watch.expires <= now]
+        renders = {}  # key -> text, render each key once per tick
+
+        for watch in due:
+            if watch.expires <= now:
+                self.stop(watch, footer='(watch expired)')
+                continue
+
+            if watch.key not in renders:
+                try:
+                    renders[watch.key] = await self.render(watch.render_cb)
+                except Exception:
+                    LOGGER.exception(f'Failed rendering {watch}')
+                    renders[watch.key] = None
+
+            text = renders[watch.key]
+
+            if text is None or text == watch.text:
+                watch.interval = min(watch.interval * 2, self.max_interval)
+            else:
+                watch.interval = self.interval
+                watch.text = text
+                self.send_queue.put(watch.chat_id, self._edit_message, watch, text, self.create_markup(watch))
+
+            watch.next_refresh = now + watch.interval
+
+    async def handle_callback_query(self, update: Update, context):
+        query = update.callback_query
+        _, action, watch_id = query.data.split(':', 2)
+        watch = self.watches.get(watch_id)
+
+        if watch is None:
+            await query.answer('No longer watching')
+            return
+
+        if query.from_user.id != watch.userid:
+            await query.answer('Not your watch')
+            return
+
+        if action == 'stop':
+            self.stop(watch)
+            await query.answer('Stopped')
+        else:
+            watch.interval = self.interval
+            watch.next_refresh = 0
+            await query.answer('Refreshing')
+
+    def create_handler(self):
+        return CallbackQueryHandler(self.handle_callback_query, pattern=self.CALLBACK_PATTERN)
+
+WATCHES = WatchRegistry()
+
+
+
 ######################################################################
 # Menu utils
 ######################################################################
+class ListPrompt(object):
+    '''
+    A selection keyboard showing one page of values with previous/next/filter buttons
+
+    values is an indexed sequence (other iterables are listed once) and only the values on the shown page
+    are stringified, so choices keep their index in values across pages and filters
+    '''
+
+    PREVIOUS = '« Previous'
+    NEXT = 'Next »'
+    FILTER = 'Filter'
+    CLEAR_FILTER = 'Clear filter'
+    CONTROLS = (PREVIOUS, NEXT, FILTER, CLEAR_FILTER)
+
+    def __init__(self, text, values, prepend_layout=[["Cancel"]],
+                 stringify_value=lambda i, value: f'{i}: {value}',
+                 page_size=getattr(config, 'LIST_PROMPT_PAGE_SIZE', 20), name=None):
+        self.text = text
+        self.name = name
+        self.values = values if isinstance(values, collections.abc.Sequence) else list(values)
+        self.prepend_layout = prepend_layout
+        self.stringify_value = stringify_value
+        self.page_size = page_size
+
+        self.page = 0
+        self.filter_text = ''
+        self.awaiting_filter = False
+        self.state_name = None  # The state whose messages are handled as page controls
+        self.shown_choices = {}  # choice text -> index in values, for every choice shown to the user
+
+    def iter_choices(self, start=0):
+        ''' Iterate (index, choice text) of the values matching the filter starting from the start'th match '''
+
+        if not self.filter_text:
+            for i in range(start, len(self.values)):
+                yield i, self.stringify_value(i, self.values[i])
+            return
+
+        filter_text = self.filter_text.lower()
+        matched = 0
+
+        for i, value in enumerate(self.values):
+            choice = self.stringify_value(i, value)
+            if filter_text not in choice.lower():
+                continue
+
+            if matched >= start:
+                yield i, choice
+            matched += 1
+
+    def get_page(self):
+        ''' Returns (choices on the current page, whether there's a next page) '''
+
+        choices = list(itertools.islice(self.iter_choices(self.page * self.page_size), self.page_size + 1))
+        has_next = len(choices) > self.page_size
+        choices = choices[:self.page_size]
+
+        self.shown_choices.update((choice, i) for i, choice in choices)
+        return choices, has_next
+
+    def get_shown_value(self, choice, default=None):
+        ''' The value of a choice which was shown to the user '''
+
+        i = self.shown_choices.get(choice)
+        if i is None:
+            return default
+
+        return self.values[i]
+
+    def describe(self):
+        text = self.text
+
+        if self.filter_text:
+            text += f' (filter "{self.filter_text}", page {self.page + 1})'
+        elif len(self.values) > self.page_size:
+            pages = (len(self.values) + self.page_size - 1) // self.page_size
+            text += f' (page {self.page + 1}/{pages})'
+
+        return text
+
+    def create_markup(self):
+        choices, has_next = self.get_page()
+
+        controls = []
+        if self.page > 0:
+            controls.append(self.PREVIOUS)
+        if has_next:
+            controls.append(self.NEXT)
+
+        keyboard = self.prepend_layout + [[choice] for _, choice in choices]
+
+        if controls:
+            keyboard.append(controls)
+        if self.filter_text:
+            keyboard.append([self.FILTER, self.CLEAR_FILTER])
+        elif controls:
+            keyboard.append([self.FILTER])
+
+        return ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True, selective=True)
+
+    def handle_control(self, text):
+        ''' Apply a control or filter text, returns False if text isn't for the prompt '''
+
+        if self.awaiting_filter:
+            self.awaiting_filter = False
+            self.filter_text = text.strip()
+            self.page = 0
+
+        elif text == self.PREVIOUS:
+            self.page = max(self.page - 1, 0)
+
+        elif text == self.NEXT:
+            self.page += 1
+
+        elif text == self.FILTER:
+            self.awaiting_filter = True
+
+        elif text == self.CLEAR_FILTER:
+            self.filter_text = ''
+            self.page = 0
+
+        else:
+            return False
+
+        return True
+
+
 class Menu(object):
     '''
     A simple menu starts off with prompting the user to choose a command then processes the choice:
@@ -325,6 +950,10 @@ class Menu(object):
 
         return self._userdatas[userid]
 
+    def get_userdata_storage(self):
+        ''' The TimeoutDefaultDict of every user's userdata, for its size and stats '''
+        return self._userdatas
+
     def del_userdata_entries(self, userid, *keys):
         userdata = self.get_userdata(userid)
 
@@ -369,6 +998,9 @@ class Menu(object):
             if prepend_menu_name:
                 state_name = self.prefix_menu(state_name)
 
+            state_callback = self.handle_list_prompt_controls(state_callback, state_name)
+            state_callback = log_on_call(False, False, name=state_name, kind='handler')(state_callback)
+
             LOGGER.info(f'{self.name} registered callback {state_name}')
             states[state_name] = [MessageHandler(filters.Regex('.*'), state_callback)]
 
@@ -378,6 +1010,34 @@ class Menu(object):
         markup = ReplyKeyboardMarkup(map_layout(self.transform_cmd_name, self.layout), resize_keyboard=True, selective=True)
         return markup
 
+    def handle_list_prompt_controls(self, callback, state_name):
+        ''' Page through the user's ListPrompt in this state instead of passing its controls to callback '''
+
+        @functools.wraps(callback)
+        async def wrapper(update, context, *args, **kwargs):
+            list_prompt = self.get_userdata(update).get('list_prompt')
+            text = get_text(update)
+
+            if list_prompt is not None and not is_cancel(update) and \
+                (text in ListPrompt.CONTROLS or (list_prompt.awaiting_filter and list_prompt.state_name == state_name)):
+
+                list_prompt.state_name = state_name
+                list_prompt.handle_control(text)
+
+                if list_prompt.awaiting_filter:
+                    await reply(update, 'Enter text to filter by:', reply_markup=REMOVE_MARKUP)
+                else:
+                    await self.send_list_prompt(update, list_prompt)
+
+                return state_name
+
+            return await callback(update, context, *args, **kwargs)
+
+        return wrapper
+
+    async def send_list_prompt(self, update, list_prompt: ListPrompt):
+        await reply(update, list_prompt.describe(), reply_markup=list_prompt.create_markup())
+
     async def _start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """ Conversation's entry point """ 
 
@@ -447,6 +1107,16 @@ class Menu(object):
 
         return wrapper
 
+    def create_watch_handler(self, state_name, render_cb, key=None, watches=None):
+        ''' A command sending a message with render_cb()'s text which is kept updated instead of re-sent, see WatchRegistry '''
+
+        @self.callback(state_name=state_name, menu_on_exit=True)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            LOGGER.info(repr_action(update, f'watching {key or state_name}'))
+            await (watches or WATCHES).start(update, key or state_name, render_cb)
+
+        return wrapper
+
     def callback(self, state_name=None, menu_on_exit=False, prefix_menu=True):
         ''' A command is a cancelable (registered) callback which may return to menu when done  '''
 
@@ -568,6 +1238,25 @@ def iter_torrent_files(torrent_id):
     # Torrent files sorted by file name
     return sorted(transmission_utils.iter_torrent_files(torrent_id), key=lambda tf: tf.name)
 
+class TorrentFiles(collections.abc.Sequence):
+    ''' A torrent's files sorted by file name, TorrentFile objects are only created for the accessed files '''
+
+    def __init__(self, torrent_id):
+        torrent = transmission_utils.make_torrent(torrent_id)
+
+        self.torrent_id = torrent.id
+        self.files = sorted(torrent.files().items(), key=lambda item: item[1].get('name'))
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        file_id, properties = self.files[i]
+        return transmission_utils.TorrentFile(self.torrent_id, file_id, properties)
+
 
 class TorrentMenu(Menu):
 
@@ -577,27 +1266,49 @@ class TorrentMenu(Menu):
     async def prompt_magnet(menu, update: Update):
         await reply(update, "Enter magnet url (or type 'cancel'):", reply_markup=REMOVE_MARKUP)
 
-    @classmethod
     async def prompt_list(menu, update, text, values, prepend_layout=[["Cancel"]],
-                          stringify_value = lambda i, value: f'{i}: {value}'):
-        keyboard = prepend_layout + [[stringify_value(i, value)] for i, value in enumerate(values)]
-        markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True, selective=True)        
-        await reply(update, text, reply_markup=markup)
+                          stringify_value = lambda i, value: f'{i}: {value}', keep_page=False, name=None):
+        '''
+        Prompt with a paginated ListPrompt, keep_page keeps the page and filter of the user's last prompt with the same text
+
+        The prompt stays in the userdata so choices can be resolved to values with get_prompted_value(update, choice, name)
+        '''
+
+        userdata = menu.get_userdata(update)
+        list_prompt = ListPrompt(text, values, prepend_layout=prepend_layout, stringify_value=stringify_value, name=name)
+
+        last_prompt = userdata.get('list_prompt')
+        if keep_page and last_prompt is not None and last_prompt.text == text:
+            list_prompt.page, list_prompt.filter_text = last_prompt.page, last_prompt.filter_text
+
+        userdata['list_prompt'] = list_prompt
+        await menu.send_list_prompt(update, list_prompt)
+
+    def get_prompted_value(menu, update, choice, name):
+        ''' The value of a choice from the user's last prompt_list(name=name), UNINITIALIZED if it wasn't shown '''
+
+        list_prompt = menu.get_userdata(update).get('list_prompt')
+        if list_prompt is None or list_prompt.name != name:
+            return UNINITIALIZED
+
+        return list_prompt.get_shown_value(choice, default=UNINITIALIZED)
 
-    @classmethod
     async def prompt_torrent(menu, update: Update, prepend_layout=[["Cancel"]]):
         return await menu.prompt_list(update,
                                       'Choose torrent:',
-                                      iter_torrent_reprs(),
+                                      transmission_utils.iter_torrents(),
                                       prepend_layout=prepend_layout,
-                                      stringify_value=lambda i,value: str(value))
-    @classmethod
-    async def prompt_torrent_files(menu, update, torrent_id, prepend_layout=[["Cancel"]]):
+                                      stringify_value=lambda i,value: transmission_utils.torrent_repr(value),
+                                      name='torrent')
+
+    async def prompt_torrent_files(menu, update, torrent_id, prepend_layout=[["Cancel"]], keep_page=False):
         return await menu.prompt_list(update,
                                       'Choose file:',
-                                      iter_torrent_files(torrent_id),
+                                      TorrentFiles(torrent_id),
                                       prepend_layout=prepend_layout,
-                                      stringify_value=lambda i,value: str(value))
+                                      stringify_value=lambda i,value: str(value),
+                                      keep_page=keep_page,
+                                      name='torrent_file')
 
     ###############
     # Choice helpers 
@@ -612,14 +1323,25 @@ class TorrentMenu(Menu):
         selection = int(match.group(1))
         return selection
         
-    @classmethod
-    def choice_to_torrent_id(menu, choice):
-        if choice not in list(iter_torrent_reprs()):
+    def choice_to_torrent_id(menu, choice, update=None):
+        ''' Resolve a prompted choice from the userdata without RPCs, typed choices are checked against the torrents list '''
+
+        if update is not None:
+            torrent = menu.get_prompted_value(update, choice, 'torrent')
+            if torrent is not UNINITIALIZED:
+                return torrent.id
+
+        # Don't list the torrents for texts which can't be a choice, like the command which started the prompt
+        if menu.choice_to_number(choice) is None or choice not in list(iter_torrent_reprs()):
             return
         return menu.choice_to_number(choice)
 
-    @classmethod
-    def choice_to_torrent_file_id(menu, choice):
+    def choice_to_torrent_file_id(menu, choice, update=None):
+        if update is not None:
+            torrent_file = menu.get_prompted_value(update, choice, 'torrent_file')
+            if torrent_file is not UNINITIALIZED:
+                return (torrent_file.torrent_id, torrent_file.file_id)
+
         regex_torrent_id = r'^(\d+).(\d+):.*'
         match = re.match(regex_torrent_id, choice)
         
@@ -635,14 +1357,18 @@ class TorrentMenu(Menu):
 
         return (torrent_id, file_id)
 
-    @classmethod
-    def choice_to_torrent_file(menu, choice):
-        tf = menu.choice_to_torrent_file_id(choice)
+    def choice_to_torrent_file(menu, choice, update=None):
+        ''' Resolve a prompted choice from the userdata without RPCs, typed choices are looked up in the torrent's files '''
 
-        if tf is None:
-            return None
+        if update is not None:
+            torrent_file = menu.get_prompted_value(update, choice, 'torrent_file')
+            if torrent_file is not UNINITIALIZED:
+                return torrent_file
 
-        torrent_id, file_id = tf
+        torrent_id, file_id = menu.choice_to_torrent_file_id(choice)
+
+        if torrent_id is None:
+            return None
 
         for other in transmission_utils.iter_torrent_files(torrent_id):
             if other.file_id == file_id:
@@ -658,6 +1384,15 @@ class TorrentMenu(Menu):
     # TODO: init_state() before wrapper() so prompt doesnt always fail first time (currently a feature)
     '''
 
+    async def get_existing_torrent(menu, update, label, torrent_id):
+        ''' The torrent, None (replying so) if it was removed since it was prompted '''
+
+        try:
+            return await asyncio.to_thread(transmission_utils.make_torrent, torrent_id)
+        except KeyError:
+            LOGGER.info(repr_action(update, f'{label} failed, torrent no longer exists'))
+            await reply(update, f'Torrent {torrent_id} no longer exists')
+
     def create_magnet_handler(menu, state_name, callback, on_complete=UNINITIALIZED):
         ''' Prompt for magnet URL and call callback() with the URL 
         !! WARNING: on_complete must be a callback of this menu since everything here prefix_menu=True !!
@@ -694,7 +1429,7 @@ class TorrentMenu(Menu):
         return wrapper
         
     def create_torrent_handler(menu, state_name, callback, on_complete=UNINITIALIZED):
-        ''' Prompt for torrent ID and call callback() with ID 
+        ''' Prompt for torrent ID and call callback() with the torrent (transmission_utils functions take either)
         !! WARNING: on_complete must be a callback of this menu since everything here prefix_menu=True !!
         '''
 
@@ -706,7 +1441,7 @@ class TorrentMenu(Menu):
         async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             choice = get_text(update)
-            torrent_id = menu.choice_to_torrent_id(choice)
+            torrent_id = menu.choice_to_torrent_id(choice, update)
 
             if torrent_id is None:
                 await menu.prompt_torrent(update)
@@ -717,7 +1452,13 @@ class TorrentMenu(Menu):
             msg = repr_action(update, label)
             LOGGER.info(msg)
 
-            ret = await call_callback(callback, update, torrent_id)
+            # The choice was resolved from the prompt's torrents, which may have been removed since
+            torrent = await menu.get_existing_torrent(update, label, torrent_id)
+            if torrent is None:
+                await menu.prompt_torrent(update)
+                return state_name
+
+            ret = await call_callback(callback, update, torrent)
             await multi_reply(update, label, ret)
 
             if on_complete is not None:
@@ -743,7 +1484,7 @@ class TorrentMenu(Menu):
         async def _prompt_torrent_files(update, context):
             choice = get_text(update)
 
-            torrent_id = menu.choice_to_torrent_id(choice)
+            torrent_id = menu.choice_to_torrent_id(choice, update)
 
             if torrent_id is None:
                 await menu.prompt_torrent(update)
@@ -757,7 +1498,7 @@ class TorrentMenu(Menu):
         async def _process_torrent_file_choice(update, context):
             choice = get_text(update)
 
-            torrent_file = menu.choice_to_torrent_file(choice)
+            torrent_file = menu.choice_to_torrent_file(choice, update)
             if torrent_file is None:
                 await reply(update, 'Error choosing torrent file')
                 return await menu._main_menu(update, context)
@@ -767,6 +1508,10 @@ class TorrentMenu(Menu):
             msg = repr_action(update, label)
             LOGGER.info(msg)
 
+            # The choice was resolved from the prompt's files, the torrent may have been removed since
+            if await menu.get_existing_torrent(update, label, torrent_file.torrent_id) is None:
+                return await menu._main_menu(update, context)
+
             ret = await call_callback(callback, update, torrent_file)
             await multi_reply(update, label, ret)
 
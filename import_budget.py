@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+'''
+Check that importing the bot stays within a startup time budget
+
+Imports the bot in fresh interpreters with -X importtime and fails (exit code 1) when the fastest run is over
+the budget, or when a dependency which should be imported lazily was imported at startup
+
+    python3 import_budget.py                          # Check against IMPORT_TIME_BUDGET_MS
+    python3 import_budget.py --budget 300 --top 20    # Custom budget, show the 20 slowest imports
+'''
+
+import os
+import sys
+import json
+import argparse
+import compileall
+import subprocess
+
+import config
+
+
+# Imported on first use (see lazy_import.py), importing the bot mustn't import them
+LAZY_MODULES = ('bs4', 'requests', 'dlna_cast', 'upnpclient', 'transmissionrpc')
+
+DIRNAME = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_python(code, *args):
+    return subprocess.run([sys.executable, *args, '-c', code], cwd=DIRNAME, capture_output=True, text=True)
+
+
+def measure_import_time(module):
+    ''' Import module in a fresh interpreter, returns (total seconds, {module: self seconds}) '''
+
+    proc = run_python(f'import {module}', '-X', 'importtime')
+    if proc.returncode:
+        raise RuntimeError(f'Importing {module} failed:\n{proc.stderr}')
+
+    self_times = {}
+    total = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+
+        fields = line[len('import time:'):].split('|')
+        if not fields[0].strip().isdigit():
+            continue  # The header line
+
+        self_us, cumulative_us, name = int(fields[0]), int(fields[1]), fields[2].strip()
+        self_times[name] = self_us / 1e6
+        if name == module:
+            total = cumulative_us / 1e6
+
+    return total, self_times
+
+
+def find_eager_imports(module, lazy_modules=LAZY_MODULES):
+    code = f'import sys, json, {module}; print(json.dumps([m for m in {list(lazy_modules)!r} if m in sys.modules]))'
+    proc = run_python(code)
+    if proc.returncode:
+        raise RuntimeError(f'Importing {module} failed:\n{proc.stderr}')
+
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def check(module='telegram_transmission_bot', budget=getattr(config, 'IMPORT_TIME_BUDGET_MS', 350) / 1000,
+          runs=5, top=10):
+
+    # Measure imports, not compiling sources whose bytecode is stale (or never written, PYTHONDONTWRITEBYTECODE)
+    compileall.compile_dir(DIRNAME, maxlevels=0, quiet=1)
+
+    results = [measure_import_time(module) for _ in range(runs)]
+    total, self_times = min(results, key=lambda result: result[0])
+    ok = True
+
+    print(f'import {module}: {total * 1000:.0f}ms (fastest of {runs}, budget {budget * 1000:.0f}ms)')
+    print(f'Slowest {top} imports by self time:')
+    for name, seconds in sorted(self_times.items(), key=lambda item: item[1], reverse=True)[:top]:
+        print(f'    {seconds * 1000:7.1f}ms  {name}')
+
+    if total > budget:
+        print(f'FAIL: over the import time budget by {(total - budget) * 1000:.0f}ms')
+        ok = False
+
+    eager = find_eager_imports(module)
+    if eager:
+        print(f'FAIL: lazily imported dependencies were imported at startup: {", ".join(eager)}')
+        ok = False
+
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='telegram_transmission_bot', help='Module to import')
+    parser.add_argument('--budget', type=float, default=getattr(config, 'IMPORT_TIME_BUDGET_MS', 350),
+                        help='Import time budget in milliseconds')
+    parser.add_argument('--runs', type=int, default=5, help='Imports to measure, the fastest one is checked')
+    parser.add_argument('--top', type=int, default=10, help='Slowest imports to show')
+    args = parser.parse_args()
+
+    sys.exit(0 if check(args.module, budget=args.budget / 1000, runs=args.runs, top=args.top) else 1)
@@ -0,0 +1,55 @@
+import types
+import threading
+import importlib
+
+
+######################################################################
+# Lazy imports
+######################################################################
+
+class LazyModule(types.ModuleType):
+    '''
+    Stand-in for a module which imports it on first attribute access
+
+    Heavy dependencies which are only needed by some features (casting, Transmission RPC)
+    are bound to a LazyModule so importing the bot doesn't pay for them
+    '''
+
+    def __init__(self, name, on_import=None):
+        super().__init__(name)
+        self._lazy_on_import = on_import
+        self._lazy_module = None
+        self._lazy_lock = threading.Lock()
+
+    @property
+    def is_loaded(self):
+        return self._lazy_module is not None
+
+    def load(self):
+        if self._lazy_module is None:
+            with self._lazy_lock:
+                if self._lazy_module is None:
+                    module = importlib.import_module(self.__name__)
+
+                    if self._lazy_on_import is not None:
+                        self._lazy_on_import(module)
+
+                    self._lazy_module = module
+
+        return self._lazy_module
+
+    def __getattr__(self, name):
+        # Only called for attributes the stand-in itself doesn't have
+        return getattr(self.load(), name)
+
+    def __dir__(self):
+        return dir(self.load())
+
+    def __repr__(self):
+        state = 'loaded' if self.is_loaded else 'not loaded'
+        return f'<LazyModule {self.__name__} ({state})>'
+
+
+def lazy_import(name, on_import=None):
+    ''' Return a LazyModule of name, on_import(module) runs once right after it's really imported '''
+    return LazyModule(name, on_import=on_import)
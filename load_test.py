@@ -0,0 +1,491 @@
+#!/usr/bin/python3
+'''
+Synthetic multi-user load on the bot's menus, to size it before opening it to more users
+
+Fake users run scripted sessions through MAIN_MENU, SECOND_MENU, CAST_MENU, CONVERTION_MENU and the
+torrent, torrent file and magnet prompts concurrently. Their updates go through the bot's real handlers and
+PerUserUpdateProcessor, and each user waits for the bot's replies (and picks from their keyboards) before
+its next action. Replies go to a MockBotAPI, Transmission RPCs to a MockTransmission and UPnP actions to a
+MockRenderer, each with a configurable latency. Reports:
+    per action and per handler latency percentiles
+    Transmission RPCs and SOAP actions per user action
+    traced memory per active user
+    userdata entries, hits, misses, expirations and evictions per menu
+
+--head-of-line measures instead how long a slow command (a torrent delete whose RPC takes --slow-latency) and
+the next update of the same user delay the other users' commands, processing updates one at a time like the
+bot used to and with PerUserUpdateProcessor
+
+The mocks run in this process, so at high loads the reply latencies include their CPU time
+
+    python3 load_test.py                                        # 20 users, 3 sessions each
+    python3 load_test.py --users 200 --no-rate-limits           # Handler capacity, without Telegram's send limits
+    python3 load_test.py --users 100 --userdata-maxsize 50      # Userdata evictions
+    python3 load_test.py --head-of-line --users 10              # Sequential vs per-user update processing
+'''
+
+import re
+import gc
+import time
+import random
+import asyncio
+import logging
+import argparse
+import contextlib
+import tempfile
+import tracemalloc
+import collections
+
+from telegram import Update
+from telegram.ext import Application, SimpleUpdateProcessor
+
+import config
+import transmission_utils
+import telegram_transmission_bot as bot
+from bot_utils import SEND_QUEUE, WATCHES, RateLimiter, to_camel_case
+from tracing import TRACER, percentile
+from stream_utils import make_upnp_device
+from mock_telegram import MOCK_TOKEN, MockBotAPI
+from mock_renderer import MockRenderer
+from mock_transmission import MockTransmission
+
+
+LOGGER = logging.getLogger(__name__)
+
+USER_ID_BASE = 7000000
+
+# A step pressing a random choice button ("3: name", "3.1: file name") of the last keyboard the bot sent
+CHOOSE = None
+
+# name -> (weight, steps), every session starts and ends in the main menu.
+# Steps are layout command names pressed as their button text, magnet links are sent after formatting
+# {user_id} and {session}
+SCENARIOS = {
+    'list_torrents': (4, ['list_torrents']),
+    'watch_torrents': (1, ['watch_torrents']),
+    'list_torrent_files': (3, ['list_torrent_files', CHOOSE]),
+    'stop_start_torrent': (2, ['stop_torrent', CHOOSE, 'start_torrent', CHOOSE]),
+    'toggle_torrent_files': (2, ['toggle_torrent_files', CHOOSE, CHOOSE, CHOOSE, 'done']),
+    'add_movie': (1, ['add_movie', 'magnet:?xt=urn:btih:{user_id:020d}{session:020d}&dn=Load+test+{user_id}+{session}']),
+    'storage_stats': (1, ['more', 'storage_stats', 'back']),
+    'convertions': (1, ['more', 'convert_videos', 'list_converted_files', 'list_active_convertions', 'back', 'back']),
+    'cast_control': (2, ['more', 'cast_videos', 'control_UPNP_device', CHOOSE, 'volume_up', 'pause',
+                         'back', 'back', 'back']),
+}
+
+CHOICE_PATTERN = re.compile(r'^\d+(\.\d+)?: ')
+
+MENUS = (bot.MAIN_MENU, bot.SECOND_MENU, bot.ADMIN_MENU, bot.CAST_MENU, bot.CONVERTION_MENU, bot.UPNP_CAST_MENU)
+
+# Allocations by the fake back-ends aren't the bot's memory per user
+MEMORY_EXCLUDED_FILES = ('*mock_telegram.py', '*mock_transmission.py', '*mock_renderer.py')
+
+
+######################################################################
+# Fake users
+######################################################################
+
+class LoadTest(object):
+    '''
+    Runs fake users through the application's handlers and collects per action samples
+
+    Actions are labeled by the button pressed, choices by the command they answer ("Start Torrent choice").
+    update_processor defaults to the application's
+    '''
+
+    def __init__(self, api: MockBotAPI, application: Application, think_time=0, ramp_up=1, seed=0,
+                 update_processor=None):
+        self.api = api
+        self.application = application
+        self.update_processor = update_processor or application.update_processor
+        self.think_time = think_time
+        self.ramp_up = ramp_up
+        self.random = random.Random(seed)
+
+        self.record = True
+        self.handled = collections.defaultdict(list)   # action -> [seconds until its handler returned]
+        self.replied = collections.defaultdict(list)   # action -> [seconds until the bot's replies were sent]
+        self.rpcs = collections.defaultdict(list)      # action -> [Transmission RPCs]
+        self.soaps = collections.defaultdict(list)     # action -> [SOAP actions]
+        self.handlers = collections.defaultdict(list)  # handler state -> [seconds]
+        self.errors = collections.Counter()            # handler state -> failed updates
+
+    def choose(self, user_id):
+        choices = [text for text in self.api.keyboards.get(user_id, []) if CHOICE_PATTERN.match(text)]
+        return self.random.choice(choices) if choices else 'Cancel'
+
+    async def wait_for_replies(self, chat_id):
+        while chat_id in SEND_QUEUE.workers:
+            await asyncio.wait([SEND_QUEUE.workers[chat_id]])
+
+    async def process(self, user_id, text):
+        ''' Process a message from user_id without waiting for the bot's replies, returns the Update '''
+
+        update = Update.de_json(self.api.create_message_update(user_id, text), self.application.bot)
+        await self.update_processor.process_update(update, self.application.process_update(update))
+        return update
+
+    async def act(self, user_id, text, label):
+        since = time.time()
+        start = time.perf_counter()
+
+        update = await self.process(user_id, text)
+        handled = time.perf_counter()
+
+        await self.wait_for_replies(user_id)
+        replied = time.perf_counter()
+
+        if not self.record:
+            return
+
+        spans = TRACER.get_spans(update_id=update.update_id, since=since)
+        for span in spans:
+            if span.kind == 'handler':
+                self.handlers[span.name].append(span.duration)
+                if span.error:
+                    self.errors[span.name] += 1
+
+        self.handled[label].append(handled - start)
+        self.replied[label].append(replied - start)
+        self.rpcs[label].append(sum(1 for span in spans if span.kind == 'transmission'))
+        self.soaps[label].append(sum(1 for span in spans if span.kind == 'soap'))
+
+    async def run_session(self, user_id, session, steps):
+        command = None
+
+        for step in steps:
+            if step is CHOOSE:
+                text = self.choose(user_id)
+                label = f'{command} choice'
+            elif step.startswith('magnet:'):
+                text = step.format(user_id=user_id, session=session)
+                label = 'magnet link'
+            else:
+                text = label = command = to_camel_case(step)
+
+            await self.act(user_id, text, label)
+
+            if self.think_time:
+                await asyncio.sleep(self.random.expovariate(1 / self.think_time))
+
+    async def run_user(self, user_id, sessions, scenarios=None, exit=True):
+        ''' Start the conversation, run sessions random (weighted) scenarios or the given ones, then exit '''
+
+        if self.ramp_up:
+            await asyncio.sleep(self.random.uniform(0, self.ramp_up))
+
+        await self.act(user_id, 'Hi', 'Hi')
+
+        if scenarios is None:
+            names = list(SCENARIOS)
+            scenarios = self.random.choices(names, weights=[SCENARIOS[name][0] for name in names], k=sessions)
+
+        for session, name in enumerate(scenarios):
+            await self.run_session(user_id, session, SCENARIOS[name][1])
+
+        if exit:
+            await self.act(user_id, 'Exit', 'Exit')
+
+    async def run_users(self, user_ids, sessions, **kwargs):
+        bot.MAIN_MENU.authenticated_user_ids.update(user_ids)
+        await asyncio.gather(*(self.run_user(user_id, sessions, **kwargs) for user_id in user_ids))
+
+    async def measure_memory(self, user_ids, top=5):
+        '''
+        Traced memory still allocated after every user ran each scenario once without exiting, divided by the users,
+        and the top allocation sites. Users aren't recorded, tracemalloc slows everything down
+        '''
+
+        self.record = False
+        gc.collect()
+        tracemalloc.start(16)
+
+        try:
+            await self.run_users(user_ids, 1, scenarios=list(SCENARIOS), exit=False)
+            await SEND_QUEUE.join()
+
+            # The span buffer is bounded, it isn't memory per user
+            TRACER.clear()
+            gc.collect()
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+            self.record = True
+
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, pattern, all_frames=True)
+                                           for pattern in MEMORY_EXCLUDED_FILES])
+        stats = snapshot.statistics('lineno')
+        return sum(stat.size for stat in stats) / len(user_ids), stats[:top]
+
+
+    async def measure_head_of_line(self, slow_user_id, user_ids, delay=0.05):
+        '''
+        Seconds until each of user_ids' List Torrents was handled, sent delay seconds after slow_user_id
+        chose a torrent to delete and sent List Torrents right after it. Also returns the update_ids of
+        slow_user_id's two updates in the order they were handled
+        '''
+
+        await self.act(slow_user_id, to_camel_case('delete_torrent'), 'Delete Torrent')
+        choice = self.choose(slow_user_id)
+
+        slow_order = []
+
+        async def process_slow(text):
+            update = await self.process(slow_user_id, text)
+            slow_order.append(update.update_id)
+
+        async def process_other(user_id):
+            await asyncio.sleep(delay)
+            start = time.perf_counter()
+            await self.process(user_id, to_camel_case('list_torrents'))
+            return time.perf_counter() - start
+
+        # Tasks start in creation order, so the delete reaches the update processor first
+        slow_tasks = [asyncio.create_task(process_slow(choice)),
+                      asyncio.create_task(process_slow(to_camel_case('list_torrents')))]
+        latencies = await asyncio.gather(*(process_other(user_id) for user_id in user_ids))
+        await asyncio.gather(*slow_tasks)
+
+        return latencies, slow_order
+
+
+######################################################################
+# Report
+######################################################################
+
+def _percentiles_ms(samples, ps=(50, 95, 99)):
+    samples = sorted(samples)
+    return ' / '.join(f'{percentile(samples, p) * 1000:6.1f}' for p in ps)
+
+
+def _mean(values):
+    return sum(values) / len(values) if values else 0
+
+
+def get_userdata_rows(stats_before):
+    ''' (menu name, entries, maxsize, ttl, stats since stats_before) of every menu's userdata storage '''
+
+    rows = []
+    for menu in MENUS:
+        storage = menu.get_userdata_storage()
+        rows.append((menu.name, len(storage), storage.maxsize, storage.ttl, storage.stats - stats_before[menu.name]))
+    return rows
+
+
+def report(load_test, elapsed, transmission_requests, userdata_rows, memory=None):
+    actions = sum(len(samples) for samples in load_test.handled.values())
+    print(f'{actions} actions in {elapsed:.1f}s ({actions / elapsed:.1f}/s)\n')
+
+    print(f'{"action":32} {"n":>5}  {"handled p50 / p95 / p99 ms":>27}  {"replied p50 / p95 / p99 ms":>27}  '
+          f'{"RPCs":>5} {"max":>4}  {"SOAP":>5}')
+    for label in sorted(load_test.handled, key=lambda label: -percentile(sorted(load_test.handled[label]), 95)):
+        rpcs, soaps = load_test.rpcs[label], load_test.soaps[label]
+        print(f'{label:32} {len(load_test.handled[label]):5}  {_percentiles_ms(load_test.handled[label]):>27}  '
+              f'{_percentiles_ms(load_test.replied[label]):>27}  {_mean(rpcs):5.1f} {max(rpcs):4}  {_mean(soaps):5.1f}')
+
+    print(f'\n{"handler":56} {"n":>5}  {"p50 / p95 / p99 ms":>27}  errors')
+    for name in sorted(load_test.handlers, key=lambda name: -percentile(sorted(load_test.handlers[name]), 95)):
+        print(f'{name:56} {len(load_test.handlers[name]):5}  {_percentiles_ms(load_test.handlers[name]):>27}  '
+              f'{load_test.errors[name] or ""}')
+
+    action_rpcs = sum(sum(rpcs) for rpcs in load_test.rpcs.values())
+    total_rpcs = sum(transmission_requests.values())
+    print(f'\nTransmission RPCs: {total_rpcs} ({action_rpcs / actions:.2f} per action, '
+          f'{total_rpcs - action_rpcs} outside of actions by watches), '
+          f'by method: {dict(transmission_requests.most_common())}')
+
+    if memory is not None:
+        memory_per_user, top_stats = memory
+        print(f'\nTraced memory per active user: {memory_per_user / 1024:.1f}KB, largest allocation sites:')
+        for stat in top_stats:
+            frame = stat.traceback[0]
+            print(f'    {stat.size / 1024:8.1f}KB  {frame.filename}:{frame.lineno}')
+
+    print(f'\n{"userdata":18} {"entries":>8} {"maxsize":>8} {"ttl":>6} {"hits":>8} {"misses":>8} '
+          f'{"expirations":>12} {"evictions":>10}')
+    for name, entries, maxsize, ttl, stats in userdata_rows:
+        print(f'{name:18} {entries:8} {str(maxsize):>8} {ttl:6} {stats["hits"]:8} '
+              f'{stats["misses"]:8} {stats["expirations"]:12} {stats["evictions"]:10}')
+
+
+######################################################################
+# Load test
+######################################################################
+
+UNLIMITED_RATE = 10 ** 6
+
+
+@contextlib.contextmanager
+def unlimited_sends(send_queue=SEND_QUEUE):
+    ''' Send replies as fast as the mock Bot API answers them, for phases which don't measure reply latency '''
+
+    saved = send_queue.chat_rate, send_queue.chat_burst, send_queue.global_limiter
+    send_queue.chat_rate = send_queue.chat_burst = UNLIMITED_RATE
+    send_queue.global_limiter = RateLimiter(UNLIMITED_RATE, burst=UNLIMITED_RATE)
+
+    try:
+        yield
+    finally:
+        send_queue.chat_rate, send_queue.chat_burst, send_queue.global_limiter = saved
+
+
+async def stop_watches():
+    for watch in list(WATCHES.watches.values()):
+        WATCHES.stop(watch)
+    await SEND_QUEUE.join()
+
+async def run(users=20, sessions=3, think_time=0, ramp_up=1, rpc_latency=0.02, upnp_latency=0.02, api_latency=0,
+              torrents=20, rate_limits=True, userdata_maxsize=None, userdata_ttl=None, memory_users=5,
+              ip='127.0.0.1', seed=0):
+
+    download_dir = tempfile.TemporaryDirectory()
+    config.DIR_MOVIES = config.DIR_TV_SHOWS = download_dir.name
+
+    api = MockBotAPI(ip=ip, latency=api_latency)
+    api.start()
+
+    transmission = MockTransmission(download_dir.name, torrents=torrents, latency=rpc_latency, seed=seed)
+    transmission_utils.TRANSMISSION_RPC_OBJECT = transmission_utils.create_transmission_rpc(http_handler=transmission)
+
+    renderer = MockRenderer(ip=ip, ssdp_address=(ip, 0), action_latency=upnp_latency)
+    renderer.start(ssdp=False)
+    bot.UPNP_REGISTRY.add_device(make_upnp_device(renderer.location, iface_ip=ip))
+    bot.SERVER.start_threads()
+
+    for menu in MENUS:
+        storage = menu.get_userdata_storage()
+        if userdata_maxsize is not None:
+            storage.maxsize = userdata_maxsize
+        if userdata_ttl is not None:
+            storage.ttl = userdata_ttl
+
+    application = bot.create_application(Application.builder().token(MOCK_TOKEN).base_url(api.base_url))
+    load_test = LoadTest(api, application, think_time=think_time, ramp_up=ramp_up, seed=seed)
+
+    try:
+        async with application:
+            # Warm up lazy imports, connections and caches with a user running every scenario once
+            load_test.record = False
+            with unlimited_sends():
+                await load_test.run_users([USER_ID_BASE - 1], 1, scenarios=list(SCENARIOS))
+            load_test.record = True
+            transmission.requests.clear()
+
+            userdata_stats_before = {menu.name: menu.get_userdata_storage().stats.copy() for menu in MENUS}
+
+            # Chats' rate limiters are created on their first reply, so the load's users get the current limits
+            with (contextlib.nullcontext() if rate_limits else unlimited_sends()):
+                start = time.monotonic()
+                await load_test.run_users(range(USER_ID_BASE, USER_ID_BASE + users), sessions)
+                elapsed = time.monotonic() - start
+
+                transmission_requests = transmission.requests.copy()
+                userdata_rows = get_userdata_rows(userdata_stats_before)
+                await stop_watches()
+
+            memory = None
+            if memory_users:
+                with unlimited_sends():
+                    memory = await load_test.measure_memory(
+                        range(USER_ID_BASE + users, USER_ID_BASE + users + memory_users))
+                    await stop_watches()
+
+        report(load_test, elapsed, transmission_requests, userdata_rows, memory=memory)
+        return load_test
+
+    finally:
+        bot.SERVER.stop_threads()
+        renderer.stop()
+        api.stop()
+        download_dir.cleanup()
+
+
+async def run_head_of_line(users=10, slow_latency=2, rpc_latency=0.02, torrents=20, ip='127.0.0.1', seed=0):
+    '''
+    Other users' List Torrents latency while a user's torrent delete takes slow_latency seconds,
+    processing updates one at a time (before PerUserUpdateProcessor) and per user
+    '''
+
+    download_dir = tempfile.TemporaryDirectory()
+    config.DIR_MOVIES = config.DIR_TV_SHOWS = download_dir.name
+
+    api = MockBotAPI(ip=ip)
+    api.start()
+
+    transmission = MockTransmission(download_dir.name, torrents=torrents, latency=rpc_latency,
+                                    method_latencies={'torrent-remove': slow_latency}, seed=seed)
+    transmission_utils.TRANSMISSION_RPC_OBJECT = transmission_utils.create_transmission_rpc(http_handler=transmission)
+
+    application = bot.create_application(Application.builder().token(MOCK_TOKEN).base_url(api.base_url))
+    processors = (('sequential', SimpleUpdateProcessor(1)), ('per-user', application.update_processor))
+
+    results = []
+    user_id = USER_ID_BASE
+
+    try:
+        async with application:
+            # Replies aren't measured, only how long each update waited and ran
+            with unlimited_sends():
+                warm_up = LoadTest(api, application, ramp_up=0, seed=seed)
+                warm_up.record = False
+                await warm_up.run_users([USER_ID_BASE - 1], 1, scenarios=['list_torrents'])
+
+                for name, update_processor in processors:
+                    load_test = LoadTest(api, application, ramp_up=0, seed=seed, update_processor=update_processor)
+                    slow_user_id, user_ids = user_id, list(range(user_id + 1, user_id + 1 + users))
+                    user_id += users + 1
+
+                    # Every user starts in the main menu
+                    await load_test.run_users([slow_user_id] + user_ids, 0, exit=False)
+                    load_test.record = False
+
+                    latencies, slow_order = await load_test.measure_head_of_line(slow_user_id, user_ids)
+                    results.append((name, sorted(latencies), slow_order == sorted(slow_order)))
+                    await SEND_QUEUE.join()
+
+    finally:
+        api.stop()
+        download_dir.cleanup()
+
+    print(f'A user deletes a torrent ({slow_latency * 1000:.0f}ms RPC) and sends another update, '
+          f'while {users} other users list torrents ({rpc_latency * 1000:.0f}ms RPC)\n')
+    print(f'{"processing":12} {"other users p50 / max ms":>25}  slow user in order')
+    for name, latencies, in_order in results:
+        print(f'{name:12} {percentile(latencies, 50) * 1000:12.1f} / {latencies[-1] * 1000:8.1f}  '
+              f'{"yes" if in_order else "NO"}')
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20, help='Concurrent fake users')
+    parser.add_argument('--sessions', type=int, default=3, help='Scenarios each user runs')
+    parser.add_argument('--think-time', type=float, default=0, help='Mean seconds a user waits between actions')
+    parser.add_argument('--ramp-up', type=float, default=1, help='Seconds over which the users start')
+    parser.add_argument('--rpc-latency', type=float, default=0.02, help='Seconds every Transmission RPC takes')
+    parser.add_argument('--upnp-latency', type=float, default=0.02, help='Seconds every SOAP action takes')
+    parser.add_argument('--api-latency', type=float, default=0, help='One-way Bot API network latency in seconds')
+    parser.add_argument('--torrents', type=int, default=20, help='Torrents in the mock Transmission')
+    parser.add_argument('--no-rate-limits', action='store_true', help="Don't rate limit replies like Telegram does")
+    parser.add_argument('--userdata-maxsize', type=int, help='Override every menu userdata storage maxsize')
+    parser.add_argument('--userdata-ttl', type=float, help='Override every menu userdata storage TTL in seconds')
+    parser.add_argument('--memory-users', type=int, default=5, help='Users to measure memory with, 0 to skip')
+    parser.add_argument('--ip', default='127.0.0.1', help='IP to serve the mocks on')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the scenarios and choices')
+    parser.add_argument('--head-of-line', action='store_true',
+                        help="Measure a slow command's delay of other users, sequential vs per-user processing")
+    parser.add_argument('--slow-latency', type=float, default=2, help="Seconds the --head-of-line slow RPC takes")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.head_of_line:
+        asyncio.run(run_head_of_line(users=args.users, slow_latency=args.slow_latency, rpc_latency=args.rpc_latency,
+                                     torrents=args.torrents, ip=args.ip, seed=args.seed))
+    else:
+        asyncio.run(run(users=args.users, sessions=args.sessions, think_time=args.think_time, ramp_up=args.ramp_up,
+                        rpc_latency=args.rpc_latency, upnp_latency=args.upnp_latency, api_latency=args.api_latency,
+                        torrents=args.torrents, rate_limits=not args.no_rate_limits,
+                        userdata_maxsize=args.userdata_maxsize, userdata_ttl=args.userdata_ttl,
+                        memory_users=args.memory_users, ip=args.ip, seed=args.seed))
@@ -0,0 +1,894 @@
+#!/usr/bin/python3
+'''
+A fake DLNA MediaRenderer to test and measure casting without a TV
+
+It answers SSDP searches, serves a device description, handles AVTransport/RenderingControl/ConnectionManager
+SOAP actions and GENA subscriptions, and fetches the casted media like TVs do (HEAD, a probing range GET,
+then streaming GETs on Play and Seek)
+
+    python3 mock_renderer.py               # Run a fake TV on the LAN for the bot to cast to
+    python3 mock_renderer.py --benchmark   # Measure casting latencies through UPNPDeviceControl
+    python3 mock_renderer.py --benchmark-events   # Compare AVTransport event parsing with ElementTree and bs4
+'''
+
+import os
+import re
+import time
+import uuid
+import timeit
+import struct
+import socket
+import logging
+import argparse
+import functools
+import threading
+import statistics
+import tempfile
+import collections
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+from xml.sax.saxutils import escape as xml_escape, quoteattr as xml_quoteattr
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests  # python3 -m pip install requests
+
+import config
+from stream_utils import (
+    GENASubscriptionManager,
+    HTTPTorrentServer,
+    PlaybackClock,
+    RendererCapabilityCache,
+    UPNPDeviceControl,
+    UPNPDeviceRegistry,
+    clock_to_seconds,
+    get_iface_ip,
+    make_upnp_device,
+    parse_AVTransport_event,
+    parse_ssdp_message,
+    seconds_to_clock,
+)
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+######################################################################
+# Service descriptions
+######################################################################
+
+SERVICE_TYPE_TEMPLATE = 'urn:schemas-upnp-org:service:{name}:1'
+
+# service name -> action name -> ([(in argument, state variable)], [(out argument, state variable)])
+SERVICE_ACTIONS = {
+    'AVTransport': {
+        'SetAVTransportURI': ([('InstanceID', 'A_ARG_TYPE_InstanceID'), ('CurrentURI', 'AVTransportURI'),
+                               ('CurrentURIMetaData', 'AVTransportURIMetaData')], []),
+        'SetNextAVTransportURI': ([('InstanceID', 'A_ARG_TYPE_InstanceID'), ('NextURI', 'NextAVTransportURI'),
+                                   ('NextURIMetaData', 'NextAVTransportURIMetaData')], []),
+        'Play': ([('InstanceID', 'A_ARG_TYPE_InstanceID'), ('Speed', 'TransportPlaySpeed')], []),
+        'Pause': ([('InstanceID', 'A_ARG_TYPE_InstanceID')], []),
+        'Stop': ([('InstanceID', 'A_ARG_TYPE_InstanceID')], []),
+        'Seek': ([('InstanceID', 'A_ARG_TYPE_InstanceID'), ('Unit', 'A_ARG_TYPE_SeekMode'),
+                  ('Target', 'A_ARG_TYPE_SeekTarget')], []),
+        'GetPositionInfo': ([('InstanceID', 'A_ARG_TYPE_InstanceID')],
+                            [('Track', 'CurrentTrack'), ('TrackDuration', 'CurrentTrackDuration'),
+                             ('TrackMetaData', 'CurrentTrackMetaData'), ('TrackURI', 'CurrentTrackURI'),
+                             ('RelTime', 'RelativeTimePosition'), ('AbsTime', 'AbsoluteTimePosition')]),
+        'GetTransportInfo': ([('InstanceID', 'A_ARG_TYPE_InstanceID')],
+                             [('CurrentTransportState', 'TransportState'),
+                              ('CurrentTransportStatus', 'TransportStatus'),
+                              ('CurrentSpeed', 'TransportPlaySpeed')]),
+    },
+    'RenderingControl': {
+        'GetVolume': ([('InstanceID', 'A_ARG_TYPE_InstanceID'), ('Channel', 'A_ARG_TYPE_Channel')],
+                      [('CurrentVolume', 'Volume')]),
+        'SetVolume': ([('InstanceID', 'A_ARG_TYPE_InstanceID'), ('Channel', 'A_ARG_TYPE_Channel'),
+                       ('DesiredVolume', 'Volume')], []),
+        'GetMute': ([('InstanceID', 'A_ARG_TYPE_InstanceID'), ('Channel', 'A_ARG_TYPE_Channel')],
+                    [('CurrentMute', 'Mute')]),
+        'SetMute': ([('InstanceID', 'A_ARG_TYPE_InstanceID'), ('Channel', 'A_ARG_TYPE_Channel'),
+                     ('DesiredMute', 'Mute')], []),
+    },
+    'ConnectionManager': {
+        'GetProtocolInfo': ([], [('Source', 'SourceProtocolInfo'), ('Sink', 'SinkProtocolInfo')]),
+    },
+}
+
+STATE_VARIABLE_TYPES = {
+    'A_ARG_TYPE_InstanceID': 'ui4',
+    'A_ARG_TYPE_Channel': 'string',
+    'A_ARG_TYPE_SeekMode': 'string',
+    'A_ARG_TYPE_SeekTarget': 'string',
+    'CurrentTrack': 'ui4',
+    'Volume': 'ui2',
+    'Mute': 'boolean',
+}
+
+# name -> (minimum, maximum) of allowedValueRange
+STATE_VARIABLE_RANGES = {
+    'Volume': (0, 100),
+}
+
+DEVICE_DESCRIPTION_TEMPLATE = '''<?xml version="1.0"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+<specVersion><major>1</major><minor>0</minor></specVersion>
+<device>
+<deviceType>urn:schemas-upnp-org:device:MediaRenderer:1</deviceType>
+<friendlyName>{friendly_name}</friendlyName>
+<manufacturer>EasySailBot</manufacturer>
+<modelName>MockRenderer</modelName>
+<modelNumber>1</modelNumber>
+<UDN>{udn}</UDN>
+<serviceList>{services}</serviceList>
+</device>
+</root>'''
+
+SERVICE_TEMPLATE = '''
+<service>
+<serviceType>{service_type}</serviceType>
+<serviceId>urn:upnp-org:serviceId:{name}</serviceId>
+<SCPDURL>/{name}/scpd.xml</SCPDURL>
+<controlURL>/{name}/control</controlURL>
+<eventSubURL>/{name}/event</eventSubURL>
+</service>'''
+
+SOAP_RESPONSE_TEMPLATE = '''<?xml version="1.0"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+<s:Body><u:{action}Response xmlns:u="{service_type}">{arguments}</u:{action}Response></s:Body>
+</s:Envelope>'''
+
+LAST_CHANGE_TEMPLATE = '''<?xml version="1.0"?>
+<e:propertyset xmlns:e="urn:schemas-upnp-org:event-1-0">
+<e:property><LastChange>{last_change}</LastChange></e:property>
+</e:propertyset>'''
+
+DEFAULT_SINK = ','.join([
+    'http-get:*:video/mp4:DLNA.ORG_PN=AVC_MP4_HP_HD_AAC',
+    'http-get:*:video/mp4:*',
+    'http-get:*:video/x-matroska:*',
+    'http-get:*:video/mp2t:*',
+    'http-get:*:audio/mpeg:DLNA.ORG_PN=MP3',
+])
+
+def make_last_change_event(variables):
+    ''' NOTIFY body of an AVTransport LastChange event with the InstanceID 0 variables '''
+
+    instance = ''.join(f'<{name} val={xml_quoteattr(str(value))}/>' for name, value in variables.items())
+    last_change = f'<Event xmlns="urn:schemas-upnp-org:metadata-1-0/AVT/"><InstanceID val="0">{instance}</InstanceID></Event>'
+    return LAST_CHANGE_TEMPLATE.format(last_change=xml_escape(last_change))
+
+
+def make_scpd(service_name):
+    actions = SERVICE_ACTIONS[service_name]
+    state_variables = set()
+
+    actions_xml = ''
+    for action, (arguments_in, arguments_out) in actions.items():
+        arguments_xml = ''
+        for direction, arguments in (('in', arguments_in), ('out', arguments_out)):
+            for name, state_variable in arguments:
+                state_variables.add(state_variable)
+                arguments_xml += (f'<argument><name>{name}</name><direction>{direction}</direction>'
+                                  f'<relatedStateVariable>{state_variable}</relatedStateVariable></argument>')
+
+        actions_xml += f'<action><name>{action}</name><argumentList>{arguments_xml}</argumentList></action>'
+
+    state_variables_xml = ''
+    for name in sorted(state_variables | {'LastChange'}):
+        range_xml = ''
+        if name in STATE_VARIABLE_RANGES:
+            minimum, maximum = STATE_VARIABLE_RANGES[name]
+            range_xml = f'<allowedValueRange><minimum>{minimum}</minimum><maximum>{maximum}</maximum></allowedValueRange>'
+
+        state_variables_xml += (f'<stateVariable sendEvents="no"><name>{name}</name>'
+                                f'<dataType>{STATE_VARIABLE_TYPES.get(name, "string")}</dataType>{range_xml}</stateVariable>')
+
+    return ('<?xml version="1.0"?><scpd xmlns="urn:schemas-upnp-org:service-1-0">'
+            '<specVersion><major>1</major><minor>0</minor></specVersion>'
+            f'<actionList>{actions_xml}</actionList>'
+            f'<serviceStateTable>{state_variables_xml}</serviceStateTable></scpd>')
+
+
+######################################################################
+# Fake renderer
+######################################################################
+
+class MockRendererHandler(BaseHTTPRequestHandler):
+    ''' Serves the renderer's descriptions, SOAP control and GENA event urls '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, renderer, *args, **kwargs):
+        self.renderer = renderer
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format, *args):
+        LOGGER.debug(format % args)
+
+    def _send(self, status_code, body=b'', content_type='text/xml; charset="utf-8"', headers=None):
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _service_name(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] not in SERVICE_ACTIONS:
+            return None, None
+        return parts
+
+    def do_GET(self):
+        if self.path == '/description.xml':
+            self._send(200, self.renderer.make_description().encode())
+            return
+
+        service_name, resource = self._service_name()
+        if resource == 'scpd.xml':
+            self._send(200, make_scpd(service_name).encode())
+            return
+
+        self._send(404)
+
+    def do_POST(self):
+        service_name, resource = self._service_name()
+        if resource != 'control':
+            self._send(404)
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        action = ElementTree.fromstring(body).find('{http://schemas.xmlsoap.org/soap/envelope/}Body')[0]
+        action_name = action.tag.split('}')[-1]
+        arguments = {child.tag.split('}')[-1]: child.text or '' for child in action}
+
+        try:
+            ret = self.renderer.handle_action(service_name, action_name, arguments)
+        except Exception as e:
+            LOGGER.exception(f'Mock renderer failed handling {action_name}')
+            self._send(500, str(e).encode(), content_type='text/plain')
+            return
+
+        arguments_xml = ''.join(f'<{name}>{xml_escape(str(value))}</{name}>' for name, value in ret.items())
+        response = SOAP_RESPONSE_TEMPLATE.format(action=action_name, arguments=arguments_xml,
+                                                 service_type=SERVICE_TYPE_TEMPLATE.format(name=service_name))
+        self._send(200, response.encode())
+
+    def do_SUBSCRIBE(self):
+        service_name, resource = self._service_name()
+        if resource != 'event':
+            self._send(404)
+            return
+
+        sid = self.headers.get('SID')
+        if sid:
+            if not self.renderer.renew_subscription(sid):
+                self._send(412)
+                return
+        else:
+            callback = self.headers.get('CALLBACK', '').strip('<>')
+            sid = self.renderer.add_subscription(service_name, callback)
+
+        self._send(200, headers={'SID': sid, 'TIMEOUT': f'Second-{self.renderer.subscription_timeout}'})
+
+        # The initial event is sent after the SUBSCRIBE response like real devices
+        if not self.headers.get('SID'):
+            self.renderer.send_initial_event(sid)
+
+    def do_UNSUBSCRIBE(self):
+        self.renderer.remove_subscription(self.headers.get('SID'))
+        self._send(200)
+
+
+class MockRenderer(object):
+    '''
+    A fake MediaRenderer serving on ip:http_port and answering SSDP searches on ssdp_address
+
+    Casted media is fetched from its url: HEAD and a probe_size range GET on SetAVTransportURI,
+    then a streaming GET of stream_size bytes (from the seeked byte offset) on Play and Seek.
+    SOAP actions take action_latency seconds, like a TV's slow UPnP stack.
+    The times of these steps are kept in self.timings for benchmarks
+    '''
+
+    def __init__(self, ip='127.0.0.1', http_port=0, ssdp_address=UPNPDeviceRegistry.SSDP_ADDRESS,
+                 friendly_name='Mock Renderer', sink=DEFAULT_SINK, supports_next_uri=True,
+                 probe_size=64 * 1024, stream_size=1024 * 1024, subscription_timeout=300, action_latency=0):
+        self.ip = ip
+        self.ssdp_address = ssdp_address
+        self.friendly_name = friendly_name
+        self.udn = f'uuid:{uuid.uuid4()}'
+        self.sink = sink
+        self.supports_next_uri = supports_next_uri
+        self.probe_size = probe_size
+        self.stream_size = stream_size
+        self.subscription_timeout = subscription_timeout
+        self.action_latency = action_latency
+
+        self.lock = threading.RLock()
+        self.session = requests.Session()
+        self.subscriptions = {}  # sid -> [service name, callback url, event sequence number]
+
+        self.transport_state = 'NO_MEDIA_PRESENT'
+        self.uri = self.next_uri = ''
+        self.uri_metadata = self.next_uri_metadata = ''
+        self.duration = 0
+        self.clock = PlaybackClock()
+        self.volume = 20
+        self.mute = False
+        self.fetch_generation = 0
+
+        self.timings = {}  # step name -> time.monotonic() it last happened
+        self.events = threading.Condition(self.lock)
+        self.sent_events = []  # (time.monotonic(), sid, LastChange variables)
+
+        handler = functools.partial(MockRendererHandler, self)
+        self.http_server = ThreadingHTTPServer((ip, http_port), handler)
+        self.http_server.daemon_threads = True
+
+        self.ssdp_socket = None
+        self.threads = []
+
+    @property
+    def location(self):
+        ip, port = self.http_server.server_address
+        return f'http://{ip}:{port}/description.xml'
+
+    def make_description(self):
+        services = ''.join(SERVICE_TEMPLATE.format(name=name, service_type=SERVICE_TYPE_TEMPLATE.format(name=name))
+                           for name in SERVICE_ACTIONS)
+        return DEVICE_DESCRIPTION_TEMPLATE.format(friendly_name=xml_escape(self.friendly_name),
+                                                  udn=self.udn, services=services)
+
+    def mark(self, step):
+        with self.events:
+            self.timings[step] = time.monotonic()
+            self.events.notify_all()
+
+    def wait_for(self, predicate, timeout=10):
+        with self.events:
+            return self.events.wait_for(predicate, timeout)
+
+    ###############
+    # SSDP
+    def _ssdp_message(self, start_line, headers):
+        lines = [start_line] + [f'{key}: {value}' for key, value in headers.items()]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode()
+
+    def send_notify(self, nts='ssdp:alive', address=None):
+        message = self._ssdp_message('NOTIFY * HTTP/1.1', {
+            'HOST': '239.255.255.250:1900',
+            'CACHE-CONTROL': 'max-age=1800',
+            'LOCATION': self.location,
+            'NT': 'urn:schemas-upnp-org:device:MediaRenderer:1',
+            'NTS': nts,
+            'USN': f'{self.udn}::urn:schemas-upnp-org:device:MediaRenderer:1',
+        })
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(message, address or self.ssdp_address)
+
+    def _answer_ssdp_searches(self):
+        while self.ssdp_socket is not None:
+            try:
+                data, address = self.ssdp_socket.recvfrom(4096)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+
+            start_line, headers = parse_ssdp_message(data)
+            if not start_line.upper().startswith('M-SEARCH'):
+                continue
+
+            st = headers.get('st', 'ssdp:all')
+            if st not in ('ssdp:all', 'upnp:rootdevice', 'urn:schemas-upnp-org:device:MediaRenderer:1'):
+                continue
+
+            response = self._ssdp_message('HTTP/1.1 200 OK', {
+                'CACHE-CONTROL': 'max-age=1800',
+                'EXT': '',
+                'LOCATION': self.location,
+                'ST': st,
+                'USN': f'{self.udn}::{st}',
+            })
+            self.ssdp_socket.sendto(response, address)
+
+    def _create_ssdp_socket(self):
+        ip, port = self.ssdp_address
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        if ip.startswith('239.'):
+            sock.bind(('', port))
+            membership = struct.pack('=4sl', socket.inet_aton(ip), socket.INADDR_ANY)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        else:
+            sock.bind((ip, port))
+
+        sock.settimeout(1)
+        return sock
+
+    ###############
+    # GENA
+    def add_subscription(self, service_name, callback):
+        sid = f'uuid:{uuid.uuid4()}'
+        with self.lock:
+            self.subscriptions[sid] = [service_name, callback, 0]
+        return sid
+
+    def renew_subscription(self, sid):
+        with self.lock:
+            return sid in self.subscriptions
+
+    def remove_subscription(self, sid):
+        with self.lock:
+            self.subscriptions.pop(sid, None)
+
+    def _avtransport_variables(self):
+        actions = {
+            'NO_MEDIA_PRESENT': '',
+            'STOPPED': 'Play',
+            'TRANSITIONING': 'Stop',
+            'PLAYING': 'Pause,Stop,Seek',
+            'PAUSED_PLAYBACK': 'Play,Stop,Seek',
+        }.get(self.transport_state, '')
+
+        return {
+            'TransportState': self.transport_state,
+            'TransportStatus': 'OK',
+            'CurrentTransportActions': actions,
+            'AVTransportURI': self.uri,
+            'NextAVTransportURI': self.next_uri,
+        }
+
+    def _send_event(self, sid, variables):
+        with self.lock:
+            subscription = self.subscriptions.get(sid)
+            if subscription is None:
+                return
+            service_name, callback, seq = subscription
+            subscription[2] += 1
+
+        body = make_last_change_event(variables)
+
+        with self.events:
+            self.sent_events.append((time.monotonic(), sid, variables))
+
+        try:
+            requests.request('NOTIFY', callback, data=body.encode(), timeout=5, headers={
+                'Content-Type': 'text/xml; charset="utf-8"',
+                'NT': 'upnp:event',
+                'NTS': 'upnp:propchange',
+                'SID': sid,
+                'SEQ': str(seq),
+            })
+        except requests.RequestException as e:
+            LOGGER.info(f'Mock renderer failed sending event to {callback}: {e}')
+
+    def send_initial_event(self, sid):
+        with self.lock:
+            service_name = self.subscriptions.get(sid, [None])[0]
+            variables = self._avtransport_variables() if service_name == 'AVTransport' else {}
+
+        threading.Thread(target=self._send_event, args=[sid, variables], daemon=True).start()
+
+    def set_transport_state(self, transport_state):
+        with self.events:
+            self.transport_state = transport_state
+            self.events.notify_all()
+            self.clock.set_transport_state(transport_state)
+            variables = self._avtransport_variables()
+            sids = [sid for sid, (service_name, _, _) in self.subscriptions.items() if service_name == 'AVTransport']
+
+        for sid in sids:
+            self._send_event(sid, variables)
+
+    ###############
+    # Fetching media like TVs do
+    def _fetch(self, generation, url, start, size, step):
+        headers = {'Range': f'bytes={start}-{start + size - 1}'}
+
+        try:
+            with self.session.get(url, headers=headers, stream=True, timeout=10) as resp:
+                received = 0
+                for chunk in resp.iter_content(64 * 1024):
+                    if received == 0:
+                        self.mark(step)
+                    received += len(chunk)
+
+                    if generation != self.fetch_generation:
+                        return False
+
+            return True
+
+        except requests.RequestException as e:
+            LOGGER.info(f'Mock renderer failed fetching {url}: {e}')
+            return False
+
+    def _probe_uri(self, generation, url):
+        try:
+            self.session.head(url, timeout=10)
+            self.mark('head')
+        except requests.RequestException as e:
+            LOGGER.info(f'Mock renderer failed probing {url}: {e}')
+
+        self._fetch(generation, url, 0, self.probe_size, 'probe_first_byte')
+
+        if generation == self.fetch_generation:
+            self.set_transport_state('STOPPED')
+
+    def _stream(self, generation, start_seconds, step):
+        url = self.uri
+        start = 0
+
+        content_length = self._content_length(url)
+        if self.duration and content_length:
+            start = int(content_length * start_seconds / self.duration)
+
+        if self._fetch(generation, url, start, self.stream_size, step) and generation == self.fetch_generation:
+            self.set_transport_state('PLAYING')
+
+    def _content_length(self, url):
+        try:
+            return int(self.session.head(url, timeout=10).headers.get('Content-Length', 0))
+        except (requests.RequestException, ValueError):
+            return 0
+
+    def _start_fetch(self, target, *args):
+        with self.lock:
+            self.fetch_generation += 1
+            generation = self.fetch_generation
+
+        threading.Thread(target=target, args=[generation, *args], daemon=True).start()
+
+    ###############
+    # Actions
+    def handle_action(self, service_name, action_name, arguments):
+        self.mark(f'action_{action_name}')
+
+        if self.action_latency:
+            time.sleep(self.action_latency)
+
+        handler = getattr(self, f'action_{action_name}', None)
+        if handler is None:
+            raise ValueError(f'Unsupported action {action_name}')
+
+        return handler(**arguments) or {}
+
+    def action_SetAVTransportURI(self, CurrentURI, CurrentURIMetaData='', **kwargs):
+        with self.lock:
+            self.uri = CurrentURI
+            self.uri_metadata = CurrentURIMetaData
+            self.next_uri = self.next_uri_metadata = ''
+            self.duration = self._metadata_duration(CurrentURIMetaData)
+            self.clock.anchor(0)
+
+        self.set_transport_state('TRANSITIONING')
+        self._start_fetch(self._probe_uri, CurrentURI)
+
+    def action_SetNextAVTransportURI(self, NextURI, NextURIMetaData='', **kwargs):
+        if not self.supports_next_uri:
+            raise ValueError('SetNextAVTransportURI is not supported')
+
+        with self.lock:
+            self.next_uri = NextURI
+            self.next_uri_metadata = NextURIMetaData
+
+    def action_Play(self, **kwargs):
+        self.set_transport_state('TRANSITIONING')
+        self._start_fetch(self._stream, self.clock.position(), 'play_first_byte')
+
+    def action_Pause(self, **kwargs):
+        self.set_transport_state('PAUSED_PLAYBACK')
+
+    def action_Stop(self, **kwargs):
+        with self.lock:
+            self.fetch_generation += 1
+
+        if self.uri:
+            self.set_transport_state('STOPPED')
+
+    def action_Seek(self, Target, Unit='REL_TIME', **kwargs):
+        position = clock_to_seconds(Target)
+        self.clock.anchor(position)
+
+        self.set_transport_state('TRANSITIONING')
+        self._start_fetch(self._stream, position, 'seek_first_byte')
+
+    def action_GetPositionInfo(self, **kwargs):
+        return {
+            'Track': 1 if self.uri else 0,
+            'TrackDuration': seconds_to_clock(int(self.duration)),
+            'TrackMetaData': self.uri_metadata,
+            'TrackURI': self.uri,
+            'RelTime': seconds_to_clock(int(self.clock.position())),
+            'AbsTime': seconds_to_clock(int(self.clock.position())),
+        }
+
+    def action_GetTransportInfo(self, **kwargs):
+        return {'CurrentTransportState': self.transport_state, 'CurrentTransportStatus': 'OK', 'CurrentSpeed': '1'}
+
+    def action_GetVolume(self, **kwargs):
+        return {'CurrentVolume': self.volume}
+
+    def action_SetVolume(self, DesiredVolume, **kwargs):
+        self.volume = int(DesiredVolume)
+
+    def action_GetMute(self, **kwargs):
+        return {'CurrentMute': int(self.mute)}
+
+    def action_SetMute(self, DesiredMute, **kwargs):
+        self.mute = DesiredMute in ('1', 'true', 'True')
+
+    def action_GetProtocolInfo(self, **kwargs):
+        return {'Source': '', 'Sink': self.sink}
+
+    def finish_track(self):
+        ''' Simulate reaching the end of the media: move on to the next uri if one was set, otherwise stop '''
+
+        with self.lock:
+            next_uri, next_uri_metadata = self.next_uri, self.next_uri_metadata
+
+        if next_uri:
+            with self.lock:
+                self.next_uri = self.next_uri_metadata = ''
+            self.action_SetAVTransportURI(next_uri, next_uri_metadata)
+            self.wait_for(lambda: self.transport_state == 'STOPPED')
+            self.action_Play()
+        else:
+            self.action_Stop()
+
+    @staticmethod
+    def _metadata_duration(metadata):
+        m = re.search(r'duration="([\d:.]+)"', metadata or '')
+        return clock_to_seconds(m.group(1)) if m else 0
+
+    ###############
+    # Threads
+    def start(self, ssdp=True):
+        thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+        if ssdp:
+            try:
+                self.ssdp_socket = self._create_ssdp_socket()
+            except OSError as e:
+                LOGGER.warning(f'Mock renderer failed listening for SSDP searches: {e}')
+            else:
+                thread = threading.Thread(target=self._answer_ssdp_searches, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+        LOGGER.info(f'Mock renderer {self.friendly_name} ({self.udn}) at {self.location}')
+
+    def stop(self):
+        with self.lock:
+            self.fetch_generation += 1
+
+        self.http_server.shutdown()
+        self.http_server.server_close()
+        self.session.close()  # Release the media server's keep-alive connections
+
+        sock, self.ssdp_socket = self.ssdp_socket, None
+        if sock is not None:
+            sock.close()
+
+        self.threads = []
+
+
+######################################################################
+# Benchmark
+######################################################################
+
+def search_devices(ssdp_address, timeout=2, make_device=make_upnp_device):
+    ''' M-SEARCH a single (possibly unicast) SSDP address, a discover() for UPNPDeviceRegistry '''
+
+    locations = set()
+    request = ('M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nMAN: "ssdp:discover"\r\n'
+               'MX: 1\r\nST: urn:schemas-upnp-org:device:MediaRenderer:1\r\n\r\n').encode()
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(request, ssdp_address)
+
+        try:
+            data, address = sock.recvfrom(4096)
+            locations.add(parse_ssdp_message(data)[1].get('location'))
+        except socket.timeout:
+            pass
+
+    return [make_device(location, iface_ip=get_iface_ip(urllib.parse.urlsplit(location).hostname))
+            for location in locations if location]
+
+
+def _percentiles(samples):
+    if not samples:
+        return 'no samples'
+
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    return f'median {statistics.median(samples) * 1000:.1f}ms  p95 {p95 * 1000:.1f}ms  (n={len(samples)})'
+
+
+def benchmark(rounds=10, media_size=32 * 1024 * 1024, ip='127.0.0.1'):
+    '''
+    Measure casting through UPNPDeviceControl against a MockRenderer on localhost:
+        discovery  - SSDP NOTIFY alive until the UPNPDeviceRegistry has the device, and an M-SEARCH + description fetch
+        cast       - play_file() until the renderer gets the first byte of its streaming GET, and until the controller sees PLAYING
+        seek       - send_seek() until the first byte of the seeked GET, and seek_relative() (including its debounce)
+        event lag  - the renderer sending a NOTIFY until UPNPDeviceControl's listener gets it
+    '''
+
+    results = collections.defaultdict(list)
+
+    server = HTTPTorrentServer(server_address=(ip, 0))
+    server.start_threads()
+
+    renderer = MockRenderer(ip=ip, ssdp_address=(ip, 0))
+    renderer.ssdp_socket = renderer._create_ssdp_socket()
+    renderer.ssdp_address = renderer.ssdp_socket.getsockname()
+    threading.Thread(target=renderer._answer_ssdp_searches, daemon=True).start()
+    renderer.start(ssdp=False)
+
+    with tempfile.NamedTemporaryFile(suffix='.mp4') as media:
+        media.write(os.urandom(1024 * 1024) * (media_size // (1024 * 1024)))
+        media.flush()
+
+        # Discovery
+        for i in range(rounds):
+            registry = UPNPDeviceRegistry(ssdp_address=(ip, 0))
+            sock = registry._create_listen_socket()
+            address = sock.getsockname()
+
+            start = time.monotonic()
+            renderer.send_notify(address=address)
+            data, _ = sock.recvfrom(4096)
+            registry.handle_ssdp_message(data)
+            while registry.get_device(renderer.udn) is None and time.monotonic() - start < 10:
+                time.sleep(0.001)
+            results['discovery (NOTIFY)'].append(time.monotonic() - start)
+            sock.close()
+
+            start = time.monotonic()
+            devices = search_devices(renderer.ssdp_address)
+            results['discovery (M-SEARCH)'].append(time.monotonic() - start)
+
+        device = devices[0]
+        subscriptions = GENASubscriptionManager(server)
+        capabilities = RendererCapabilityCache(path=os.path.join(tempfile.gettempdir(), f'mock_capabilities_{os.getpid()}.json'))
+        controller = UPNPDeviceControl(server, device, subscriptions=subscriptions, capabilities=capabilities)
+
+        received_events = []
+        def record_event(data):
+            received_events.append(time.monotonic())
+        subscriptions.subscribe(device, 'AVTransport', record_event)
+
+        try:
+            for i in range(rounds):
+                # Cast
+                renderer.timings.clear()
+                start = time.monotonic()
+                controller.play_file(media.name)
+
+                renderer.wait_for(lambda: 'play_first_byte' in renderer.timings)
+                results['cast to first byte'].append(renderer.timings['play_first_byte'] - start)
+                if 'head' in renderer.timings:
+                    results['cast to renderer HEAD'].append(renderer.timings['head'] - start)
+
+                deadline = time.monotonic() + 10
+                while controller.cast_state != 'playing' and time.monotonic() < deadline:
+                    time.sleep(0.001)
+                results['cast to PLAYING event'].append(time.monotonic() - start)
+
+                # Seek
+                renderer.timings.pop('seek_first_byte', None)
+                start = time.monotonic()
+                controller.send_seek(60 + i)
+                renderer.wait_for(lambda: 'seek_first_byte' in renderer.timings)
+                results['seek to first byte'].append(renderer.timings['seek_first_byte'] - start)
+
+                renderer.wait_for(lambda: renderer.transport_state == 'PLAYING')
+                renderer.timings.pop('seek_first_byte', None)
+                start = time.monotonic()
+                for _ in range(5):
+                    controller.seek_relative(30)
+                renderer.wait_for(lambda: 'seek_first_byte' in renderer.timings)
+                results['5x seek_relative to first byte'].append(renderer.timings['seek_first_byte'] - start)
+                renderer.wait_for(lambda: renderer.transport_state == 'PLAYING')
+
+                # Event lag
+                received_events.clear()
+                sent = len(renderer.sent_events)
+                renderer.set_transport_state('PAUSED_PLAYBACK')
+                deadline = time.monotonic() + 5
+                while not received_events and time.monotonic() < deadline:
+                    time.sleep(0.0005)
+                if received_events:
+                    results['event lag'].append(received_events[0] - renderer.sent_events[sent][0])
+
+                controller.stop()
+
+        finally:
+            subscriptions.unsubscribe(device, 'AVTransport', record_event)
+            controller.close()
+            renderer.stop()
+            server.stop_threads()
+
+            if os.path.exists(capabilities.path):
+                os.unlink(capabilities.path)
+
+    for name, samples in results.items():
+        print(f'{name:32} {_percentiles(samples)}')
+
+    return results
+
+
+def benchmark_event_parsing(rounds=2000):
+    '''
+    Measure parsing a PLAYING AVTransport event (as sent by the renderer) with parse_AVTransport_event()'s ElementTree
+    parsing and with the BeautifulSoup parsing it falls back to for malformed XML
+    '''
+
+    import stream_utils
+
+    data = make_last_change_event({
+        'TransportState': 'PLAYING',
+        'TransportStatus': 'OK',
+        'CurrentTransportActions': 'Pause,Stop,Seek',
+        'RelativeTimePosition': '00:12:34',
+        'CurrentTrackDuration': '00:45:00',
+        'AVTransportURI': 'http://192.168.1.2:8000/File/1697000000.0_abcdefgh/video.mp4',
+        'NextAVTransportURI': '',
+    }).encode()
+
+    parsers = {
+        'ElementTree': parse_AVTransport_event,
+        'bs4': stream_utils._parse_AVTransport_event_bs4,
+    }
+
+    if parsers['ElementTree'](data) != parsers['bs4'](data):
+        raise AssertionError('The parsers disagree on the benchmarked event')
+
+    results = {}
+    for name, parser in parsers.items():
+        # Best of 5 repeats to skip scheduling noise
+        results[name] = min(timeit.repeat(lambda: parser(data), number=rounds, repeat=5)) / rounds
+        print(f'{name:12} {results[name] * 1e6:8.1f}us per event')
+
+    print(f'bs4 / ElementTree: {results["bs4"] / results["ElementTree"]:.1f}x')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ip', default=getattr(config, 'SERVER_IP', '') or '127.0.0.1', help='IP to serve the renderer on')
+    parser.add_argument('--name', default='Mock Renderer', help='Friendly name of the renderer')
+    parser.add_argument('--benchmark', action='store_true', help='Measure casting latencies on localhost and exit')
+    parser.add_argument('--benchmark-events', action='store_true', help='Compare AVTransport event parsing speeds and exit')
+    parser.add_argument('--rounds', type=int, default=10, help='Benchmark rounds')
+    args = parser.parse_args()
+
+    if args.benchmark_events:
+        benchmark_event_parsing()
+
+    elif args.benchmark:
+        logging.getLogger().setLevel(logging.WARNING)
+        benchmark(rounds=args.rounds, ip=args.ip)
+
+    else:
+        renderer = MockRenderer(ip=args.ip, friendly_name=args.name)
+        renderer.start()
+        renderer.send_notify()
+
+        try:
+            while True:
+                time.sleep(60)
+                renderer.send_notify()
+        except KeyboardInterrupt:
+            renderer.send_notify('ssdp:byebye')
+            renderer.stop()
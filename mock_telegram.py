@@ -0,0 +1,409 @@
+#!/usr/bin/python3
+'''
+A fake Telegram Bot API server to run the bot's update handling against without Telegram
+
+It answers the Bot API methods python-telegram-bot uses, queues synthetic user messages for getUpdates long-polling
+or POSTs them to a registered webhook, and records the bot's sent messages.
+Every request and response can be delayed by a one-way network latency
+
+    python3 mock_telegram.py --benchmark   # Compare the bot's reply latency when polling and with a webhook
+'''
+
+import json
+import time
+import email
+import random
+import asyncio
+import logging
+import argparse
+import functools
+import itertools
+import threading
+import statistics
+import collections
+import urllib.parse
+import concurrent.futures
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests  # python3 -m pip install requests
+from telegram.ext import Application, MessageHandler, filters
+
+from bot_utils import PerUserUpdateProcessor
+from stream_utils import TelegramWebhookHandler, TelegramWebhookServer
+
+
+LOGGER = logging.getLogger(__name__)
+
+MOCK_TOKEN = '123456:MOCK-TOKEN'
+
+
+######################################################################
+# Mock Bot API
+######################################################################
+
+class MockBotAPIHandler(BaseHTTPRequestHandler):
+    ''' Handles POST /bot{token}/{method} with form encoded or multipart (JSON valued) parameters, or JSON parameters '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, api, *args, **kwargs):
+        self.api = api
+        super().__init__(*args, **kwargs)
+
+    @staticmethod
+    def _parse_value(value):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+
+    def _read_params(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        content_type = self.headers.get('Content-Type', '')
+
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+
+        if content_type.startswith('multipart/form-data'):
+            message = email.message_from_bytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+            params = {}
+            for part in message.get_payload():
+                name = part.get_param('name', header='content-disposition')
+                payload = part.get_payload(decode=True)
+                params[name] = payload if part.get_filename() else self._parse_value(payload.decode('utf-8'))
+            return params
+
+        return {name: self._parse_value(values[0]) for name, values in urllib.parse.parse_qs(body.decode('utf-8')).items()}
+
+    def do_POST(self):
+        self.api.sleep_latency()
+
+        method = self.path.rstrip('/').rsplit('/', 1)[-1]
+        try:
+            response, code = {'ok': True, 'result': self.api.call(method, self._read_params())}, 200
+        except Exception as e:
+            LOGGER.exception(f'Mock Bot API failed handling {method}')
+            response, code = {'ok': False, 'error_code': 400, 'description': f'Bad Request: {e!r}'}, 400
+
+        response = json.dumps(response).encode('utf-8')
+        self.api.sleep_latency()
+
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockBotAPI(object):
+    '''
+    Bot API stand-in keeping the updates it was given and the messages the bot sent
+
+    Updates are delivered by getUpdates until setWebhook is called, then they're POSTed to the webhook
+    '''
+
+    BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Mock', 'username': 'mock_bot',
+                'can_join_groups': False, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+
+    def __init__(self, ip='127.0.0.1', port=0, latency=0, webhook_workers=4):
+        self.latency = latency
+
+        self.lock = threading.Condition()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.updates = collections.deque()
+        self.sent_at = {}        # update_id -> when it was given to the bot (polled or POSTed)
+        self.created_at = {}     # update_id -> when it was created
+        self.sent_messages = []  # (time, chat_id, text)
+        self.keyboards = {}      # chat_id -> button texts of the last reply keyboard sent to the chat
+
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.webhook_executor = concurrent.futures.ThreadPoolExecutor(max_workers=webhook_workers)
+        self.webhook_session = requests.Session()
+        self.webhook_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=webhook_workers))
+        self.webhook_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=webhook_workers))
+
+        self.server = ThreadingHTTPServer((ip, port), functools.partial(MockBotAPIHandler, self))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        ip, port = self.server.server_address[:2]
+        return f'http://{ip}:{port}/bot'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.webhook_executor.shutdown(wait=False)
+        self.webhook_session.close()
+
+    def sleep_latency(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    ##############################
+    # Synthetic updates
+    def create_message_update(self, user_id, text):
+        update_id = next(self.update_ids)
+        user = {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'}
+
+        return {
+            'update_id': update_id,
+            'message': {
+                'message_id': next(self.message_ids),
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private', 'first_name': user['first_name']},
+                'from': user,
+                'text': text,
+            },
+        }
+
+    def send_message(self, user_id, text):
+        ''' A user sends the bot text, returns the update id '''
+
+        update = self.create_message_update(user_id, text)
+        update_id = update['update_id']
+
+        with self.lock:
+            self.created_at[update_id] = time.monotonic()
+
+            if self.webhook_url is None:
+                self.updates.append(update)
+                self.lock.notify_all()
+                return update_id
+
+        self.webhook_executor.submit(self._post_webhook, update)
+        return update_id
+
+    def _post_webhook(self, update):
+        self.sleep_latency()
+
+        with self.lock:
+            self.sent_at[update['update_id']] = time.monotonic()
+
+        try:
+            self.webhook_session.post(self.webhook_url, json=update, timeout=10, verify=False,
+                                      headers={TelegramWebhookHandler.SECRET_TOKEN_HEADER: self.webhook_secret or ''})
+        except Exception:
+            LOGGER.exception(f'Failed POSTing update {update["update_id"]} to {self.webhook_url}')
+
+    def wait_for_messages(self, count, timeout=30):
+        ''' Wait until the bot sent count messages in total '''
+
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while len(self.sent_messages) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+        return True
+
+    ##############################
+    # Bot API methods
+    def call(self, method, params):
+        handler = getattr(self, f'api_{method}', None)
+        if handler is None:
+            return True
+
+        return handler(params)
+
+    def api_getMe(self, params):
+        return self.BOT_USER
+
+    def api_deleteWebhook(self, params):
+        with self.lock:
+            self.webhook_url = self.webhook_secret = None
+        return True
+
+    def api_setWebhook(self, params):
+        with self.lock:
+            self.webhook_url = params['url']
+            self.webhook_secret = params.get('secret_token')
+        return True
+
+    def api_getUpdates(self, params):
+        offset = params.get('offset') or 0
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+
+        with self.lock:
+            while self.updates and self.updates[0]['update_id'] < offset:
+                self.updates.popleft()
+
+            while not self.updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self.lock.wait(remaining)
+
+            updates = list(self.updates)
+            now = time.monotonic()
+            for update in updates:
+                self.sent_at.setdefault(update['update_id'], now)
+
+            return updates
+
+    def api_sendMessage(self, params):
+        chat_id = params['chat_id']
+
+        with self.lock:
+            self.sent_messages.append((time.monotonic(), chat_id, str(params.get('text', ''))))
+
+            reply_markup = params.get('reply_markup')
+            if isinstance(reply_markup, dict):
+                if 'keyboard' in reply_markup:
+                    self.keyboards[chat_id] = [button['text'] if isinstance(button, dict) else button
+                                               for row in reply_markup['keyboard'] for button in row]
+                elif reply_markup.get('remove_keyboard'):
+                    self.keyboards.pop(chat_id, None)
+
+            self.lock.notify_all()
+
+        return {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': self.BOT_USER,
+            'text': str(params.get('text', '')),
+        }
+
+    api_editMessageText = api_sendMessage
+
+
+######################################################################
+# Benchmark
+######################################################################
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return 'no samples'
+
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    return f'p50 {statistics.median(samples) * 1000:7.1f}ms  p95 {p95 * 1000:7.1f}ms  max {samples[-1] * 1000:7.1f}ms  (n={len(samples)})'
+
+
+async def _echo(update, context):
+    await update.message.reply_text(f'update {update.update_id}')
+
+
+def create_echo_application(api):
+    application = Application.builder().token(MOCK_TOKEN).base_url(api.base_url) \
+        .concurrent_updates(PerUserUpdateProcessor()).build()
+    application.add_handler(MessageHandler(filters.ALL, _echo))
+    return application
+
+
+async def _run_workload(api, users, messages_per_user, interval):
+    '''
+    Every user sends messages_per_user messages, a new message (from a random user) every interval seconds
+    on average, returns update id -> seconds from the user sending it until the bot's reply arrived
+    '''
+
+    sent = len(api.sent_messages)
+    senders = [user_id for user_id in range(1000, 1000 + users) for _ in range(messages_per_user)]
+    random.shuffle(senders)
+
+    for user_id in senders:
+        await asyncio.to_thread(api.send_message, user_id, 'ping')
+        if interval:
+            await asyncio.sleep(random.expovariate(1 / interval))
+
+    await asyncio.to_thread(api.wait_for_messages, sent + len(senders))
+
+    latencies = {}
+    for at, chat_id, text in api.sent_messages[sent:]:
+        update_id = int(text.split()[-1])
+        latencies[update_id] = at - api.created_at[update_id]
+    return latencies
+
+
+async def benchmark_polling(api, **workload):
+    application = create_echo_application(api)
+
+    async with application:
+        await application.updater.start_polling(poll_interval=0, timeout=10)
+        await application.start()
+        try:
+            return await _run_workload(api, **workload)
+        finally:
+            await application.updater.stop()
+            await application.stop()
+
+
+async def benchmark_webhook(api, ip='127.0.0.1', **workload):
+    application = create_echo_application(api)
+    server = TelegramWebhookServer(application, server_address=(ip, 0), cert=None, key=None)
+    task = asyncio.create_task(server.run(webhook_url=f'http://{ip}:{server.server_address[1]}'))
+
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    try:
+        return await _run_workload(api, **workload)
+    finally:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+        with api.lock:
+            api.webhook_url = None
+
+
+def benchmark(latency=0.05, users=20, messages_per_user=10, interval=0.02, ip='127.0.0.1'):
+    '''
+    Measure how long the bot takes to answer synthetic messages when polling versus with a webhook,
+    against a MockBotAPI with latency seconds of one-way network delay
+        steady - messages arriving interval seconds apart on average
+        burst  - all messages at once
+    '''
+
+    results = {}
+    for workload_name, workload_interval in (('steady', interval), ('burst', 0)):
+        for mode, run in (('polling', benchmark_polling), ('webhook', benchmark_webhook)):
+            api = MockBotAPI(ip=ip, latency=latency)
+            api.start()
+
+            try:
+                start = time.monotonic()
+                latencies = asyncio.run(run(api, users=users, messages_per_user=messages_per_user,
+                                            interval=workload_interval))
+                elapsed = time.monotonic() - start
+            finally:
+                api.stop()
+
+            results[(workload_name, mode)] = latencies
+            print(f'{workload_name:6} {mode:7} {_percentiles(list(latencies.values()))}  total {elapsed:.2f}s')
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ip', default='127.0.0.1', help='IP to serve the mock API and webhook on')
+    parser.add_argument('--latency', type=float, default=0.05, help='One-way network latency to simulate, in seconds')
+    parser.add_argument('--users', type=int, default=20, help='Benchmark users')
+    parser.add_argument('--messages', type=int, default=10, help='Benchmark messages per user')
+    parser.add_argument('--benchmark', action='store_true', help='Compare polling and webhook update latency and exit')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        logging.getLogger().setLevel(logging.WARNING)
+        benchmark(latency=args.latency, users=args.users, messages_per_user=args.messages, ip=args.ip)
+
+    else:
+        parser.print_help()
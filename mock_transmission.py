@@ -0,0 +1,211 @@
+'''
+A fake Transmission daemon to run the bot's torrent commands against without Transmission
+
+MockTransmission is a transmissionrpc HTTP handler which answers the RPC methods the bot uses from torrents
+kept in memory, so the real transmissionrpc.Client (and its tracing) is used. Every RPC can be delayed
+by a latency, like a busy daemon or one on another host, and single methods by their own latency
+
+    client = transmission_utils.create_transmission_rpc(http_handler=MockTransmission(latency=0.02))
+'''
+
+import json
+import time
+import random
+import hashlib
+import shutil
+import logging
+import tempfile
+import threading
+import collections
+import urllib.parse
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+######################################################################
+# Mock Transmission
+######################################################################
+
+class MockTransmission(object):
+    '''
+    In memory Transmission answering session-get, session-stats, free-space and the torrent-* methods
+
+    Starts with torrents torrents of files_per_torrent files each in download_dir, the files aren't created on disk.
+    method_latencies (method -> seconds) overrides latency for some methods. self.requests counts the RPCs by method
+    '''
+
+    VERSION = '3.00 (bb6b5a062e)'
+    RPC_VERSION = 16
+
+    # Status codes of rpc-version >= 14
+    STATUS_STOPPED = 0
+    STATUS_DOWNLOADING = 4
+    STATUS_SEEDING = 6
+
+    def __init__(self, download_dir=tempfile.gettempdir(), torrents=10, files_per_torrent=5,
+                 file_size=700 * 1024 * 1024, latency=0, method_latencies=None, seed=0):
+        self.download_dir = download_dir
+        self.files_per_torrent = files_per_torrent
+        self.file_size = file_size
+        self.latency = latency
+        self.method_latencies = method_latencies or {}
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.torrents = {}  # id -> torrent-get fields
+        self.requests = collections.Counter()  # method -> count
+
+        for i in range(torrents):
+            self.add_torrent(f'Mock Show S01E{i + 1:02d} 1080p')
+
+    ##############################
+    # transmissionrpc HTTP handler interface
+    def set_authentication(self, uri, login, password):
+        pass
+
+    def request(self, url, query, headers, timeout):
+        query = json.loads(query)
+        method = query.get('method', '')
+        arguments = query.get('arguments', {})
+
+        latency = self.method_latencies.get(method, self.latency)
+        if latency:
+            time.sleep(latency)
+
+        handler = getattr(self, 'rpc_' + method.replace('-', '_'), None)
+        if handler is None:
+            LOGGER.warning(f'Mock Transmission got unsupported method {method}')
+            return json.dumps({'result': 'method name not recognized', 'arguments': {}, 'tag': query.get('tag')})
+
+        with self.lock:
+            self.requests[method] += 1
+            return json.dumps({'result': 'success', 'arguments': handler(arguments), 'tag': query.get('tag')})
+
+    ##############################
+    # Torrents
+    def add_torrent(self, name, download_dir=None):
+        torrent_id = self.next_id
+        self.next_id += 1
+
+        progress = self.random.choice([0, 0.1, 0.5, 0.9, 1])
+        files = []
+        for i in range(self.files_per_torrent):
+            length = self.random.randint(self.file_size // 2, self.file_size)
+            files.append({'name': f'{name}/{name} part {i + 1}.mkv', 'length': length,
+                          'bytesCompleted': int(length * progress)})
+
+        total_size = sum(f['length'] for f in files)
+        self.torrents[torrent_id] = {
+            'id': torrent_id,
+            'name': name,
+            'hashString': hashlib.sha1(name.encode()).hexdigest(),
+            'status': self.STATUS_SEEDING if progress == 1 else self.STATUS_DOWNLOADING,
+            'downloadDir': download_dir or self.download_dir,
+            'addedDate': int(time.time()),
+            'files': files,
+            'fileStats': [{'bytesCompleted': f['bytesCompleted'], 'wanted': True, 'priority': 0} for f in files],
+            'priorities': [0] * len(files),
+            'wanted': [1] * len(files),
+            'totalSize': total_size,
+            'sizeWhenDone': total_size,
+            'leftUntilDone': total_size - sum(f['bytesCompleted'] for f in files),
+            'percentDone': progress,
+            'rateDownload': 0,
+            'rateUpload': 0,
+            'eta': -1,
+            'uploadRatio': 0,
+            'error': 0,
+            'errorString': '',
+            'peersConnected': 0,
+            'queuePosition': torrent_id,
+        }
+
+        return self.torrents[torrent_id]
+
+    def _select(self, ids):
+        if ids is None or ids == []:
+            return list(self.torrents.values())
+
+        if not isinstance(ids, list):
+            ids = [ids]
+
+        return [torrent for torrent in self.torrents.values() if torrent['id'] in ids or torrent['hashString'] in ids]
+
+    def _set_status(self, arguments, stopped):
+        for torrent in self._select(arguments.get('ids')):
+            if stopped:
+                torrent['status'] = self.STATUS_STOPPED
+            else:
+                torrent['status'] = self.STATUS_SEEDING if torrent['leftUntilDone'] == 0 else self.STATUS_DOWNLOADING
+        return {}
+
+    ##############################
+    # RPC methods
+    def rpc_session_get(self, arguments):
+        return {'version': self.VERSION, 'rpc-version': self.RPC_VERSION, 'rpc-version-minimum': 1,
+                'download-dir': self.download_dir}
+
+    def rpc_session_stats(self, arguments):
+        return {'torrentCount': len(self.torrents), 'activeTorrentCount': len(self.torrents),
+                'pausedTorrentCount': 0, 'downloadSpeed': 0, 'uploadSpeed': 0}
+
+    def rpc_free_space(self, arguments):
+        path = arguments.get('path', self.download_dir)
+        return {'path': path, 'size-bytes': shutil.disk_usage(self.download_dir).free}
+
+    def rpc_torrent_get(self, arguments):
+        fields = set(arguments.get('fields') or ()) | {'id'}
+        return {'torrents': [{key: value for key, value in torrent.items() if key in fields}
+                             for torrent in self._select(arguments.get('ids'))]}
+
+    def rpc_torrent_add(self, arguments):
+        filename = arguments.get('filename', '')
+
+        try:
+            name = urllib.parse.parse_qs(urllib.parse.urlsplit(filename).query)['dn'][0]
+        except (KeyError, IndexError):
+            name = hashlib.sha1(filename.encode()).hexdigest()
+
+        for torrent in self.torrents.values():
+            if torrent['name'] == name:
+                return {'torrent-duplicate': {key: torrent[key] for key in ('id', 'name', 'hashString')}}
+
+        torrent = self.add_torrent(name, download_dir=arguments.get('download-dir'))
+        return {'torrent-added': {key: torrent[key] for key in ('id', 'name', 'hashString')}}
+
+    def rpc_torrent_remove(self, arguments):
+        for torrent in self._select(arguments.get('ids')):
+            del self.torrents[torrent['id']]
+        return {}
+
+    def rpc_torrent_set(self, arguments):
+        for torrent in self._select(arguments.get('ids')):
+            for file_id in arguments.get('files-wanted', []):
+                torrent['wanted'][file_id] = 1
+            for file_id in arguments.get('files-unwanted', []):
+                torrent['wanted'][file_id] = 0
+
+            for priority, value in (('priority-low', -1), ('priority-normal', 0), ('priority-high', 1)):
+                for file_id in arguments.get(priority, []):
+                    torrent['priorities'][file_id] = value
+
+            for file_stats, wanted, priority in zip(torrent['fileStats'], torrent['wanted'], torrent['priorities']):
+                file_stats['wanted'] = bool(wanted)
+                file_stats['priority'] = priority
+
+        return {}
+
+    def rpc_torrent_start(self, arguments):
+        return self._set_status(arguments, stopped=False)
+
+    rpc_torrent_start_now = rpc_torrent_start
+
+    def rpc_torrent_stop(self, arguments):
+        return self._set_status(arguments, stopped=True)
+
+    def rpc_torrent_verify(self, arguments):
+        return {}
+
+    rpc_torrent_reannounce = rpc_torrent_verify
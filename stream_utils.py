@@ -1,24 +1,90 @@
 import os
 import re
 import json
+import logging
+import ssl
+import hmac
 import time
+import signal
+import asyncio
+import secrets
+import contextvars
+import collections
+import dataclasses
+import shlex
+import struct
+import socket
+import hashlib
+import sqlite3
 import threading
 import functools
+import subprocess
+import urllib.parse
+import concurrent.futures
+from pathlib import Path
+import xml.etree.ElementTree as ElementTree
+from xml.sax.saxutils import escape as xml_escape, quoteattr as xml_quoteattr
 from http.server import HTTPServer, BaseHTTPRequestHandler
 
-import bs4  # python3 -m pip install beautifulsoup4
-import requests  # python3 -m pip install requests
 # import magic  # python3 -m pip install python-magic
 import mimetypes
-from dlna_cast.ssdp import discover as upnp_discover, \
-                            Device as UPNPDevice  # python3 -m pip install dlna-cast
 
-from bot_utils import *
+import cachetools  # python3 -m pip install cachetools
+from telegram import Update
+from telegram.ext import ConversationHandler
+
+import config
+import transmission_utils
+from tracing import TRACER
+from lazy_import import lazy_import
+from bot_utils import (
+    UNINITIALIZED,
+    UninitializedClass,
+    TorrentMenu,
+    call_callback,
+    execute_shell,
+    get_chat_id,
+    get_text,
+    get_userid,
+    iter_torrent_files,
+    multi_reply,
+    random_identifier,
+    reply,
+    repr_action,
+)
+
+# Only needed once something is casted or fetched, imported on first use
+bs4 = lazy_import('bs4')  # python3 -m pip install beautifulsoup4
+requests = lazy_import('requests')  # python3 -m pip install requests
+dlna_cast_ssdp = lazy_import('dlna_cast.ssdp')  # python3 -m pip install dlna-cast
+upnpclient_marshal = lazy_import('upnpclient.marshal')  # Installed by dlna-cast
+upnpclient_upnp = lazy_import('upnpclient.upnp')  # Installed by dlna-cast
+
+
+__all__ = [
+    'upnp_discover', 'make_upnp_device', 'clock_to_seconds', 'seconds_to_clock', 'make_href', 'LiveTranscode',
+    'LiveTranscoder', 'MediaRequestStats', 'TracedHTTPRequestHandler', 'ThreadedHTTPServer',
+    'HTTPTorrentServerHandler', 'HTTPTorrentServer', 'TelegramWebhookHandler', 'TelegramWebhookServer',
+    'iter_mp4_atoms', 'needs_faststart', 'faststart_mp4', 'SUBTITLE_MIMETYPES',
+    'MediaProbe', 'probe_media', 'warm_file', 'find_subtitle_sidecars', 'fingerprint_file',
+    'ConvertionCatalog', 'FileConverter', 'FileConvertionMenu', 'get_iface_ip', 'parse_ssdp_message',
+    'UPNPDeviceRegistry', 'iter_UPNP_devices', 'AVTRANSPORT_EVENT_VARIABLES', 'AVTransportEvent',
+    'parse_AVTransport_event', 'DIDL_LITE_TEMPLATE', 'make_DIDL_lite', 'PlaybackClock',
+    'RendererCapabilities', 'RendererCapabilityCache', 'GENASubscription', 'GENASubscriptionManager',
+    'CastItem', 'UPNPDeviceControl', 'CastSession', 'CastSessionRegistry', 'UPNPTorrentCastMenu',
+]
 
 
 LOGGER = logging.getLogger(__name__)
 
 
+def upnp_discover(*args, **kwargs):
+    return dlna_cast_ssdp.discover(*args, **kwargs)
+
+def make_upnp_device(*args, **kwargs):
+    return dlna_cast_ssdp.Device(*args, **kwargs)
+
+
 ######################################################################
 # Misc
 ######################################################################
@@ -51,23 +117,305 @@ def make_href(*subdirs):
 
     return f'{subdirs_str}'
 
+##############################
+# Live transcoding
+class LiveTranscode(object):
+    ''' A running ffmpeg process writing to a pipe, closing it kills ffmpeg '''
+
+    def __init__(self, process, chunk_size, on_close=None, input_path=None):
+        self.process = process
+        self.chunk_size = chunk_size
+        self.on_close = on_close
+        self.input_path = input_path
+        self.closed = False
+        self.started = time.time()
+        self.started_perf = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            data = self.process.stdout.read1(self.chunk_size)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        try:
+            self.process.kill()
+            self.process.wait()
+            self.process.stdout.close()
+        finally:
+            TRACER.record('ffmpeg live transcode', 'ffmpeg', self.started, time.perf_counter() - self.started_perf,
+                          input=os.path.basename(self.input_path or ''))
+
+            if self.on_close is not None:
+                self.on_close()
+
+
+class LiveTranscoder(object):
+    '''
+    Transcode files on the fly with ffmpeg writing to a pipe instead of converting them to disk first
+
+    The number of concurrent ffmpeg processes is capped by max_transcodes
+    '''
+
+    CODEC_SWITCHES = '-map 0:v:0 -map 0:a:0? -vcodec libx264 -preset veryfast -pix_fmt yuv420p -profile:v baseline -acodec aac'
+
+    FORMAT_SWITCHES = {
+        'mp4': '-f mp4 -movflags frag_keyframe+empty_moov+default_base_moof',
+        'mpegts': '-f mpegts',
+    }
+
+    CONTENT_TYPES = {
+        'mp4': 'video/mp4',
+        'mpegts': 'video/mp2t',
+    }
+
+    def __init__(self, ffmpeg_path=getattr(config, 'FFMPEG_PATH', 'ffmpeg'),
+                 max_transcodes=getattr(config, 'MAX_TRANSCODES', 2),
+                 output_format=getattr(config, 'TRANSCODE_FORMAT', 'mp4'),
+                 codec_switches=CODEC_SWITCHES,
+                 chunk_size=64 * 1024):
+        self.ffmpeg_path = ffmpeg_path
+        self.output_format = output_format
+        self.codec_switches = codec_switches
+        self.chunk_size = chunk_size
+        self.slots = threading.BoundedSemaphore(max_transcodes)
+
+    @property
+    def content_type(self):
+        return self.CONTENT_TYPES[self.output_format]
+
+    def make_command(self, input_path, start_seconds=0):
+        cmd = [self.ffmpeg_path, '-nostdin', '-loglevel', 'error']
+
+        if start_seconds:
+            cmd += ['-ss', str(start_seconds)]
+
+        cmd += ['-i', input_path]
+        cmd += shlex.split(self.codec_switches)
+        cmd += shlex.split(self.FORMAT_SWITCHES[self.output_format])
+        cmd += ['pipe:1']
+        return cmd
+
+    def transcode(self, input_path, start_seconds=0):
+        ''' Start ffmpeg and return a LiveTranscode, None if too many transcodes are running '''
+
+        if not self.slots.acquire(blocking=False):
+            LOGGER.warning(f'Too many live transcodes, refusing {input_path}')
+            return
+
+        cmd = self.make_command(input_path, start_seconds=start_seconds)
+        LOGGER.info(f'Starting live transcode: {cmd}')
+
+        try:
+            process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError:
+            LOGGER.exception(f'Failed starting live transcode of {input_path}')
+            self.slots.release()
+            return
+
+        return LiveTranscode(process, self.chunk_size, on_close=self.slots.release, input_path=input_path)
+
+
+##############################
+# Casted media request statistics
+class MediaRequestStats(object):
+    '''
+    Measure how renderers fetch casted media: time from SetAVTransportURI to the first GET,
+    and how many requests were made until playback started
+
+    Only hrefs passed to start() are recorded
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def start(self, href):
+        with self.lock:
+            self.stats[href] = {'start': time.monotonic(), 'first_get': None, 'requests': []}
+
+    def record(self, href, method, range_header=None):
+        with self.lock:
+            stats = self.stats.get(href)
+            if stats is None:
+                return
+
+            elapsed = time.monotonic() - stats['start']
+            stats['requests'].append((round(elapsed, 3), method, range_header))
+
+            if method == 'GET' and stats['first_get'] is None:
+                stats['first_get'] = elapsed
+
+    def stop(self, href):
+        ''' Stop recording and return the stats of the href, None if it wasn't recorded '''
+
+        with self.lock:
+            return self.stats.pop(href, None)
+
+
+##############################
+# HTTP base classes
+class TracedHTTPRequestHandler(BaseHTTPRequestHandler):
+    ''' Request handler recording every request it handles as an 'http' span '''
+
+    def parse_request(self):
+        # Start timing once the request line arrived, not while idling on a keep-alive connection
+        self.request_started = time.time()
+        self.request_started_perf = time.perf_counter()
+        self.response_code = None
+        return super().parse_request()
+
+    def send_response(self, code, message=None):
+        self.response_code = code
+        super().send_response(code, message)
+
+    def handle_one_request(self):
+        self.request_started = None
+        error = None
+        try:
+            super().handle_one_request()
+        except Exception as e:
+            error = repr(e)[:200]
+            raise
+        finally:
+            if self.request_started is not None and getattr(self, 'command', None):
+                TRACER.record(f'HTTP {self.command}', 'http', self.request_started,
+                              time.perf_counter() - self.request_started_perf, error=error,
+                              path=self.path, status=self.response_code)
+
+
+class ThreadedHTTPServer(HTTPServer):
+    '''
+    HTTP server handling requests in num_threads threads which all wait on handle_request()
+
+    Given an ssl.SSLContext it terminates TLS itself, the handshake runs in the thread which accepted the connection
+    and is bounded by self.timeout, which stays the connection's timeout afterwards
+    '''
+
+    def __init__(self, *args, num_threads=10, ssl_context=None, **kwargs):
+        self.should_run = self.started = False
+        self.threads = []
+        self.num_threads = num_threads
+        self.ssl_context = ssl_context
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def get_request(self):
+        sock, address = super().get_request()
+
+        if self.ssl_context is not None:
+            # Don't let a client which never finishes its handshake hold a thread
+            sock.settimeout(self.timeout)
+            try:
+                sock = self.ssl_context.wrap_socket(sock, server_side=True)
+            except:
+                sock.close()
+                raise
+
+        return sock, address
+
+    def finish_request(self, request, client_address):
+        with self.connections_lock:
+            self.connections.add(request)
+
+        try:
+            super().finish_request(request, client_address)
+        finally:
+            with self.connections_lock:
+                self.connections.discard(request)
+
+    def close_connections(self):
+        ''' Wake threads blocked on open (e.g. idle keep-alive) connections by shutting them down '''
+
+        with self.connections_lock:
+            connections = list(self.connections)
+
+        for sock in connections:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def start_threads(self):
+        if self.started:
+            return
+        LOGGER.info(f"STARTING {self.__class__.__name__} threads")
+
+        self.started = self.should_run = True
+        for i in range(self.num_threads):
+            thread = threading.Thread(target=self._serve_while_should_run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop_threads(self):
+        self.should_run = False
+        LOGGER.info(f"STOPPING {self.__class__.__name__} threads")
+        
+        self.close_connections()
+
+        ip, port = self.server_address[:2]
+        if ip in ('', None, '0.0.0.0'):
+            ip = '127.0.0.1'
+        
+        # Trigger requests for awaiting self.handle_request() calls, each one wakes a thread even if it fails.
+        # Stop once they all exited, later requests would only wait in the listen backlog until timing out
+        for i in range(2 * self.num_threads + 2):
+            if not any(thread.is_alive() for thread in self.threads):
+                break
+
+            try:
+                requests.get(f'http://{ip}:{port}/', timeout=4)
+            except:
+                pass
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+        self.started = False
+
+    def _serve_while_should_run(self):
+        while self.should_run:
+            self.handle_request()
+
+
 ##############################
 # HTTP Handler
-class HTTPTorrentServerHandler(BaseHTTPRequestHandler):
+class HTTPTorrentServerHandler(TracedHTTPRequestHandler):
     '''
     HTTP torrent server handler which serves torrent files accessed by /TorrentFile/{torrent_id}/{file_id}
+    and transcodes them on the fly when accessed by /Transcode/{torrent_id}/{file_id}
 
     It also has registries for other mapped files and NOTIFY callbacks
 
     It supports the "Content-Range" HTTP header
+
+    Files which are still being written (registered as growing files) are served without a Content-Length since
+    their final size is unknown, waiting for bytes which weren't written yet
     '''
 
     HREF_AVTRANSPORT = 'AVTransport'
     HREF_FILE = 'File'
     HREF_TORRENT = 'TorrentFile'
+    HREF_TRANSCODE = 'Transcode'
 
     regex_torrent_file = re.compile(fr'^/*{HREF_TORRENT}\/(\d+)(?:/(\d+)/)?.*?')  # http://host/TorrentFile/1/0/ for torrent id 1 file id 0
+    regex_transcode = re.compile(fr'^/*{HREF_TRANSCODE}\/(\d+)/(\d+)')  # http://host/Transcode/1/0/ for torrent id 1 file id 0
     regex_header_range = re.compile(r'^(\d+)-(\d+)?$')
+    regex_header_time_seek = re.compile(r'^npt=([\d:.]+)-')
 
     protocol_version = 'HTTP/1.1'
 
@@ -75,9 +423,20 @@ class HTTPTorrentServerHandler(BaseHTTPRequestHandler):
         'video/x-matroska': 'video/webm'
     }
 
-    def __init__(self, NOTIFY_callbacks, file_mappings, *args, **kwargs):
+    # Also used as the 4th field of DIDL-Lite res@protocolInfo, renderers expect both to match
+    CONTENT_FEATURES = 'DLNA.ORG_OP=01;DLNA.ORG_FLAGS=01700000000000000000000000000000'
+    TRANSCODE_CONTENT_FEATURES = 'DLNA.ORG_OP=10;DLNA.ORG_CI=1;DLNA.ORG_FLAGS=01700000000000000000000000000000'
+
+    GROWING_FILE_POLL_INTERVAL = 0.5
+    GROWING_FILE_STALL_TIMEOUT = 60
+    GROWING_FILE_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, NOTIFY_callbacks, file_mappings, growing_files, live_transcoder, media_requests, *args, **kwargs):
         self.NOTIFY_callbacks = NOTIFY_callbacks
         self.file_mappings = file_mappings
+        self.growing_files = growing_files
+        self.live_transcoder = live_transcoder
+        self.media_requests = media_requests
         super().__init__(*args, **kwargs)
 
     def _get_content_range_numbers(self):
@@ -127,6 +486,109 @@ class HTTPTorrentServerHandler(BaseHTTPRequestHandler):
             f.seek(start)
             self.wfile.write(f.read(size))
 
+    def _get_growing_file_size(self, fp):
+        ''' Size written so far of a file which is still being written, None if it's complete '''
+
+        size_cb = self.growing_files.get(fp)
+        if size_cb is None:
+            return
+
+        return size_cb()
+
+    def _get_file_size(self, fp):
+        size = self._get_growing_file_size(fp)
+
+        if size is None:
+            size = os.path.getsize(fp)
+
+        return size
+
+    def _wait_for_growing_file(self, fp, size):
+        ''' Wait until more than size bytes of a growing file are written, returns False if the writer stalled or finished first '''
+
+        last_progress = time.time()
+        while True:
+            growing = self._get_growing_file_size(fp) is not None
+
+            try:
+                if os.path.getsize(fp) > size:
+                    return True
+            except OSError:
+                pass
+
+            if not growing or time.time() - last_progress > self.GROWING_FILE_STALL_TIMEOUT:
+                return False
+
+            time.sleep(self.GROWING_FILE_POLL_INTERVAL)
+
+    def _serve_growing_file_part(self, fp, start):
+        ''' Serve a file which is still being written from start, waiting for bytes until the writer finishes '''
+
+        if not self._wait_for_growing_file(fp, start):
+            return
+
+        with open(fp, 'rb') as f:
+            f.seek(start)
+
+            last_progress = time.time()
+            while True:
+                # Check before reading so no bytes are missed if the writer finishes in between
+                growing = self._get_growing_file_size(fp) is not None
+
+                data = f.read(self.GROWING_FILE_CHUNK_SIZE)
+                if data:
+                    self.wfile.write(data)
+                    last_progress = time.time()
+                    continue
+
+                if not growing:
+                    return
+
+                if time.time() - last_progress > self.GROWING_FILE_STALL_TIMEOUT:
+                    LOGGER.warning(f'Stopped waiting for growing file {fp}')
+                    return
+
+                time.sleep(self.GROWING_FILE_POLL_INTERVAL)
+
+    def _serve_growing_file(self, fp, head=False):
+        '''
+        Serve a file which is still being written without claiming its unknown final size
+
+        Requests from the start stream it until the writer finishes and close the connection,
+        seeks (ranges not starting at 0) get the part already written with an unknown complete length
+        '''
+
+        fn = os.path.basename(fp)
+        content_type = self.guess_mimetype(fp)
+
+        content_range = self._get_content_range_numbers()
+        if content_range is not None and content_range[0] > 0:
+            start, end = content_range
+
+            if not head:
+                self._wait_for_growing_file(fp, start)
+
+            written = os.path.getsize(fp) if os.path.exists(fp) else 0
+            if start >= written:
+                self._send_default_headers(fn, 0, content_type=content_type, status_code=416)
+                return
+
+            end = written - 1 if end is None else min(end, written - 1)
+
+            LOGGER.info(f'GET GROWING FILE {content_type} {fp} CONTENT RANGE: {start} {end}')
+            self._send_default_headers(fn, None, content_type=content_type, content_range=(start, end))
+            if not head:
+                self._serve_file_part(fp, start, end + 1 - start)
+            return
+
+        LOGGER.info(f'GET GROWING FILE {content_type} {fp}')
+
+        # Ranges from 0 are answered with the whole file, which ends when the connection closes
+        self.close_connection = True
+        self._send_default_headers(fn, None, content_type=content_type, connection='close')
+        if not head:
+            self._serve_growing_file_part(fp, 0)
+
     def _url_to_torrent_file_id(self):
         ''' Extract (torrent_id,file_id) from the url '''
 
@@ -142,7 +604,12 @@ class HTTPTorrentServerHandler(BaseHTTPRequestHandler):
 
         return torrent_id, file_id
 
-    def guess_mimetype(self, filepath, use_data=False):
+    @classmethod
+    def guess_mimetype(cls, filepath, use_data=False):
+        ext = os.path.splitext(filepath)[1].lower()
+        if ext in SUBTITLE_MIMETYPES:
+            return SUBTITLE_MIMETYPES[ext]
+
         if use_data:
             import magic
             with open(filepath, 'rb') as f:
@@ -152,7 +619,7 @@ class HTTPTorrentServerHandler(BaseHTTPRequestHandler):
             fn = os.path.basename(filepath)
             guessed = mimetypes.guess_type(fn)[0]
 
-        return self.OVERRIDE_MIMETYPES.get(guessed, guessed)
+        return cls.OVERRIDE_MIMETYPES.get(guessed, guessed)
 
     def _url_to_torrent_fileinfo(self):
         ''' Extract (torrent_id,file_id) from the url and get file information '''
@@ -178,7 +645,7 @@ class HTTPTorrentServerHandler(BaseHTTPRequestHandler):
         if not fp:
             return
         
-        size = os.path.getsize(fp)
+        size = self._get_file_size(fp)
         content_type = self.guess_mimetype(fp)
         return fp, size, content_type
 
@@ -195,15 +662,16 @@ class HTTPTorrentServerHandler(BaseHTTPRequestHandler):
 
         self.send_header("Content-Type", content_type)
 
+        # No Content-Length for an unknown size (None), the body ends when the connection closes
         if content_range:
             start, end = content_range
-            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.send_header('Content-Range', f'bytes {start}-{end}/{"*" if size is None else size}')
             self.send_header("Content-Length", f'{end - start + 1}')
-        else:
+        elif size is not None:
             self.send_header("Content-Length", f'{size}')
 
         self.send_header("TransferMode.DLNA.ORG", "Streaming")
-        self.send_header('ContentFeatures.DLNA.ORG', 'DLNA.ORG_OP=01;DLNA.ORG_FLAGS=01700000000000000000000000000000')
+        self.send_header('ContentFeatures.DLNA.ORG', self.CONTENT_FEATURES)
         self.send_header("Accept-Ranges", "bytes")
 
         if isinstance(connection, UninitializedClass):
@@ -214,6 +682,78 @@ class HTTPTorrentServerHandler(BaseHTTPRequestHandler):
 
         self.end_headers()
 
+    def _get_time_seek_seconds(self):
+        ''' Extract the start of the "TimeSeekRange.dlna.org" HTTP header in seconds: npt=123.4- or npt=0:02:03.4- '''
+
+        time_seek_str = self.headers.get('TimeSeekRange.dlna.org')
+        if not time_seek_str:
+            return 0
+
+        m = self.regex_header_time_seek.match(time_seek_str.strip())
+        if not m:
+            return 0
+
+        start = m.group(1)
+        if ':' in start:
+            return clock_to_seconds(start)
+
+        return int(float(start))
+
+    def _url_to_transcode_path(self):
+        ''' Extract (torrent_id,file_id) from a /Transcode/ url and get the file path '''
+
+        match = self.regex_transcode.match(self.path)
+        if not match:
+            return
+
+        tf = transmission_utils.get_torrent_file(int(match.group(1)), int(match.group(2)))
+        if tf is None:
+            return
+
+        return transmission_utils.torrent_file_to_path(tf)
+
+    def _send_transcode_headers(self, start_seconds=0):
+        self.send_response(200)
+        self.send_header("Content-Type", self.live_transcoder.content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("TransferMode.DLNA.ORG", "Streaming")
+
+        # Only time based seeking is supported since the output size is unknown
+        self.send_header('ContentFeatures.DLNA.ORG', self.TRANSCODE_CONTENT_FEATURES)
+
+        if start_seconds:
+            self.send_header('TimeSeekRange.dlna.org', f'npt={start_seconds}-')
+
+        self.end_headers()
+
+    def _serve_transcode(self, fp, head=False):
+        ''' Stream a live transcode of the file with chunked transfer, seeks restart ffmpeg at the requested time '''
+
+        start_seconds = self._get_time_seek_seconds()
+
+        if head:
+            self._send_transcode_headers(start_seconds)
+            return
+
+        transcode = self.live_transcoder.transcode(fp, start_seconds=start_seconds)
+        if transcode is None:
+            self._send_default_headers('transcode', status_code=503)
+            return
+
+        LOGGER.info(f'TRANSCODE FILE {fp} FROM {start_seconds}s')
+
+        with transcode:
+            self._send_transcode_headers(start_seconds)
+
+            try:
+                for data in transcode:
+                    self.wfile.write(f'{len(data):X}\r\n'.encode('latin1') + data + b'\r\n')
+                self.wfile.write(b'0\r\n\r\n')
+
+            except (BrokenPipeError, ConnectionResetError):
+                LOGGER.info(f'Client disconnected from transcode of {fp}')
+                self.close_connection = True
+
     def _serve_torrents(self):
         ''' Serve a list of torrents in json format:  {'torrents': ["1: What If Season 2", "2: Percy Jackson...", ...] } '''
 
@@ -247,6 +787,13 @@ class HTTPTorrentServerHandler(BaseHTTPRequestHandler):
             self._send_default_headers('nocallback')
 
     def do_HEAD(self):
+        self.media_requests.record(self.path, self.command, self.headers.get('Range') or self.headers.get('TimeSeekRange.dlna.org'))
+
+        fp = self._url_to_transcode_path()
+        if fp is not None:
+            self._serve_transcode(fp, head=True)
+            return
+
         ret = self._url_to_torrent_fileinfo()
 
         if ret is not None:
@@ -265,6 +812,10 @@ class HTTPTorrentServerHandler(BaseHTTPRequestHandler):
             
         LOGGER.info(f'HEAD FILE {fp}')
 
+        if self._get_growing_file_size(fp) is not None:
+            self._serve_growing_file(fp, head=True)
+            return
+
         fn = os.path.basename(fp)
 
         content_range = self._get_content_range(size)
@@ -273,6 +824,13 @@ class HTTPTorrentServerHandler(BaseHTTPRequestHandler):
                                    content_range=content_range)
 
     def do_GET(self):
+        self.media_requests.record(self.path, self.command, self.headers.get('Range') or self.headers.get('TimeSeekRange.dlna.org'))
+
+        fp = self._url_to_transcode_path()
+        if fp is not None:
+            self._serve_transcode(fp)
+            return
+
         ret = self._url_to_torrent_fileinfo()
 
         if ret is not None:
@@ -292,7 +850,14 @@ class HTTPTorrentServerHandler(BaseHTTPRequestHandler):
                     return
                 self._serve_torrent_files(torrent_id)
                 return
-        
+
+        if self._get_growing_file_size(fp) is not None:
+            try:
+                self._serve_growing_file(fp)
+            except (BrokenPipeError, ConnectionResetError):
+                LOGGER.info(f'Client disconnected from growing file {fp}')
+            return
+
         fn = os.path.basename(fp)
         
         content_range = self._get_content_range(size)
@@ -320,7 +885,7 @@ class HTTPTorrentServerHandler(BaseHTTPRequestHandler):
 
 ##############################
 # HTTP server
-class HTTPTorrentServer(HTTPServer):
+class HTTPTorrentServer(ThreadedHTTPServer):
     '''
     HTTP Torrent server main object to easily start and stop the server
 
@@ -328,57 +893,22 @@ class HTTPTorrentServer(HTTPServer):
     '''
 
     def __init__(self, *args, server_address=(getattr(config, 'SERVER_IP', ''), getattr(config, 'SERVER_PORT', 0)), RequestHandlerClass=HTTPTorrentServerHandler,
-                 timeout=10, **kwargs):
-        self.should_run = self.started = False
+                 timeout=10, live_transcoder=None, **kwargs):
         self.timeout=timeout
-        self.threads = []
 
         # Share objects with RequestHandlerClass
         self.NOTIFY_callbacks = {}
         self.file_mappings = {}
-        new_cls = functools.partial(RequestHandlerClass, self.NOTIFY_callbacks, self.file_mappings)
+        self.growing_files = {}
+        self.live_transcoder = live_transcoder or LiveTranscoder()
+        self.media_requests = MediaRequestStats()
+        new_cls = functools.partial(RequestHandlerClass, self.NOTIFY_callbacks, self.file_mappings, self.growing_files,
+                                    self.live_transcoder, self.media_requests)
 
         super().__init__(*args, server_address=server_address,
                          RequestHandlerClass=new_cls,
                          **kwargs)
 
-    def start_threads(self):
-        if self.started:
-            return
-        LOGGER.info("STARTING file server threads")
-
-        self.started = self.should_run = True
-        for i in range(10):
-            thread = threading.Thread(target=self._serve_while_should_run)
-            thread.daemon = True
-            thread.start()
-            self.threads.append(thread)
-
-    def stop_threads(self):
-        self.should_run = False
-        LOGGER.info("STOPPING file server threads")
-        
-        ip, port = self.server_address
-        if ip in ('', None, '0.0.0.0'):
-            ip = '127.0.0.1'
-        
-        # Trigger requests for awaiting self.handle_request() calls
-        try:
-            for i in range(22):
-                requests.get(f'http://{ip}:{port}/', timeout=4)
-        except:
-            pass
-
-        for thread in self.threads:
-            thread.join()
-
-        self.threads = []
-        self.started = False
-
-    def _serve_while_should_run(self):
-        while self.should_run:
-            self.handle_request()
-
     def register_NOTIFY_callback(self, href, callback):
         if href in self.NOTIFY_callbacks:
             LOGGER.warning(f"Overwriting {href} callback")
@@ -410,26 +940,717 @@ class HTTPTorrentServer(HTTPServer):
         
         LOGGER.info(f"Unregistered {href} to file {self.file_mappings[href]}")
         del self.file_mappings[href]
+
+    def is_file_mapped(self, filepath):
+        ''' Check if a file (or a hardlink to it) is mapped to an href '''
+
+        for mapped_path in list(self.file_mappings.values()):
+            try:
+                if os.path.samefile(mapped_path, filepath):
+                    return True
+            except OSError:
+                continue
+
+        return False
+
+    def register_growing_file(self, filepath, size_cb):
+        ''' size_cb() returns the size written so far while the file is being written and None once it's complete '''
+
+        LOGGER.info(f"Registered growing file {filepath}")
+        self.growing_files[filepath] = size_cb
+
+    def unregister_growing_file(self, filepath):
+        if filepath not in self.growing_files:
+            return
+
+        LOGGER.info(f"Unregistered growing file {filepath}")
+        del self.growing_files[filepath]
     
 
 
 ######################################################################
-# File convertion
+# Telegram webhook
 ######################################################################
 
+class TelegramWebhookHandler(TracedHTTPRequestHandler):
+    ''' Accepts Telegram update POSTs on the webhook path carrying the secret token, refuses everything else '''
 
-class FileConverter(object):
-    ''' 
-    Handle file convertions with ffmpeg binary
+    SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+    MAX_BODY_SIZE = 1024 * 1024
 
-    Saves .metadata_json files to represent the output file's metadata
-    '''
+    protocol_version = 'HTTP/1.1'
 
-    COMMAND_TEMPLATE =  '''{ffmpeg_path} -y -i "{input_path}" {codec_switches} "{output_path}" '''
+    def __init__(self, url_path, secret_token, on_update, timeout, *args, **kwargs):
+        self.url_path = url_path
+        self.secret_token = secret_token
+        self.on_update = on_update
+        self.timeout = timeout  # Idle keep-alive connections and stalled bodies are closed instead of holding a thread
+        super().__init__(*args, **kwargs)
 
-    DEFAULT_CODEC_SWITCHES = '-map 0 -map_chapters 0 -scodec mov_text -vcodec libx264 -pix_fmt yuv420p -profile:v baseline'
+    def _respond(self, code):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
 
-    METADATA_EXTENSION = '.metadata_json'
+    def do_GET(self):
+        self.close_connection = True
+        self._respond(404)
+
+    def do_POST(self):
+        if self.path != self.url_path:
+            self.close_connection = True
+            return self._respond(404)
+
+        if self.secret_token:
+            token = self.headers.get(self.SECRET_TOKEN_HEADER, '')
+            if not hmac.compare_digest(token.encode('utf-8', 'replace'), self.secret_token.encode('utf-8')):
+                LOGGER.warning(f'Webhook POST from {self.client_address} with a wrong secret token')
+                self.close_connection = True
+                return self._respond(403)
+
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = 0
+
+        if not 0 < length <= self.MAX_BODY_SIZE:
+            self.close_connection = True
+            return self._respond(400)
+
+        try:
+            data = json.loads(self.rfile.read(length))
+            self.on_update(data)
+        except Exception:
+            LOGGER.exception(f'Failed handling webhook update from {self.client_address}')
+            return self._respond(400)
+
+        self._respond(200)
+
+    def log_message(self, format, *args):
+        LOGGER.debug(f'{self.client_address} {format % args}')
+
+
+class TelegramWebhookServer(ThreadedHTTPServer):
+    '''
+    Local listener Telegram pushes updates to, instead of the bot long-polling getUpdates
+
+    The listener threads only parse and enqueue, updates are processed on the application's event loop
+    by the same handlers (and update processor) as polled updates
+
+    There are only num_threads threads, so TLS handshakes and reads time out after timeout seconds,
+    otherwise a few idle connections (a port scanner) would stop the updates
+    '''
+
+    def __init__(self, application,
+                 server_address=(getattr(config, 'WEBHOOK_LISTEN', ''), getattr(config, 'WEBHOOK_PORT', 8443)),
+                 url_path=getattr(config, 'WEBHOOK_PATH', 'telegram'),
+                 secret_token=getattr(config, 'WEBHOOK_SECRET_TOKEN', None),
+                 num_threads=getattr(config, 'WEBHOOK_WORKERS', 4), timeout=getattr(config, 'WEBHOOK_TIMEOUT', 10),
+                 cert=getattr(config, 'WEBHOOK_CERT', None), key=getattr(config, 'WEBHOOK_KEY', None), **kwargs):
+
+        self.application = application
+        self.url_path = '/' + url_path.strip('/')
+        self.secret_token = secret_token or secrets.token_urlsafe(32)  # A fresh one is registered on every start
+        self.cert = cert
+        self.loop = None
+
+        ssl_context = None
+        if cert and key:
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(cert, key)
+
+        handler = functools.partial(TelegramWebhookHandler, self.url_path, self.secret_token, self.put_update, timeout)
+        super().__init__(server_address=server_address, RequestHandlerClass=handler,
+                         num_threads=num_threads, ssl_context=ssl_context, **kwargs)
+        self.timeout = timeout
+
+    def put_update(self, data):
+        update = Update.de_json(data, self.application.bot)
+        self.loop.call_soon_threadsafe(self.application.update_queue.put_nowait, update)
+
+    async def run(self, webhook_url=getattr(config, 'WEBHOOK_URL', None), allowed_updates=Update.ALL_TYPES,
+                  drop_pending_updates=False):
+        '''
+        Register the webhook and serve updates until cancelled (SIGTERM cancels it too)
+
+        webhook_url is the public https://host[:port] Telegram reaches this listener on (e.g. through a reverse proxy)
+        '''
+
+        if not webhook_url:
+            raise ValueError('WEBHOOK_ENABLED requires WEBHOOK_URL, the public URL Telegram POSTs updates to')
+
+        self.loop = asyncio.get_running_loop()
+        webhook_url = webhook_url.rstrip('/') + self.url_path
+
+        try:
+            self.loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        except NotImplementedError:
+            pass  # Windows
+
+        async with self.application:
+            await self.application.bot.set_webhook(
+                webhook_url,
+                certificate=Path(self.cert).read_bytes() if self.cert else None,
+                max_connections=self.num_threads,
+                allowed_updates=allowed_updates,
+                drop_pending_updates=drop_pending_updates,
+                secret_token=self.secret_token,
+            )
+            await self.application.start()
+            self.start_threads()
+            LOGGER.info(f'Serving webhook {webhook_url} on {self.server_address} with {self.num_threads} threads')
+
+            try:
+                await asyncio.Event().wait()
+            finally:
+                try:
+                    self.loop.remove_signal_handler(signal.SIGTERM)
+                except NotImplementedError:
+                    pass
+
+                await asyncio.to_thread(self.stop_threads)
+                await self.application.stop()
+
+
+######################################################################
+# MP4 faststart
+######################################################################
+
+def iter_mp4_atoms(f, start, end):
+    ''' Yield (atom_type, offset, size, header_size) for the atoms of an MP4 file between start and end '''
+
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, atom_type = struct.unpack('>I4s', f.read(8))
+        header_size = 8
+
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+
+        if size < header_size or offset + size > end:
+            raise ValueError(f'Invalid MP4 atom {atom_type} at {offset} with size {size}')
+
+        yield atom_type, offset, size, header_size
+        offset += size
+
+def needs_faststart(filepath):
+    ''' Check if a (non fragmented) MP4 file has its moov atom after the media data '''
+
+    with open(filepath, 'rb') as f:
+        atoms = list(iter_mp4_atoms(f, 0, os.path.getsize(filepath)))
+
+    atom_types = [atom[0] for atom in atoms]
+    if b'moov' not in atom_types or b'mdat' not in atom_types or b'moof' in atom_types:
+        return False
+
+    return atom_types.index(b'moov') > atom_types.index(b'mdat')
+
+def faststart_mp4(filepath, output_path, ffmpeg_path=getattr(config, 'FFMPEG_PATH', 'ffmpeg'),
+                  throttle_bps=None, progress_cb=None):
+    '''
+    Write a copy of an MP4 file with its moov atom before its media data to output_path (ffmpeg -c copy -movflags +faststart)
+
+    ffmpeg is paused while it's ahead of throttle_bps bytes per second (on Windows it runs at a lower priority instead),
+    progress_cb(written_bytes, total_bytes) is called with its progress
+
+    Returns True if output_path was written, False if the file doesn't need faststart
+    '''
+
+    if not needs_faststart(filepath):
+        return False
+
+    total_size = os.path.getsize(filepath)
+    cmd = [ffmpeg_path, '-nostdin', '-loglevel', 'error', '-y', '-i', filepath,
+           '-map', '0', '-c', 'copy', '-movflags', '+faststart', '-f', 'mp4', '-progress', 'pipe:1', output_path]
+    LOGGER.info(f'Starting faststart: {cmd}')
+
+    # ffmpeg can't limit its own I/O rate so it's paused with SIGSTOP/SIGCONT, which don't exist on Windows.
+    # There it isn't throttled, only started below normal priority to leave the CPU and disk to streaming
+    can_pause = hasattr(signal, 'SIGSTOP')
+    creationflags = 0
+    if throttle_bps and not can_pause:
+        creationflags = getattr(subprocess, 'BELOW_NORMAL_PRIORITY_CLASS', 0)
+
+    start_time = time.time()
+    try:
+        with TRACER.span('ffmpeg faststart', 'ffmpeg', input=os.path.basename(filepath)), \
+             subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              text=True, creationflags=creationflags) as process:
+
+            for line in process.stdout:
+                key, _, value = line.strip().partition('=')
+                if key != 'total_size' or not value.isdigit():
+                    continue
+
+                written = int(value)
+                if progress_cb is not None:
+                    progress_cb(min(written, total_size), total_size)
+
+                if throttle_bps and can_pause:
+                    delay = written / throttle_bps - (time.time() - start_time)
+                    if delay > 0:
+                        process.send_signal(signal.SIGSTOP)
+                        try:
+                            time.sleep(delay)
+                        finally:
+                            process.send_signal(signal.SIGCONT)
+
+            stderr = process.stderr.read()
+
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, cmd, stderr=stderr)
+
+    except:
+        if os.path.exists(output_path):
+            os.unlink(output_path)
+        raise
+
+    return True
+
+
+######################################################################
+# Media probe
+######################################################################
+
+SUBTITLE_MIMETYPES = {
+    '.srt': 'text/srt',
+    '.vtt': 'text/vtt',
+    '.ass': 'text/x-ssa',
+    '.ssa': 'text/x-ssa',
+    '.smi': 'smi/caption',
+}
+
+
+@dataclasses.dataclass
+class MediaProbe:
+    size: int = None
+    duration: float = None  # Seconds
+    resolution: str = None  # WIDTHxHEIGHT
+    bitrate: int = None  # Bits per second
+    container: str = None
+    video_codec: str = None
+    audio_codec: str = None
+    audio_channels: int = None
+    sample_frequency: int = None
+
+
+@functools.lru_cache(maxsize=256)
+def _probe_media(filepath, size, mtime_ns, ffprobe_path):
+    ''' Cached by (filepath, size, mtime_ns) so a changed file is probed again '''
+
+    probe = MediaProbe(size=size)
+
+    cmd = [ffprobe_path, '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', filepath]
+
+    try:
+        output = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                timeout=30, check=True).stdout
+        info = json.loads(output)
+    except (OSError, ValueError, subprocess.SubprocessError):
+        LOGGER.info(f'Failed probing {filepath}')
+        return probe
+
+    fmt = info.get('format', {})
+    probe.container = fmt.get('format_name')
+
+    try:
+        probe.duration = float(fmt['duration'])
+    except (KeyError, ValueError):
+        pass
+
+    try:
+        probe.bitrate = int(fmt['bit_rate'])
+    except (KeyError, ValueError):
+        pass
+
+    for stream in info.get('streams', []):
+        codec_type = stream.get('codec_type')
+
+        if codec_type == 'video' and probe.video_codec is None:
+            probe.video_codec = stream.get('codec_name')
+            if stream.get('width') and stream.get('height'):
+                probe.resolution = f"{stream['width']}x{stream['height']}"
+
+        elif codec_type == 'audio' and probe.audio_codec is None:
+            probe.audio_codec = stream.get('codec_name')
+            probe.audio_channels = stream.get('channels')
+            try:
+                probe.sample_frequency = int(stream['sample_rate'])
+            except (KeyError, ValueError):
+                pass
+
+    return probe
+
+
+def probe_media(filepath, ffprobe_path=getattr(config, 'FFPROBE_PATH', 'ffprobe')):
+    ''' Get a MediaProbe of the file with ffprobe, results are cached until the file changes '''
+
+    filepath = os.path.abspath(filepath)
+    st = os.stat(filepath)
+    return _probe_media(filepath, st.st_size, st.st_mtime_ns, ffprobe_path)
+
+
+def warm_file(filepath, head_size=4 * 1024 * 1024, tail_size=4 * 1024 * 1024):
+    ''' Load the start and end of a file (where MP4 moov atoms are) into the page cache before it's requested '''
+
+    with open(filepath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        tail_start = max(size - tail_size, 0)
+
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, head_size, os.POSIX_FADV_WILLNEED)
+            os.posix_fadvise(f.fileno(), tail_start, tail_size, os.POSIX_FADV_WILLNEED)
+            return
+
+        f.read(head_size)
+        f.seek(tail_start)
+        f.read(tail_size)
+
+
+def find_subtitle_sidecars(filepath):
+    ''' Subtitle files next to the video sharing its name: "video.srt", "video.en.srt" '''
+
+    dirname, filename = os.path.split(filepath)
+    stem = os.path.splitext(filename)[0]
+
+    try:
+        entries = list(os.scandir(dirname or '.'))
+    except OSError:
+        return []
+
+    return sorted(entry.path for entry in entries
+                  if entry.name.startswith(stem + '.') and
+                  os.path.splitext(entry.name)[1].lower() in SUBTITLE_MIMETYPES)
+
+
+######################################################################
+# File convertion
+######################################################################
+
+
+def fingerprint_file(filepath, samples=8, sample_size=1024 * 1024):
+    ''' Fast content fingerprint of a file: a hash of its size and evenly spaced samples of its data '''
+
+    size = os.path.getsize(filepath)
+    digest = hashlib.sha1(str(size).encode('latin1'))
+
+    with open(filepath, 'rb') as f:
+        for i in range(samples):
+            f.seek(max(size - sample_size, 0) * i // max(samples - 1, 1))
+            digest.update(f.read(sample_size))
+
+    return digest.hexdigest()
+
+
+class ConvertionCatalog(object):
+    '''
+    SQLite catalog of file convertions so listing convertions doesn't walk the whole media library
+
+    FileConverter updates it when convertions are created, finished or deleted.
+    A background thread reconciles it with the .metadata_json files on disk,
+    only rescanning directories whose mtime changed since the last scan.
+
+    Convertions are also indexed by their fingerprint (input content + codec switches) to reuse outputs,
+    and by their last access time to evict the least recently used ones.
+    '''
+
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS convertions (
+            converted_file TEXT PRIMARY KEY,
+            directory TEXT,
+            identifier TEXT,
+            original_file TEXT,
+            status TEXT,
+            time REAL,
+            metadata TEXT,
+            fingerprint TEXT,
+            last_access REAL
+        )''',
+        'CREATE TABLE IF NOT EXISTS scanned_dirs (path TEXT PRIMARY KEY, mtime REAL)',
+    ]
+
+    # Columns added after the convertions table was created, added to existing databases
+    ADDED_COLUMNS = {
+        'fingerprint': 'TEXT',
+        'last_access': 'REAL',
+    }
+
+    INDEXES = [
+        'CREATE INDEX IF NOT EXISTS convertions_directory ON convertions (directory)',
+        'CREATE INDEX IF NOT EXISTS convertions_identifier ON convertions (identifier)',
+        'CREATE INDEX IF NOT EXISTS convertions_time ON convertions (time)',
+        'CREATE INDEX IF NOT EXISTS convertions_fingerprint ON convertions (fingerprint)',
+        'CREATE INDEX IF NOT EXISTS convertions_last_access ON convertions (last_access)',
+    ]
+
+    STATUS_UNKNOWN = 'unknown'
+    STATUS_RUNNING = 'running'
+    STATUS_FINISHED = 'finished'
+    STATUS_FAILED = 'failed'
+
+    def __init__(self, db_path=getattr(config, 'CONVERTION_CATALOG_PATH', 'convertions.sqlite3'), paths=None,
+                 reconcile_interval=getattr(config, 'CONVERTION_CATALOG_RECONCILE_INTERVAL', 10 * 60)):
+        self.db_path = db_path
+        self.paths = paths
+        self.reconcile_interval = reconcile_interval
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+
+        with self.lock, self.db:
+            for statement in self.SCHEMA:
+                self.db.execute(statement)
+
+            columns = {row[1] for row in self.db.execute('PRAGMA table_info(convertions)')}
+            for column, column_type in self.ADDED_COLUMNS.items():
+                if column not in columns:
+                    self.db.execute(f'ALTER TABLE convertions ADD COLUMN {column} {column_type}')
+
+            for statement in self.INDEXES:
+                self.db.execute(statement)
+
+        self.thread = None
+        self.should_run = False
+
+    def get_paths(self):
+        return self.paths or [config.DIR_MOVIES, config.DIR_TV_SHOWS]
+
+    ###############
+    # Convertion entries
+    def _upsert(self, metadata, status):
+        converted_file = metadata.get('converted_file')
+
+        self.db.execute('''INSERT INTO convertions (converted_file, directory, identifier, original_file, status, time, metadata,
+                                                    fingerprint, last_access)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                           ON CONFLICT(converted_file) DO UPDATE SET
+                               identifier=excluded.identifier,
+                               original_file=excluded.original_file,
+                               status=COALESCE(excluded.status, convertions.status),
+                               time=excluded.time,
+                               metadata=excluded.metadata,
+                               fingerprint=excluded.fingerprint,
+                               last_access=COALESCE(convertions.last_access, excluded.last_access)''',
+                        (converted_file,
+                         os.path.dirname(converted_file),
+                         metadata.get('identifier'),
+                         metadata.get('original_file'),
+                         status,
+                         metadata.get('time'),
+                         json.dumps(metadata),
+                         metadata.get('fingerprint'),
+                         metadata.get('time')))
+
+    def add(self, metadata, status=STATUS_RUNNING):
+        if not metadata.get('converted_file'):
+            LOGGER.error(f'Catalog entries require converted_file: {metadata}')
+            return
+
+        with self.lock, self.db:
+            self._upsert(metadata, status)
+
+    def set_status(self, converted_file, status):
+        with self.lock, self.db:
+            self.db.execute('UPDATE convertions SET status=? WHERE converted_file=?', (status, converted_file))
+
+    def remove(self, converted_file):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM convertions WHERE converted_file=?', (converted_file,))
+
+    def touch(self, converted_file):
+        ''' Mark a convertion as recently used '''
+
+        with self.lock, self.db:
+            self.db.execute('UPDATE convertions SET last_access=? WHERE converted_file=?', (time.time(), converted_file))
+
+    def find_by_fingerprint(self, fingerprint):
+        ''' Iterate finished convertions with the fingerprint, most recently used first '''
+
+        with self.lock:
+            rows = self.db.execute('''SELECT metadata, status FROM convertions WHERE fingerprint=? AND status=?
+                                      ORDER BY last_access DESC''',
+                                   (fingerprint, self.STATUS_FINISHED)).fetchall()
+
+        for row in rows:
+            yield self._row_to_metadata(row)
+
+    def iter_least_recently_used(self):
+        ''' Iterate convertions which aren't running, least recently used first '''
+
+        with self.lock:
+            rows = self.db.execute('''SELECT metadata, status FROM convertions WHERE status!=?
+                                      ORDER BY COALESCE(last_access, time)''',
+                                   (self.STATUS_RUNNING,)).fetchall()
+
+        for row in rows:
+            yield self._row_to_metadata(row)
+
+    def get(self, converted_file):
+        with self.lock:
+            row = self.db.execute('SELECT metadata, status FROM convertions WHERE converted_file=?',
+                                  (converted_file,)).fetchone()
+        if row is None:
+            return
+
+        return self._row_to_metadata(row)
+
+    def iter_metadatas(self, status=None):
+        with self.lock:
+            if status is None:
+                rows = self.db.execute('SELECT metadata, status FROM convertions ORDER BY time').fetchall()
+            else:
+                rows = self.db.execute('SELECT metadata, status FROM convertions WHERE status=? ORDER BY time',
+                                       (status,)).fetchall()
+
+        for row in rows:
+            yield self._row_to_metadata(row)
+
+    @staticmethod
+    def _row_to_metadata(row):
+        metadata_json, status = row
+        metadata = json.loads(metadata_json)
+        metadata['status'] = status
+        return metadata
+
+    ###############
+    # Reconciliation with disk
+    @staticmethod
+    def _iter_dirs(path):
+        ''' Yield (dirpath, mtime) for path and all its subdirectories '''
+
+        stack = [path]
+        while stack:
+            dirpath = stack.pop()
+
+            try:
+                mtime = os.stat(dirpath).st_mtime
+                with os.scandir(dirpath) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+            except OSError:
+                continue
+
+            yield dirpath, mtime
+
+    def _rescan_dir(self, dirpath):
+        ''' Sync the catalog entries of a single directory with its .metadata_json files '''
+
+        metadatas = []
+        try:
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    if not entry.name.endswith(FileConverter.METADATA_EXTENSION):
+                        continue
+
+                    try:
+                        with open(entry.path, 'r') as metadata_file:
+                            metadatas.append(json.loads(metadata_file.read()))
+                    except (OSError, ValueError):
+                        LOGGER.warning(f'Failed reading convertion metadata {entry.path}')
+        except OSError:
+            pass
+
+        converted_files = [m.get('converted_file') for m in metadatas if m.get('converted_file')]
+
+        with self.lock, self.db:
+            known = {row[0] for row in self.db.execute('SELECT converted_file FROM convertions WHERE directory=?',
+                                                       (dirpath,))}
+
+            for converted_file in known.difference(converted_files):
+                self.db.execute('DELETE FROM convertions WHERE converted_file=?', (converted_file,))
+
+            for metadata in metadatas:
+                if metadata.get('converted_file') and metadata['converted_file'] not in known:
+                    self._upsert(metadata, self.STATUS_UNKNOWN)
+
+    def reconcile(self, *paths):
+        paths = paths or self.get_paths()
+
+        with self.lock:
+            scanned_dirs = dict(self.db.execute('SELECT path, mtime FROM scanned_dirs').fetchall())
+
+        seen_dirs = set()
+        rescanned = 0
+
+        for path in paths:
+            for dirpath, mtime in self._iter_dirs(path):
+                seen_dirs.add(dirpath)
+
+                if scanned_dirs.get(dirpath) == mtime:
+                    continue
+
+                self._rescan_dir(dirpath)
+                rescanned += 1
+
+                with self.lock, self.db:
+                    self.db.execute('INSERT OR REPLACE INTO scanned_dirs (path, mtime) VALUES (?, ?)', (dirpath, mtime))
+
+        with self.lock, self.db:
+            for dirpath in set(scanned_dirs).difference(seen_dirs):
+                self.db.execute('DELETE FROM scanned_dirs WHERE path=?', (dirpath,))
+                self.db.execute('DELETE FROM convertions WHERE directory=?', (dirpath,))
+
+        LOGGER.info(f'Reconciled convertion catalog: rescanned {rescanned}/{len(seen_dirs)} directories')
+        return rescanned
+
+    def is_scanned(self):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM scanned_dirs LIMIT 1').fetchone() is not None
+
+    def _reconcile_while_should_run(self):
+        while self.should_run:
+            time.sleep(self.reconcile_interval)
+
+            try:
+                self.reconcile()
+            except:
+                LOGGER.exception('Failed reconciling convertion catalog')
+
+    def start_reconcile_thread(self):
+        if self.thread is not None:
+            return
+
+        # Import existing .metadata_json files on first start
+        if not self.is_scanned():
+            self.reconcile()
+
+        self.should_run = True
+        self.thread = threading.Thread(target=self._reconcile_while_should_run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop_reconcile_thread(self):
+        self.should_run = False
+        self.thread = None
+
+
+class FileConverter(object):
+    ''' 
+    Handle file convertions with ffmpeg binary
+
+    Saves .metadata_json files to represent the output file's metadata
+    and keeps the ConvertionCatalog (if given) up to date
+
+    With a catalog, convertions of the same content with the same codec switches reuse (hardlink) an existing output,
+    and the least recently used outputs are deleted when they exceed cache_budget bytes
+    '''
+
+    COMMAND_TEMPLATE =  '''{ffmpeg_path} -y -i "{input_path}" {codec_switches} "{output_path}" '''
+
+    DEFAULT_CODEC_SWITCHES = '-map 0 -map_chapters 0 -scodec mov_text -vcodec libx264 -pix_fmt yuv420p -profile:v baseline'
+
+    # Fragmented MP4 can be played while it's being written since it doesn't need the moov atom at the end
+    FRAGMENTED_SWITCHES = '-movflags frag_keyframe+empty_moov+default_base_moof'
+
+    # Renderers can start playing without range requesting the moov atom at the end of the file
+    FASTSTART_SWITCHES = '-movflags +faststart'
+
+    METADATA_EXTENSION = '.metadata_json'
 
     @classmethod
     def output_to_metadata_path(cls, output_path):
@@ -440,251 +1661,1440 @@ class FileConverter(object):
         if not paths:
             paths = [config.DIR_MOVIES, config.DIR_TV_SHOWS]
 
-        for path in paths:
-            # TODO: glob
-            for root, folders, files in os.walk(path):
-                for f in files:
-                    
-                    if f.endswith(cls.METADATA_EXTENSION):
-                        yield os.path.join(root, f)
-    @classmethod
-    def iter_convertion_metadatas(cls,
-                                  filter_cb=lambda md: os.path.exists(md.get('converted_file')),
-                                  *paths):
-        for fp in cls.iter_convertion_metadata_files(*paths):
-            with open(fp, 'r') as metadata_file:
-                metadata = json.loads(metadata_file.read())
+        for path in paths:
+            # TODO: glob
+            for root, folders, files in os.walk(path):
+                for f in files:
+                    
+                    if f.endswith(cls.METADATA_EXTENSION):
+                        yield os.path.join(root, f)
+    @classmethod
+    def iter_convertion_metadatas_from_disk(cls, *paths):
+        for fp in cls.iter_convertion_metadata_files(*paths):
+            with open(fp, 'r') as metadata_file:
+                yield json.loads(metadata_file.read())
+
+    def __init__(self, ffmpeg_path='ffmpeg', catalog: ConvertionCatalog = None,
+                 cache_budget=getattr(config, 'CONVERTION_CACHE_BUDGET', None), server: HTTPTorrentServer = None):
+        self.ffmpeg_path = ffmpeg_path
+        self.catalog = catalog
+        self.server = server
+        self.cache_budget = cache_budget
+
+        # Input fingerprints by (filepath, size, mtime) so unchanged files aren't hashed again
+        self.file_fingerprints = cachetools.LRUCache(maxsize=1024)
+        self.threads = []
+        self.running_identifiers = set()
+        self.convertions = []
+
+        self.faststart_thread = None
+        self.faststart_progress = {}
+
+    def iter_convertion_metadatas(self,
+                                  filter_cb=lambda md: os.path.exists(md.get('converted_file')),
+                                  *paths):
+        ''' Iterate convertions from the catalog, or walk the media directories if there is no catalog '''
+
+        if self.catalog is not None and not paths:
+            metadatas = self.catalog.iter_metadatas()
+        else:
+            metadatas = self.iter_convertion_metadatas_from_disk(*paths)
+
+        for metadata in metadatas:
+            if not filter_cb(metadata):
+                continue
+
+            yield metadata
+
+    def is_running(self, metadata):
+        return metadata.get('identifier') in self.running_identifiers
+
+    def get_running_output_size(self, metadata):
+        ''' Size written so far of a running convertion's output, None once it's finished '''
+
+        if not self.is_running(metadata):
+            return
+
+        try:
+            return os.path.getsize(metadata.get('converted_file'))
+        except OSError:
+            return 0
+
+    def save_convertion_metadata(self, metadata):
+        ''' Update the .metadata_json file and catalog entry of a convertion '''
+
+        metadata = {k: v for k, v in metadata.items() if k not in ('status', 'active')}
+
+        with open(self.output_to_metadata_path(metadata.get('converted_file')), 'w') as metadata_file:
+            metadata_file.write(json.dumps(metadata, indent=2))
+
+        if self.catalog is not None:
+            self.catalog.add(metadata, status=None)
+
+    def is_in_use(self, output_path):
+        ''' Check if an output (or a hardlink to it) is mapped on the HTTP server and may be being served '''
+
+        return self.server is not None and self.server.is_file_mapped(output_path)
+
+    def iter_shared_convertions(self, output_path):
+        ''' Convertions whose outputs are hardlinks to output_path (deduplicated convertions), including itself '''
+
+        for metadata in self.iter_convertion_metadatas():
+            try:
+                if os.path.samefile(metadata.get('converted_file'), output_path):
+                    yield metadata
+            except OSError:
+                continue
+
+    def faststart_convertion(self, metadata, throttle_bps=None, progress_cb=None):
+        '''
+        Faststart a convertion's output and every convertion sharing it
+
+        The faststart copy is a new inode which replaces each hardlink, so readers of the old file aren't affected
+        and deduplicated outputs stay shared. Outputs which are being served are skipped since seeks into them
+        would land on moved bytes
+
+        Returns the updated convertions, None if they were skipped
+        '''
+
+        output_path = metadata.get('converted_file')
+        shared = list(self.iter_shared_convertions(output_path)) or [metadata]
+
+        if any(self.is_in_use(m.get('converted_file')) for m in shared):
+            LOGGER.info(f'Skipping faststart of {output_path} which is being served')
+            return
+
+        tmp_path = f'{output_path}.faststart_tmp'
+        if faststart_mp4(output_path, tmp_path, ffmpeg_path=self.ffmpeg_path,
+                         throttle_bps=throttle_bps, progress_cb=progress_cb):
+            try:
+                for m in shared:
+                    link_path = f'{m.get("converted_file")}.faststart_link'
+                    os.link(tmp_path, link_path)
+                    os.replace(link_path, m.get('converted_file'))
+            finally:
+                os.unlink(tmp_path)
+
+        for m in shared:
+            m['faststart'] = True
+            self.save_convertion_metadata(m)
+
+        return shared
+
+    def _faststart_convertions_thread(self, metadatas, throttle_bps):
+        self.faststart_progress = {'done': 0, 'total': len(metadatas), 'failed': 0, 'skipped': 0}
+        done_paths = set()
+
+        for metadata in metadatas:
+            output_path = metadata.get('converted_file')
+
+            # Already done through a hardlink
+            if output_path in done_paths:
+                self.faststart_progress['done'] += 1
+                continue
+
+            self.faststart_progress.update(file=output_path, file_percent=0)
+
+            def progress_cb(written, total):
+                self.faststart_progress['file_percent'] = int(100 * written / total)
+
+            try:
+                shared = self.faststart_convertion(metadata, throttle_bps=throttle_bps, progress_cb=progress_cb)
+            except:
+                LOGGER.exception(f'Failed faststart of {output_path}')
+                self.faststart_progress['failed'] += 1
+            else:
+                if shared is None:
+                    self.faststart_progress['skipped'] += 1
+                else:
+                    done_paths.update(m.get('converted_file') for m in shared)
+
+            self.faststart_progress['done'] += 1
+
+        LOGGER.info(f'Finished faststart of converted files: {self.faststart_progress}')
+        self.faststart_thread = None
+
+    def start_faststart_thread(self, throttle_bps=getattr(config, 'FASTSTART_THROTTLE_BPS', 50 * 1024 * 1024)):
+        ''' Rewrite existing converted files with ffmpeg so their moov atom is at the start '''
+
+        if self.faststart_thread is not None:
+            return
+
+        metadatas = [m for m in self.iter_convertion_metadatas()
+                     if not self.is_running(m) and not m.get('fragmented') and not m.get('faststart')]
+
+        self.faststart_thread = threading.Thread(target=self._faststart_convertions_thread, args=[metadatas, throttle_bps])
+        self.faststart_thread.daemon = True
+        self.faststart_thread.start()
+        return metadatas
+
+    def forget_convertion(self, output_path):
+        ''' Remove a deleted convertion from the catalog '''
+
+        if self.catalog is not None:
+            self.catalog.remove(output_path)
+
+    def touch_convertion(self, output_path):
+        if self.catalog is not None:
+            self.catalog.touch(output_path)
+
+    def fingerprint_convertion(self, filepath, codec_switches):
+        ''' Fingerprint of converting the file's content with the codec switches '''
+
+        stat = os.stat(filepath)
+        key = (filepath, stat.st_size, stat.st_mtime)
+
+        file_fingerprint = self.file_fingerprints.get(key)
+        if file_fingerprint is None:
+            file_fingerprint = self.file_fingerprints[key] = fingerprint_file(filepath)
+
+        return hashlib.sha1(f'{file_fingerprint} {codec_switches}'.encode()).hexdigest()
+
+    def find_cached_convertion(self, fingerprint):
+        if self.catalog is None:
+            return
+
+        for metadata in self.catalog.find_by_fingerprint(fingerprint):
+            if os.path.isfile(metadata.get('converted_file')):
+                return metadata
+
+    def evict_convertions(self):
+        ''' Delete the least recently used convertions until their outputs fit in the cache budget, except ones being served '''
+
+        if self.catalog is None or not self.cache_budget:
+            return []
+
+        metadatas = list(self.catalog.iter_least_recently_used())
+
+        # Hardlinked outputs only take space once
+        inode_sizes = {}
+        for metadata in metadatas:
+            try:
+                st = os.stat(metadata.get('converted_file'))
+            except OSError:
+                continue
+            inode_sizes[(st.st_dev, st.st_ino)] = st.st_size
+
+        used_size = sum(inode_sizes.values())
+
+        evicted = []
+        for metadata in metadatas:
+            if used_size <= self.cache_budget:
+                break
+
+            output_path = metadata.get('converted_file')
+
+            if self.is_running(metadata) or self.is_in_use(output_path):
+                continue
+
+            try:
+                st = os.stat(output_path)
+                os.unlink(output_path)
+                os.unlink(self.output_to_metadata_path(output_path))
+            except OSError:
+                LOGGER.warning(f'Failed evicting convertion {output_path}')
+                continue
+
+            if st.st_nlink <= 1:
+                used_size -= st.st_size
+
+            self.forget_convertion(output_path)
+            evicted.append(output_path)
+            LOGGER.info(f'Evicted convertion {output_path}')
+
+        return evicted
+
+    def _reuse_convertion(self, cached, output_path, metadata):
+        ''' Hardlink a cached convertion's output to output_path, or reference the cached convertion if that fails '''
+
+        cached_path = cached.get('converted_file')
+        self.touch_convertion(cached_path)
+
+        if cached_path == output_path:
+            return cached
+
+        try:
+            if os.path.exists(output_path):
+                os.unlink(output_path)
+            os.link(cached_path, output_path)
+
+        except OSError:
+            LOGGER.info(f'Failed hardlinking {cached_path} -> {output_path}, reusing convertion as is')
+            return cached
+
+        LOGGER.info(f'Reused convertion {cached_path} -> {output_path}')
+
+        metadata['deduplicated_from'] = cached_path
+        for k in ('fragmented', 'faststart'):
+            metadata[k] = cached.get(k)
+
+        self.save_convertion_metadata(metadata)
+        self.catalog.set_status(output_path, ConvertionCatalog.STATUS_FINISHED)
+        return metadata
+
+    def _convert_file_thread(self, metadata):
+        LOGGER.info(f'STARTING CONVERTION THREAD FOR {metadata}')
+
+        input_path = metadata.get('original_file')
+        output_path = metadata.get('converted_file')
+
+        if not input_path or not output_path:
+            LOGGER.error(f'CONVERSION REQUIRES original_file({input_path}) and converted_file({output_path})')
+            return
+
+        self.convertions.append(metadata)
+
+        codec_switches = metadata.get('ffmpeg_codec_switches')
+        identifier = metadata.get('identifier')
+
+        if identifier:
+            self.running_identifiers.add(identifier)
+
+        cmd = self.COMMAND_TEMPLATE.format(ffmpeg_path=self.ffmpeg_path,
+                                           input_path=input_path,
+                                           codec_switches=codec_switches,
+                                           output_path=output_path)
+        status = ConvertionCatalog.STATUS_FAILED
+        try:
+            with TRACER.span('ffmpeg convertion', 'ffmpeg', input=os.path.basename(input_path), identifier=identifier):
+                output = execute_shell(cmd)
+            # TODO: Save video metadata from ffmpeg output
+
+            LOGGER.info(f'Finished converting {input_path} -> {output_path} ({identifier}):\n{output}')
+            status = ConvertionCatalog.STATUS_FINISHED
+        except:
+            LOGGER.info(f'Failed converting {input_path} -> {output_path} ({identifier}) !!!')
+        finally:
+            if identifier:
+                self.running_identifiers.remove(identifier)
+
+            if self.catalog is not None:
+                self.catalog.set_status(output_path, status)
+                self.evict_convertions()
+    
+    def start_conversion_thread(self, metadata):
+        # Run in a copy of the caller's context so the convertion's span is linked to the requesting update
+        t = threading.Thread(target=contextvars.copy_context().run, args=[self._convert_file_thread, metadata])
+        self.threads.append(t)
+        t.start()
+
+    def convert_file(self, filepath, output_path=None, codec_switches=DEFAULT_CODEC_SWITCHES,
+                     fragmented=False, **metadatas):
+        
+        if not filepath or not os.path.isfile(filepath):
+            LOGGER.error(f'No such file {filepath}')
+            return
+        
+        if output_path is None:
+            output_path = f'{filepath}_converted.mp4'
+
+        if fragmented:
+            codec_switches = f'{codec_switches} {self.FRAGMENTED_SWITCHES}'
+        else:
+            codec_switches = f'{codec_switches} {self.FASTSTART_SWITCHES}'
+
+        if any(self.is_running(m) and m.get('converted_file') == output_path for m in self.convertions):
+            LOGGER.error(f'Convertion to {output_path} is already running')
+            return
+
+        metadata = {
+            'original_file': filepath,
+            'converted_file': output_path,
+            'ffmpeg_codec_switches': codec_switches,
+            'identifier': random_identifier(),
+            'time': time.time(),
+            'fragmented': fragmented,
+            'faststart': not fragmented,
+            'fingerprint': self.fingerprint_convertion(filepath, codec_switches),
+        }
+
+        for k, v in metadatas.items():
+            metadata[k] = v
+
+        cached = self.find_cached_convertion(metadata['fingerprint'])
+        if cached is not None:
+            return self._reuse_convertion(cached, output_path, metadata)
+
+        metadata_path = self.output_to_metadata_path(output_path)
+
+        with open(metadata_path, 'w') as metadata_file:
+            metadata_file.write(json.dumps(metadata, indent=2))
+
+        if self.catalog is not None:
+            self.catalog.add(metadata, status=ConvertionCatalog.STATUS_RUNNING)
+
+        self.start_conversion_thread(metadata)
+        return metadata
+
+
+######################################################################
+# File convertion menu
+######################################################################
+
+
+class FileConvertionMenu(TorrentMenu):
+    DEFAULT_LAYOUT = [
+        ['convert_torrent_file', 'convert_torrent_file_streamable'],
+        ['list_converted_files', 'list_active_convertions', 'watch_active_convertions'],
+        ['delete_file_convertion', 'faststart_converted_files'],
+        ['back']
+    ]
+    
+    def __init__(self, file_converter: FileConverter, *args, on_complete=None, layout=DEFAULT_LAYOUT, **kwargs):
+        super().__init__(*args, layout=layout, **kwargs)
+
+        self.file_converter = file_converter
+        self.on_complete = on_complete
+
+        self.create_torrent_file_handler('convert_torrent_file', self._convert_torrent_file_cb)
+        self.create_torrent_file_handler('convert_torrent_file_streamable',
+                                         functools.partial(self._convert_torrent_file_cb, fragmented=True))
+
+        process_delete_file_cb = self.cancelable(self._delete_file_convertion_process_choice)
+        self.register_callback('_delete_file_convertion_process_choice', process_delete_file_cb)
+
+        self.create_watch_handler('watch_active_convertions', self.repr_active_convertions, key='active_convertions')
+
+    async def back(self, update, context):
+        if self.on_complete:
+            return await call_callback(self.on_complete, update, context)
+        
+        return ConversationHandler.END
+
+    async def _convert_torrent_file_cb(self, update, torrent_file, fragmented=False):
+        # on_complete in self.create_torrent_file_handler() call will make this return to self._main_menu
+
+        if torrent_file.completed < torrent_file.size or not torrent_file.size:
+            await reply(update, f'Warning: Torrent file download not complete: {torrent_file.completed} / {torrent_file.size}')
+
+        fp = transmission_utils.torrent_file_to_path(torrent_file)
+        if not fp:
+            await reply(update, f'Invalid input')
+            return
+
+        # Fingerprinting reads samples of the whole file, keep the disk reads off the event loop
+        metadata = await asyncio.to_thread(self.file_converter.convert_file, fp,
+                                           fragmented=fragmented,
+                                           torrent_id=torrent_file.torrent_id,
+                                           file_id=torrent_file.file_id)
+        if metadata:
+            await multi_reply(update, f'Started convertion', metadata)
+        else:
+            await reply(update, 'Failed to start convertion')
+
+    async def list_converted_files(self, update, context):
+        for metadata in self.file_converter.iter_convertion_metadatas():
+            identifier = metadata.get('identifier')
+
+            if not identifier:
+                metadata['active'] = 'unknown'
+            elif identifier in self.file_converter.running_identifiers:
+                metadata['active'] = True
+            else:
+                metadata['active'] = False
+
+            await reply(update, f'Converted file metadata:\n{json.dumps(metadata, indent=2)}')
+        return await self._main_menu(update, context)
+
+    async def delete_file_convertion(self, update, context):
+        userdata = self.get_userdata(update)
+
+        convertions = list(m for m in self.file_converter.iter_convertion_metadatas()
+                           if m.get('identifier', 'FAKEIFDSFDSFD') not in self.file_converter.running_identifiers)
+        userdata['ConvertedFiles_list'] = convertions
+
+        await self.prompt_list(update, 'Choose converted file:', [c.get("converted_file") for c in convertions])
+        return self.prefix_menu('_delete_file_convertion_process_choice')
+
+    async def _delete_file_convertion_process_choice(self, update, context):
+        userdata = self.get_userdata(update)
+        convertions = userdata.get('ConvertedFiles_list', [])
+
+        i = self.choice_to_number(get_text(update))
+
+        if i is not None and 0 <= i < len(convertions):
+            convertion = convertions[i]
+
+            output_path = convertion.get('converted_file')
+            metadata_path = self.file_converter.output_to_metadata_path(output_path)
+            
+            try:
+                os.unlink(output_path)
+
+            except:
+                msg = repr_action(update, f'failed to delete data file {output_path}')
+                LOGGER.info(msg)
+                await reply(update, msg)
+
+            else:
+                msg = repr_action(update, f'deleted data file {output_path}')
+                LOGGER.info(msg)
+                await reply(update, msg)
+
+            try:
+                os.unlink(metadata_path)
+
+            except:
+                msg = repr_action(update, f'failed to delete metadata file {metadata_path}')
+                LOGGER.info(msg)
+                await reply(update, msg)
+
+            else:
+                msg = repr_action(update, f'deleted metadata file {output_path}')
+                LOGGER.info(msg)
+                await reply(update, msg)
+
+            self.file_converter.forget_convertion(output_path)
+
+        return await self._main_menu(update, context)
+            
+    async def faststart_converted_files(self, update, context):
+        metadatas = self.file_converter.start_faststart_thread()
+
+        if metadatas is None:
+            await reply(update, 'Faststart already running')
+        else:
+            msg = repr_action(update, f'started faststart of {len(metadatas)} converted files')
+            LOGGER.info(msg)
+            await reply(update, msg)
+
+        return await self._main_menu(update, context)
+
+    def iter_active_convertion_reprs(self):
+        identifiers = self.file_converter.running_identifiers.copy()
+        for convertion in self.file_converter.convertions:
+
+            if convertion.get('identifier') in identifiers:
+                yield f'File convertion:\n{json.dumps(convertion, indent=2)}'
+
+        if self.file_converter.faststart_thread is not None:
+            yield f'Faststart progress:\n{json.dumps(self.file_converter.faststart_progress, indent=2)}'
+
+    def repr_active_convertions(self):
+        return '\n\n'.join(self.iter_active_convertion_reprs()) or 'No active convertions'
+
+    async def list_active_convertions(self, update, context):
+        for convertion_repr in self.iter_active_convertion_reprs():
+            await reply(update, convertion_repr)
+
+        return await self._main_menu(update, context)
+
+
+######################################################################
+# UPnP control
+######################################################################
+
+
+def get_iface_ip(host):
+    ''' IP of the local interface which routes to host '''
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect((host, 1900))
+        return sock.getsockname()[0]
+    finally:
+        sock.close()
+
+def parse_ssdp_message(data):
+    ''' Parse an SSDP message into (start line, headers with lowercase names) '''
+
+    lines = data.decode('utf-8', errors='replace').split('\r\n')
+    headers = {}
+
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+
+    return lines[0].strip(), headers
+
+
+class UPNPDeviceRegistry(object):
+    '''
+    Long lived registry of UPnP devices so device pickers don't wait for discovery
+
+    Listens passively for SSDP NOTIFY alive/byebye messages and actively searches in the background,
+    backing off while nothing changes. Device descriptions are cached by UDN until their max-age expires.
+
+    ssdp_address and discover can be replaced to run against a local fake SSDP responder
+    '''
+
+    SSDP_ADDRESS = ('239.255.255.250', 1900)
+
+    regex_max_age = re.compile(r'max-age\s*=\s*(\d+)', re.IGNORECASE)
+
+    def __init__(self, ssdp_address=SSDP_ADDRESS, discover=upnp_discover, make_device=make_upnp_device,
+                 search_timeout=5,
+                 min_search_interval=getattr(config, 'UPNP_MIN_SEARCH_INTERVAL', 30),
+                 max_search_interval=getattr(config, 'UPNP_MAX_SEARCH_INTERVAL', 10 * 60),
+                 default_max_age=1800):
+        self.ssdp_address = ssdp_address
+        self.discover = discover
+        self.make_device = make_device
+        self.search_timeout = search_timeout
+        self.min_search_interval = min_search_interval
+        self.max_search_interval = max_search_interval
+        self.default_max_age = default_max_age
+
+        self.lock = threading.Lock()
+        self.devices = {}  # UDN -> (device, expiration time)
+        self.pending_locations = set()
+
+        self.should_run = False
+        self.threads = []
+        self.search_event = threading.Event()
+        self.searched_event = threading.Event()
+
+    ###############
+    # Devices
+    def add_device(self, device, max_age=None):
+        expires = time.time() + (max_age or self.default_max_age)
+
+        with self.lock:
+            is_new = device.udn not in self.devices
+            self.devices[device.udn] = (device, expires)
+
+        if is_new:
+            LOGGER.info(f'UPnP device registered: {device} ({device.udn})')
+
+        return is_new
+
+    def refresh_device(self, udn, max_age=None):
+        ''' Extend a known device's expiration, returns False if it's unknown '''
+
+        with self.lock:
+            if udn not in self.devices:
+                return False
+
+            device, _ = self.devices[udn]
+            self.devices[udn] = (device, time.time() + (max_age or self.default_max_age))
+            return True
+
+    def remove_device(self, udn):
+        with self.lock:
+            entry = self.devices.pop(udn, None)
+
+        if entry is not None:
+            LOGGER.info(f'UPnP device removed: {entry[0]} ({udn})')
+
+    def get_device(self, udn):
+        with self.lock:
+            entry = self.devices.get(udn)
+
+        if entry is None or entry[1] < time.time():
+            return
+
+        return entry[0]
+
+    def iter_devices(self):
+        now = time.time()
+
+        with self.lock:
+            for udn in [udn for udn, (_, expires) in self.devices.items() if expires < now]:
+                del self.devices[udn]
+
+            devices = [device for device, _ in self.devices.values()]
+
+        return iter(devices)
+
+    ###############
+    # Passive NOTIFY listening
+    def _fetch_device(self, location, max_age):
+        try:
+            iface_ip = get_iface_ip(urllib.parse.urlsplit(location).hostname)
+            device = self.make_device(location, iface_ip=iface_ip)
+        except Exception as e:
+            LOGGER.info(f'Failed fetching UPnP device description {location}: {e}')
+        else:
+            self.add_device(device, max_age=max_age)
+        finally:
+            with self.lock:
+                self.pending_locations.discard(location)
+
+    def handle_ssdp_message(self, data):
+        start_line, headers = parse_ssdp_message(data)
+
+        if not start_line.upper().startswith('NOTIFY'):
+            return
+
+        udn = headers.get('usn', '').split('::')[0]
+        if not udn:
+            return
+
+        nts = headers.get('nts', '').lower()
+
+        if nts == 'ssdp:byebye':
+            self.remove_device(udn)
+            return
+
+        if nts != 'ssdp:alive':
+            return
+
+        m = self.regex_max_age.search(headers.get('cache-control', ''))
+        max_age = int(m.group(1)) if m else None
+
+        if self.refresh_device(udn, max_age=max_age):
+            return
+
+        location = headers.get('location')
+        if not location:
+            return
+
+        with self.lock:
+            if location in self.pending_locations:
+                return
+            self.pending_locations.add(location)
+
+        # Fetching the description takes a few round trips, don't block the listener
+        thread = threading.Thread(target=self._fetch_device, args=[location, max_age])
+        thread.daemon = True
+        thread.start()
+
+    def _create_listen_socket(self):
+        ip, port = self.ssdp_address
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        sock.bind(('', port))
+
+        if ip.startswith('239.'):
+            membership = struct.pack('=4sl', socket.inet_aton(ip), socket.INADDR_ANY)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+
+        sock.settimeout(1)
+        return sock
+
+    def _listen_while_should_run(self):
+        try:
+            sock = self._create_listen_socket()
+        except OSError as e:
+            LOGGER.warning(f'Failed listening for SSDP NOTIFY messages, relying on searches: {e}')
+            return
+
+        with sock:
+            while self.should_run:
+                try:
+                    data, address = sock.recvfrom(4096)
+                except socket.timeout:
+                    continue
+                except OSError:
+                    LOGGER.exception('SSDP listener error')
+                    continue
+
+                try:
+                    self.handle_ssdp_message(data)
+                except:
+                    LOGGER.exception(f'Failed handling SSDP message from {address}')
+
+    ###############
+    # Active searching
+    def search(self):
+        ''' Search for devices once, returns the number of new devices '''
+
+        new_devices = 0
+        for device in self.discover(timeout=self.search_timeout):
+            if self.add_device(device):
+                new_devices += 1
+
+        self.searched_event.set()
+        return new_devices
+
+    def request_search(self):
+        ''' Wake the background search instead of waiting for its backoff '''
+
+        self.searched_event.clear()
+        self.search_event.set()
+
+    def wait_for_search(self, timeout=None):
+        return self.searched_event.wait(timeout)
+
+    def _search_while_should_run(self):
+        interval = self.min_search_interval
+
+        while self.should_run:
+            self.search_event.clear()
+
+            try:
+                new_devices = self.search()
+            except:
+                LOGGER.exception('UPnP search failed')
+                new_devices = 0
+
+            if new_devices:
+                interval = self.min_search_interval
+            else:
+                interval = min(interval * 2, self.max_search_interval)
+
+            self.search_event.wait(interval)
+
+    def start_threads(self):
+        if self.should_run:
+            return
+
+        self.should_run = True
+        for target in (self._listen_while_should_run, self._search_while_should_run):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop_threads(self):
+        self.should_run = False
+        self.search_event.set()
+        self.threads = []
+
+
+def iter_UPNP_devices(filter_cb=lambda device: device.find_action("SetAVTransportURI"), registry=None):
+    ''' By default get only UPNP devices which support casting, from the registry if given instead of discovering '''
+
+    if registry is not None:
+        devices = registry.iter_devices()
+    else:
+        devices = upnp_discover(timeout=10)
+
+    for device in devices:
+        if filter_cb(device):
+            yield device
+
+
+# LastChange state variables of AVTransportEvent
+AVTRANSPORT_EVENT_VARIABLES = {
+    'TransportState': 'transport_state',
+    'TransportStatus': 'transport_status',
+    'CurrentTransportActions': 'current_transport_actions',
+    'RelativeTimePosition': 'relative_time_position',
+    'CurrentTrackDuration': 'current_track_duration',
+    'AVTransportURI': 'av_transport_uri',
+    'NextAVTransportURI': 'next_av_transport_uri',
+}
+
+@dataclasses.dataclass
+class AVTransportEvent:
+    ''' InstanceID 0 state variables of an AVTransport event, None for variables which didn't change '''
+
+    transport_state: str = None
+    transport_status: str = None
+    current_transport_actions: str = None
+    relative_time_position: str = None
+    current_track_duration: str = None
+    av_transport_uri: str = None
+    next_av_transport_uri: str = None
+
+def _local_tag(element):
+    return element.tag.rsplit('}', 1)[-1]
+
+def _parse_AVTransport_event_bs4(data):
+    ''' Lenient (and slow) parsing for renderers which send malformed XML '''
+
+    xml_soup = bs4.BeautifulSoup(data, 'xml')
+    lastchange = xml_soup.find('LastChange')
+    if lastchange is None:
+        return
+
+    instance = bs4.BeautifulSoup(lastchange.text, 'xml').find("InstanceID", val=0)
+    if not instance:
+        return
+
+    event = AVTransportEvent()
+    for variable, field in AVTRANSPORT_EVENT_VARIABLES.items():
+        element = instance.find(variable)
+        if element is not None:
+            setattr(event, field, element.attrs.get('val'))
+
+    return event
+
+def parse_AVTransport_event(data):
+    ''' Extract the InstanceID 0 state variables of an AVTransport NOTIFY body, None if there are none '''
+
+    try:
+        lastchange = None
+        for element in ElementTree.fromstring(data).iter():
+            if _local_tag(element) == 'LastChange':
+                lastchange = element.text
+                break
+
+        if not lastchange:
+            return
+
+        for instance in ElementTree.fromstring(lastchange):
+            if _local_tag(instance) == 'InstanceID' and instance.get('val') == '0':
+                break
+        else:
+            return
+
+    except ElementTree.ParseError:
+        return _parse_AVTransport_event_bs4(data)
+
+    event = AVTransportEvent()
+    for element in instance:
+        field = AVTRANSPORT_EVENT_VARIABLES.get(_local_tag(element))
+        if field is not None:
+            setattr(event, field, element.get('val'))
+
+    return event
+
+
+DIDL_LITE_TEMPLATE = (
+    '<DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/" xmlns:dc="http://purl.org/dc/elements/1.1/" '
+    'xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" xmlns:sec="http://www.sec.co.kr/">'
+    '<item id="0" parentID="-1" restricted="1">'
+    '<dc:title>{title}</dc:title>'
+    '<upnp:class>object.item.videoItem</upnp:class>'
+    '{resources}'
+    '</item>'
+    '</DIDL-Lite>'
+)
+
+def _didl_duration(seconds):
+    return f'{seconds_to_clock(int(seconds))}.{int(seconds % 1 * 1000):03}'
+
+def make_DIDL_lite(title, url, mimetype, content_features='*', probe: MediaProbe = None, subtitles=()):
+    '''
+    DIDL-Lite metadata for SetAVTransportURI so renderers don't need to probe the url for its type, size and duration
+
+    subtitles is a list of (url, mimetype) of subtitle sidecars
+    '''
+
+    attributes = {'protocolInfo': f'http-get:*:{mimetype}:{content_features}'}
+
+    if probe is not None:
+        if probe.size:
+            attributes['size'] = probe.size
+        if probe.duration:
+            attributes['duration'] = _didl_duration(probe.duration)
+        if probe.resolution:
+            attributes['resolution'] = probe.resolution
+        if probe.bitrate:
+            attributes['bitrate'] = probe.bitrate // 8  # Bytes per second
+        if probe.audio_channels:
+            attributes['nrAudioChannels'] = probe.audio_channels
+        if probe.sample_frequency:
+            attributes['sampleFrequency'] = probe.sample_frequency
+
+    attributes_str = ''.join(f' {key}={xml_quoteattr(str(value))}' for key, value in attributes.items())
+    resources = f'<res{attributes_str}>{xml_escape(url)}</res>'
+
+    for subtitle_url, subtitle_mimetype in subtitles:
+        subtitle_type = subtitle_mimetype.split('/')[-1]
+        resources += f'<res protocolInfo="http-get:*:{subtitle_mimetype}:*">{xml_escape(subtitle_url)}</res>'
+        resources += f'<sec:CaptionInfoEx sec:type="{subtitle_type}">{xml_escape(subtitle_url)}</sec:CaptionInfoEx>'
+
+    return DIDL_LITE_TEMPLATE.format(title=xml_escape(title), resources=resources)
+
+
+class PlaybackClock(object):
+    '''
+    Local model of a renderer's playback position so relative seeks don't need a GetPositionInfo round trip
+
+    It is anchored to positions from AVTransport events and position polls, and advances while PLAYING
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.transport_state = None
+        self.duration = None
+        self.anchor_position = 0
+        self.anchor_time = 0
+        self.position_time = 0  # time.monotonic() of the last known position, 0 if never known
+
+    def _position(self, now):
+        position = self.anchor_position
+
+        if self.transport_state == 'PLAYING':
+            position += now - self.anchor_time
+
+        if self.duration:
+            position = min(position, self.duration)
+
+        return max(position, 0)
+
+    def position(self):
+        with self.lock:
+            return self._position(time.monotonic())
+
+    def age(self):
+        ''' Seconds since a position was received, None if none was '''
+
+        if not self.position_time:
+            return
+
+        return time.monotonic() - self.position_time
+
+    def anchor(self, position):
+        with self.lock:
+            self.anchor_position = position
+            self.anchor_time = self.position_time = time.monotonic()
+
+    def set_transport_state(self, transport_state):
+        with self.lock:
+            now = time.monotonic()
+
+            if transport_state in ('STOPPED', 'NO_MEDIA_PRESENT'):
+                self.anchor_position = 0
+            else:
+                self.anchor_position = self._position(now)
+
+            self.anchor_time = now
+            self.transport_state = transport_state
+
+    def set_duration(self, duration):
+        with self.lock:
+            self.duration = duration
+
+
+class RendererCapabilities(object):
+    '''
+    A renderer's GetProtocolInfo Sink list indexed by mimetype for fast "can it play this file directly?" checks
+
+    Entries with a DLNA.ORG_PN profile only accept the video codecs of the profile, entries without one accept anything
+    '''
+
+    # ffprobe video codec names to the DLNA.ORG_PN profile prefixes which contain them
+    VIDEO_CODEC_PROFILES = {
+        'h264': ('AVC_',),
+        'hevc': ('HEVC_',),
+        'mpeg2video': ('MPEG_PS_', 'MPEG_TS_', 'MPEG_ES_'),
+        'mpeg1video': ('MPEG1',),
+        'mpeg4': ('MPEG4_',),
+        'vc1': ('VC1_', 'WMVHIGH', 'WMVMED'),
+        'wmv3': ('WMVHIGH', 'WMVMED', 'WMVSPLL', 'WMVSPML'),
+    }
+
+    ANY = '*'
+
+    def __init__(self, sink):
+        self.sink = sink or ''
+        self.codecs = {}  # mimetype -> set of playable video codecs, or ANY
+
+        for protocol_info in self.sink.split(','):
+            fields = protocol_info.strip().split(':')
+            if len(fields) != 4 or fields[0] not in ('http-get', '*'):
+                continue
+
+            mimetype = fields[2].lower()
+            profiles = [param[len('DLNA.ORG_PN='):] for param in fields[3].split(';') if param.startswith('DLNA.ORG_PN=')]
+
+            if not profiles:
+                self.codecs[mimetype] = self.ANY
+                continue
+
+            codecs = self.codecs.setdefault(mimetype, set())
+            if codecs is self.ANY:
+                continue
+
+            for codec, prefixes in self.VIDEO_CODEC_PROFILES.items():
+                if any(profile.startswith(prefixes) for profile in profiles):
+                    codecs.add(codec)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({len(self.codecs)} mimetypes)'
 
-            if not filter_cb(metadata):
+    def can_play(self, mimetypes, probe: MediaProbe = None):
+        ''' Whether the renderer lists one of the mimetypes with the probed video codec '''
+
+        for mimetype in mimetypes:
+            if not mimetype:
                 continue
-                
-            yield metadata
 
-    def __init__(self, ffmpeg_path='ffmpeg'):
-        self.ffmpeg_path = ffmpeg_path
-        self.threads = []
-        self.running_identifiers = set()
-        self.convertions = []
+            codecs = self.codecs.get(mimetype.lower(), self.codecs.get('*'))
+            if codecs is None:
+                continue
 
-    def _convert_file_thread(self, metadata):
-        LOGGER.info(f'STARTING CONVERTION THREAD FOR {metadata}')
+            if codecs is self.ANY or probe is None or probe.video_codec is None:
+                return True
 
-        input_path = metadata.get('original_file')
-        output_path = metadata.get('converted_file')
+            if probe.video_codec in codecs:
+                return True
 
-        if not input_path or not output_path:
-            LOGGER.error(f'CONVERSION REQUIRES original_file({input_path}) and converted_file({output_path})')
-            return
+        return False
 
-        self.convertions.append(metadata)
 
-        codec_switches = metadata.get('ffmpeg_codec_switches')
-        identifier = metadata.get('identifier')
+class RendererCapabilityCache(object):
+    '''
+    Persistent cache of renderers' GetProtocolInfo Sink lists so they're only fetched once per renderer
 
-        if identifier:
-            self.running_identifiers.add(identifier)
+    Keyed by UDN and firmware (model name and number), a renderer reporting another firmware is fetched again
+    '''
 
-        cmd = self.COMMAND_TEMPLATE.format(ffmpeg_path=self.ffmpeg_path,
-                                           input_path=input_path,
-                                           codec_switches=codec_switches,
-                                           output_path=output_path)
+    def __init__(self, path=getattr(config, 'RENDERER_CAPABILITIES_PATH', 'renderer_capabilities.json')):
+        self.path = path
+        self.lock = threading.Lock()
+        self.sinks = self._load()
+        self.capabilities = {}
+
+    def _load(self):
         try:
-            output = execute_shell(cmd)
-            # TODO: Save video metadata from ffmpeg output
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            LOGGER.exception(f'Failed loading renderer capabilities from {self.path}')
+            return {}
 
-            LOGGER.info(f'Finished converting {input_path} -> {output_path} ({identifier}):\n{output}')
-        except:
-            LOGGER.info(f'Failed converting {input_path} -> {output_path} ({identifier}) !!!')
-        finally:
-            if identifier:
-                self.running_identifiers.remove(identifier)
-    
-    def start_conversion_thread(self, metadata):
-        t = threading.Thread(target=self._convert_file_thread, args=[metadata])
-        self.threads.append(t)
-        t.start()
+    def _save(self):
+        tmp_path = f'{self.path}.tmp'
 
-    def convert_file(self, filepath, output_path=None, codec_switches=DEFAULT_CODEC_SWITCHES,
-                     **metadatas):
-        
-        if not filepath or not os.path.isfile(filepath):
-            LOGGER.error(f'No such file {filepath}')
-            return
-        
-        if output_path is None:
-            output_path = f'{filepath}_converted.mp4'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.sinks, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            LOGGER.exception(f'Failed saving renderer capabilities to {self.path}')
 
-        metadata_path = self.output_to_metadata_path(output_path)
+    @staticmethod
+    def make_key(device):
+        return f"{device.udn}|{getattr(device, 'model_name', '')}|{getattr(device, 'model_number', '')}"
 
-        with open(metadata_path, 'w') as metadata_file:
-            metadata = {
-                'original_file': filepath,
-                'converted_file': output_path,
-                'ffmpeg_codec_switches': codec_switches,
-                'identifier': random_identifier(),
-                'time': time.time(),
-            }
+    def get(self, device, fetch_sink_cb):
+        ''' Get the RendererCapabilities of the device, fetch_sink_cb() is only called if its Sink isn't cached '''
 
-            for k, v in metadatas.items():
-                metadata[k] = v
+        key = self.make_key(device)
 
-            metadata_file.write(json.dumps(metadata, indent=2))
+        with self.lock:
+            capabilities = self.capabilities.get(key)
+            if capabilities is not None:
+                return capabilities
 
-        self.start_conversion_thread(metadata)
-        return metadata
+            sink = self.sinks.get(key)
 
+        if sink is None:
+            sink = fetch_sink_cb()
+            if sink is None:
+                return
 
-######################################################################
-# File convertion menu
-######################################################################
+            with self.lock:
+                # Forget the Sink of older firmwares
+                for old_key in [k for k in self.sinks if k.startswith(f'{device.udn}|')]:
+                    del self.sinks[old_key]
 
+                self.sinks[key] = sink
+                self._save()
 
-class FileConvertionMenu(TorrentMenu):
-    DEFAULT_LAYOUT = [
-        ['convert_torrent_file', 'delete_file_convertion'],
-        ['list_converted_files', 'list_active_convertions'],
-        ['back']
-    ]
-    
-    def __init__(self, file_converter: FileConverter, *args, on_complete=None, layout=DEFAULT_LAYOUT, **kwargs):
-        super().__init__(*args, layout=layout, **kwargs)
+        capabilities = RendererCapabilities(sink)
 
-        self.file_converter = file_converter
-        self.on_complete = on_complete
+        with self.lock:
+            self.capabilities[key] = capabilities
 
-        self.create_torrent_file_handler('convert_torrent_file', self._convert_torrent_file_cb)
+        return capabilities
 
-        process_delete_file_cb = self.cancelable(self._delete_file_convertion_process_choice)
-        self.register_callback('_delete_file_convertion_process_choice', process_delete_file_cb)
+    def invalidate(self, device):
+        key = self.make_key(device)
 
-    async def back(self, update, context):
-        if self.on_complete:
-            return await call_callback(self.on_complete, update, context)
-        
-        return ConversationHandler.END
+        with self.lock:
+            self.capabilities.pop(key, None)
+            if self.sinks.pop(key, None) is not None:
+                self._save()
 
-    async def _convert_torrent_file_cb(self, update, torrent_file):
-        # on_complete in self.create_torrent_file_handler() call will make this return to self._main_menu
 
-        if torrent_file.completed < torrent_file.size or not torrent_file.size:
-            await reply(update, f'Warning: Torrent file download not complete: {torrent_file.completed} / {torrent_file.size}')
+class GENASubscription(object):
+    ''' A GENA event subscription to a device's service, shared by all of its listeners '''
 
-        fp = transmission_utils.torrent_file_to_path(torrent_file)
-        if not fp:
-            await reply(update, f'Invalid input')
-            return
+    def __init__(self, device, service_name, callback_href):
+        self.device = device
+        self.service_name = service_name
+        self.callback_href = callback_href
 
-        metadata = self.file_converter.convert_file(fp,
-                                                    torrent_id=torrent_file.torrent_id,
-                                                    file_id=torrent_file.file_id)
-        if metadata:
-            await multi_reply(update, f'Started convertion', metadata)
-        else:
-            await reply(update, 'Failed to start convertion')
+        self.sid = ''
+        self.timeout = None
+        self.expires = 0
+        self.listeners = []
+        self.renew_timer = None
 
-    async def list_converted_files(self, update, context):
-        for metadata in self.file_converter.iter_convertion_metadatas():
-            identifier = metadata.get('identifier')
+        # Serializes this subscription's SUBSCRIBE/RENEW requests without blocking other devices
+        self.lock = threading.Lock()
 
-            if not identifier:
-                metadata['active'] = 'unknown'
-            elif identifier in self.file_converter.running_identifiers:
-                metadata['active'] = True
-            else:
-                metadata['active'] = False
+    @property
+    def service(self):
+        return getattr(self.device, self.service_name)
 
-            await reply(update, f'Converted file metadata:\n{json.dumps(metadata, indent=2)}')
-        return await self._main_menu(update, context)
+    def __repr__(self):
+        return f'<GENASubscription {self.service_name} {self.device} sid={self.sid}>'
 
-    async def delete_file_convertion(self, update, context):
-        userdata = self.get_userdata(update)
 
-        convertions = list(m for m in self.file_converter.iter_convertion_metadatas()
-                           if m.get('identifier', 'FAKEIFDSFDSFD') not in self.file_converter.running_identifiers)
-        userdata['ConvertedFiles_list'] = convertions
+class GENASubscriptionManager(object):
+    '''
+    Keep one GENA subscription per device service, shared across casts and users
 
-        await self.prompt_list(update, 'Choose converted file:', [c.get("converted_file") for c in convertions])
-        return self.prefix_menu('_delete_file_convertion_process_choice')
+    Subscriptions are renewed by SID on a timer before they expire,
+    failed renewals fall back to a new subscription and are retried until they succeed.
+    NOTIFY events are read once and passed to every listener as listener(data)
+    '''
 
-    async def _delete_file_convertion_process_choice(self, update, context):
-        userdata = self.get_userdata(update)
-        convertions = userdata.get('ConvertedFiles_list', [])
+    RETRY_INTERVAL = 30
 
-        i = self.choice_to_number(get_text(update))
+    def __init__(self, server: HTTPTorrentServer,
+                 requested_timeout=getattr(config, 'GENA_SUBSCRIPTION_TIMEOUT', 1800)):
+        self.server = server
+        self.requested_timeout = requested_timeout
 
-        if i is not None and 0 <= i < len(convertions):
-            convertion = convertions[i]
+        self.lock = threading.RLock()
+        self.subscriptions = {}  # (UDN, service name) -> GENASubscription
 
-            output_path = convertion.get('converted_file')
-            metadata_path = self.file_converter.output_to_metadata_path(output_path)
-            
-            try:
-                os.unlink(output_path)
+    def make_url(self, device, href):
+        port = self.server.server_address[1]
+        return f'http://{device.iface_ip}:{port}{href}'
+
+    def get_subscription(self, device, service_name):
+        return self.subscriptions.get((device.udn, service_name))
+
+    def subscribe(self, device, service_name, listener):
+        '''
+        Add a listener to the device service's events, subscribing only if nobody is subscribed yet
+
+        The manager's lock only guards the subscriptions and their listeners, SUBSCRIBE requests are sent
+        outside of it so an unreachable device doesn't stall the others
+        '''
+
+        with self.lock:
+            subscription = self.get_subscription(device, service_name)
+
+            if subscription is None:
+                callback_href = make_href(HTTPTorrentServerHandler.HREF_AVTRANSPORT, random_identifier())
+                subscription = GENASubscription(device, service_name, callback_href)
+
+                if not self.server.started:
+                    self.server.start_threads()
 
+                self.server.register_NOTIFY_callback(callback_href, functools.partial(self._NOTIFY_cb, subscription))
+                self.subscriptions[(device.udn, service_name)] = subscription
+
+            if listener not in subscription.listeners:
+                subscription.listeners.append(listener)
+
+        with subscription.lock:
+            if subscription.sid:
+                return subscription
+
+            try:
+                self._subscribe(subscription)
             except:
-                msg = repr_action(update, f'failed to delete data file {output_path}')
-                LOGGER.info(msg)
-                await reply(update, msg)
+                with self.lock:
+                    if listener in subscription.listeners:
+                        subscription.listeners.remove(listener)
+
+                    if not subscription.listeners:
+                        self._remove(subscription)
+                raise
+
+        return subscription
+
+    def unsubscribe(self, device, service_name, listener):
+        ''' Remove a listener, cancelling the subscription once it has no listeners '''
+
+        with self.lock:
+            subscription = self.get_subscription(device, service_name)
+            if subscription is None:
+                return
+
+            if listener in subscription.listeners:
+                subscription.listeners.remove(listener)
+
+            if subscription.listeners:
+                return
+
+            self._remove(subscription)
+
+        self._cancel(subscription)
+
+    def _cancel(self, subscription):
+        if not subscription.sid:
+            return
+
+        try:
+            subscription.service.cancel_subscription(subscription.sid)
+        except Exception as e:
+            LOGGER.info(f'Failed cancelling {subscription}: {e}')
+
+    def is_active(self, subscription):
+        return self.get_subscription(subscription.device, subscription.service_name) is subscription
+
+    def _remove(self, subscription):
+        if subscription.renew_timer is not None:
+            subscription.renew_timer.cancel()
+
+        self.server.unregister_NOTIFY_callback(subscription.callback_href)
+        self.subscriptions.pop((subscription.device.udn, subscription.service_name), None)
 
+    def _subscribe(self, subscription):
+        url = self.make_url(subscription.device, subscription.callback_href)
+        subscription.sid, timeout = subscription.service.subscribe(url, timeout=self.requested_timeout)
+
+        LOGGER.info(f'Subscribed {subscription} for {timeout}s')
+        self._schedule_renewal(subscription, timeout)
+
+    def _schedule_renewal(self, subscription, timeout, delay=None):
+        subscription.timeout = timeout
+
+        if timeout is None:
+            # "Second-infinite" subscriptions don't expire
+            subscription.expires = 0
+            return
+
+        subscription.expires = time.time() + timeout
+
+        if delay is None:
+            # Renew a bit before expiry to account for slow devices
+            delay = max(timeout - min(60, timeout / 4), 1)
+
+        with self.lock:
+            active = self.is_active(subscription)
+
+            if active:
+                subscription.renew_timer = threading.Timer(delay, self._renew, args=[subscription])
+                subscription.renew_timer.daemon = True
+                subscription.renew_timer.start()
+
+        # Unsubscribed while its request was running
+        if not active:
+            self._cancel(subscription)
+
+    def _renew(self, subscription):
+        if not self.is_active(subscription):
+            return
+
+        with subscription.lock:
+            try:
+                timeout = subscription.service.renew_subscription(subscription.sid, timeout=self.requested_timeout)
+            except Exception as e:
+                LOGGER.warning(f'Failed renewing {subscription}, subscribing again: {e}')
             else:
-                msg = repr_action(update, f'deleted data file {output_path}')
-                LOGGER.info(msg)
-                await reply(update, msg)
+                LOGGER.info(f'Renewed {subscription} for {timeout}s')
+                self._schedule_renewal(subscription, timeout)
+                return
 
             try:
-                os.unlink(metadata_path)
+                self._subscribe(subscription)
+            except Exception as e:
+                LOGGER.warning(f'Failed subscribing {subscription}, retrying in {self.RETRY_INTERVAL}s: {e}')
+                self._schedule_renewal(subscription, subscription.timeout, delay=self.RETRY_INTERVAL)
+
+    def _NOTIFY_cb(self, subscription, httphandler: HTTPTorrentServerHandler):
+        try:
+            size = int(httphandler.headers.get('Content-Length'))
+            data = httphandler.rfile.read(size)
+        except:
+            httphandler._send_default_headers('error_callback', 0)
+            return
+
+        httphandler._send_default_headers('callback', 0)
+
+        sid = httphandler.headers.get('SID')
+        if sid and subscription.sid and sid != subscription.sid:
+            LOGGER.info(f'Ignoring NOTIFY for stale SID {sid} of {subscription}')
+            return
+
+        with self.lock:
+            listeners = list(subscription.listeners)
 
+        for listener in listeners:
+            try:
+                listener(data)
             except:
-                msg = repr_action(update, f'failed to delete metadata file {metadata_path}')
-                LOGGER.info(msg)
-                await reply(update, msg)
+                LOGGER.exception(f'NOTIFY listener {listener} of {subscription} failed')
 
-            else:
-                msg = repr_action(update, f'deleted metadata file {output_path}')
-                LOGGER.info(msg)
-                await reply(update, msg)
 
-        return await self._main_menu(update, context)
-            
-    async def list_active_convertions(self, update, context):
-        identifiers = self.file_converter.running_identifiers.copy()
-        for convertion in self.file_converter.convertions:
+@dataclasses.dataclass
+class CastItem:
+    ''' A queued torrent file prepared for casting: served, probed and optionally preloaded with SetNextAVTransportURI '''
 
-            if convertion.get('identifier') in identifiers:
-                await reply(update, f'File convertion:\n{json.dumps(convertion, indent=2)}')
+    torrent_file: object
+    filepath: str
+    href: str
+    transcoded: bool = False
+    didl_metadata: str = ''
+    subtitle_hrefs: list = dataclasses.field(default_factory=list)
+    preloaded: bool = False
 
-        return await self._main_menu(update, context)
 
+class UPNPDeviceControl(object):
+    '''
+    Control a UPnP renderer with SOAP actions
 
-######################################################################
-# UPnP control
-######################################################################
+    Actions are sent over a keep-alive HTTP session with a timeout,
+    and run() executes them on a bounded executor serialized per device so the bot's event loop isn't blocked
+    '''
 
+    SOAP_ENVELOPE = ('<?xml version="1.0" encoding="utf-8"?>'
+                     '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+                     's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+                     '<s:Body><u:{action} xmlns:u="{service_type}">{arguments}</u:{action}></s:Body>'
+                     '</s:Envelope>')
 
-def iter_UPNP_devices(filter_cb=lambda device: device.find_action("SetAVTransportURI")):
-    ''' By default get only UPNP devices which support casting '''
-    for device in upnp_discover(timeout=10):
-        if filter_cb(device):
-            yield device
+    ACTION_TIMEOUT = getattr(config, 'UPNP_ACTION_TIMEOUT', 5)
 
+    # Relative seeks within this many seconds of each other are sent as one Seek
+    SEEK_DEBOUNCE = 0.7
 
-class UPNPDeviceControl(object):
-    def __init__(self, server: HTTPTorrentServer, device: UPNPDevice):
+    # Re-anchor the playback clock with GetPositionInfo if no position was received for this many seconds
+    POSITION_MAX_AGE = 60
+
+    # Used when the renderer's Volume state variable has no allowedValueRange
+    DEFAULT_MAX_VOLUME = 100
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=getattr(config, 'UPNP_ACTION_WORKERS', 4),
+                                                     thread_name_prefix='upnp_action')
+
+    def __init__(self, server: HTTPTorrentServer, device: 'dlna_cast_ssdp.Device', subscriptions: GENASubscriptionManager = None,
+                 capabilities: RendererCapabilityCache = None):
         self.server = server
         self.device = device
+        self.subscriptions = subscriptions or GENASubscriptionManager(server)
+        self.capabilities = capabilities or RendererCapabilityCache()
+
+        self.lock = threading.RLock()
+        self.session = requests.Session()
 
         self.cast_state = ''
+        self.max_volume = None
+
+        self.avtransport_subscribed = False
+        self.events_lock = threading.Lock()
+        self.events = collections.deque()  # AVTransportEvents waiting to be applied on the executor, in arrival order
+        self.processing_events = False
+
+        self.clock = PlaybackClock()
+        self.pending_seek = 0
+        self.seek_timer = None
+        self.seek_error_callbacks = {}  # requester -> on_error of the pending seek
 
-        self.avtransport_href = ''
-        self.avtransport_sid = ''
-        self.avtransport_timeout = self.avtransport_start = 0
+        self.queue = collections.deque()  # TorrentFiles to play after the current video
+        self.next_item = None  # CastItem of self.queue[0] once it's prepared
 
         self.video_href = ''
+        self.video_filepath = ''
         self.video_didl_metadata = ''
+        self.subtitle_hrefs = []
 
     def __del__(self):
-        self.unregister_video_file()
-        self.unsubscribe_avtransport()
+        self.close()
+
+    def close(self):
+        ''' Drop everything the controller registered: its queue, file mappings and AVTransport subscription '''
+
+        with self.lock:
+            if self.seek_timer is not None:
+                self.seek_timer.cancel()
+                self.seek_timer = None
+
+            self.clear_queue()
+            self.unregister_video_file()
+            self.unsubscribe_avtransport()
+
+        with self.events_lock:
+            self.events.clear()
+
+    def is_casting(self):
+        ''' Whether a cast is starting or the renderer is still playing (or paused on) it '''
+
+        if self.cast_state in ('registered', 'sent_uri', 'sent_play'):
+            return True
+
+        return self.cast_state == 'playing' and \
+            self.clock.transport_state not in ('STOPPED', 'NO_MEDIA_PRESENT')
 
     def make_url(self, postfix=''):
         ip = self.device.iface_ip  # Use the IP of the interface connected to the device
@@ -692,17 +3102,89 @@ class UPNPDeviceControl(object):
         return f'http://{ip}:{port}{postfix}'
     
     def get_action(self, action, default=lambda *args, **kwargs: None):
-        action = self.device.find_action(action)
+        action_name = action
+        action = self.device.find_action(action_name)
 
         if action is None:
-            LOGGER.warn(f'No such action {action}')
+            LOGGER.warn(f'No such action {action_name}')
             return default
         
-        return action
+        return functools.partial(self.call_action, action)
 
-    def send_play(self, InstanceID=0, Speed=None):
-        self.subscribe_avtransport()
+    @staticmethod
+    def validate_arguments(action, kwargs):
+        ''' Check arguments against the action's argsdef_in like upnpclient's Action() does, raises UPNPError/ValidationError '''
+
+        unknown = set(kwargs) - {name for name, _ in action.argsdef_in}
+        if unknown:
+            raise upnpclient_upnp.UPNPError(f'Unknown params {sorted(unknown)} for {action.name}')
+
+        reasons = {}
+        for name, statevar in action.argsdef_in:
+            if name not in kwargs:
+                raise upnpclient_upnp.UPNPError(f"Missing required param '{name}' for {action.name}")
+
+            # Values are sent as text, validate them the same way
+            valid, arg_reasons = action.validate_arg(str(kwargs[name]), statevar)
+            if not valid:
+                reasons[name] = arg_reasons
+
+        if reasons:
+            raise upnpclient_upnp.ValidationError(reasons)
+
+    def call_action(self, action, **kwargs):
+        ''' Validate and send a SOAP action over the device's keep-alive session and marshal the response '''
+
+        self.validate_arguments(action, kwargs)
+
+        arguments = ''.join(f'<{name}>{xml_escape(str(kwargs[name]))}</{name}>' for name, _ in action.argsdef_in)
+        body = self.SOAP_ENVELOPE.format(action=action.name, service_type=action.service_type, arguments=arguments)
+        headers = {
+            'Content-Type': 'text/xml; charset="utf-8"',
+            'SOAPAction': f'"{action.service_type}#{action.name}"',
+        }
+
+        with self.lock, TRACER.span(f'SOAP {action.name}', 'soap', device=getattr(self.device, 'friendly_name', self.device)):
+            resp = self.session.post(action.url, data=body.encode('utf-8'), headers=headers, timeout=self.ACTION_TIMEOUT)
+
+        if resp.status_code >= 400:
+            raise IOError(f'{action.name} failed with HTTP {resp.status_code}: {resp.text[:200]}')
+
+        response_tag = f'{action.name}Response'
+        response = None
+        for element in ElementTree.fromstring(resp.content).iter():
+            if element.tag.split('}')[-1] == response_tag:
+                response = element
+                break
 
+        if response is None:
+            raise IOError(f'{action.name} response is missing {response_tag}')
+
+        values = {child.tag.split('}')[-1]: child.text or '' for child in response}
+
+        ret = {}
+        for name, statevar in action.argsdef_out:
+            if name in values:
+                _, ret[name] = upnpclient_marshal.marshal_value(statevar['datatype'], values[name])
+
+        return ret
+
+    def _run_locked(self, method, *args, **kwargs):
+        with self.lock:
+            return method(*args, **kwargs)
+
+    async def run(self, method, *args, timeout=None, **kwargs):
+        ''' Run a (blocking) control method off the event loop, serialized with the device's other actions '''
+
+        if timeout is None:
+            timeout = 3 * self.ACTION_TIMEOUT
+
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        future = loop.run_in_executor(self.executor, functools.partial(context.run, self._run_locked, method, *args, **kwargs))
+        return await asyncio.wait_for(future, timeout)
+
+    def send_play(self, InstanceID=0, Speed=None):
         LOGGER.info(f"SENDING PLAY to {self.device}")
 
         if Speed is None:
@@ -712,26 +3194,18 @@ class UPNPDeviceControl(object):
         return self.get_action('Play')(InstanceID=InstanceID, Speed=Speed)
 
     def send_pause(self, InstanceID=0):
-        self.subscribe_avtransport()
-
         LOGGER.info(f"SENDING PAUSE to {self.device}")
         return self.get_action('Pause')(InstanceID=InstanceID)
 
     def send_stop(self, InstanceID=0):
-        self.subscribe_avtransport()
-
         LOGGER.info(f"SENDING STOP to {self.device}")
         return self.get_action('Stop')(InstanceID=InstanceID)
 
     def send_mute(self, InstanceID=0, Channel='Master', DesiredMute=1):
-        self.subscribe_avtransport()
-
         LOGGER.info(f"SENDING MUTE {DesiredMute} to {self.device}")
         return self.get_action('Mute')(InstanceID=InstanceID, Channel=Channel, DesiredMute=DesiredMute)
 
     def send_uri(self, url, InstanceID=0, CurrentURIMetaData=''):
-        self.subscribe_avtransport()
-
         LOGGER.info(f"SENDING URI {url} to {self.device}")
         return self.get_action('SetAVTransportURI')(
                                             InstanceID=InstanceID,
@@ -739,21 +3213,24 @@ class UPNPDeviceControl(object):
                                             CurrentURIMetaData=CurrentURIMetaData
                                             )
     
-    def get_position_info(self, InstanceID=0):
-        self.subscribe_avtransport()
+    def send_next_uri(self, url, InstanceID=0, NextURIMetaData=''):
+        LOGGER.info(f"SENDING NEXT URI {url} to {self.device}")
+        return self.get_action('SetNextAVTransportURI')(
+                                            InstanceID=InstanceID,
+                                            NextURI=url,
+                                            NextURIMetaData=NextURIMetaData
+                                            )
 
+    def get_position_info(self, InstanceID=0):
         LOGGER.info(f"GETTING POSITION INFO from {self.device}")
         return self.get_action('GetPositionInfo')(InstanceID=InstanceID) or {}
     
-    def get_protocol_info(self, InstanceID=0):
-        self.subscribe_avtransport()
-
+    def get_protocol_info(self):
+        # A ConnectionManager action, it takes no InstanceID
         LOGGER.info(f"GETTING PROTOCOL INFO from {self.device}")
-        return self.get_action('GetProtocolInfo')(InstanceID=InstanceID) or {}
+        return self.get_action('GetProtocolInfo')() or {}
 
     def get_volume(self, InstanceID=0, Channel='Master'):
-        self.subscribe_avtransport()
-
         LOGGER.info(f"GETTING VOLUME from {self.device}")
         ret = self.get_action('GetVolume')(InstanceID=InstanceID, Channel=Channel)
 
@@ -761,14 +3238,114 @@ class UPNPDeviceControl(object):
             return ret.get('CurrentVolume')
 
     def set_volume(self, DesiredVolume=0, InstanceID=0, Channel='Master'):
-        self.subscribe_avtransport()
-
         LOGGER.info(f"SETTING VOLUME on {self.device}")
         return self.get_action('SetVolume')(InstanceID=InstanceID, Channel=Channel, DesiredVolume=DesiredVolume)
 
-    def send_seek(self, location, relative=False, InstanceID=0, Unit='REL_TIME'):
-        self.subscribe_avtransport()
+    def get_max_volume(self):
+        ''' Maximum of the Volume state variable's allowedValueRange, DEFAULT_MAX_VOLUME if the renderer doesn't list it '''
+
+        if self.max_volume is not None:
+            return self.max_volume
+
+        self.max_volume = self.DEFAULT_MAX_VOLUME
+
+        # upnpclient only parses allowedValueList, read the range from the service description
+        action = self.device.find_action('SetVolume')
+        try:
+            for statevar in action.service.scpd_xml.iter('{*}stateVariable'):
+                if statevar.findtext('{*}name', '').strip() == 'Volume':
+                    self.max_volume = int(statevar.findtext('{*}allowedValueRange/{*}maximum').strip())
+                    break
+        except (AttributeError, TypeError, ValueError):
+            LOGGER.info(f'No Volume range for {self.device}, using {self.max_volume}')
+
+        return self.max_volume
+
+    def change_volume(self, delta, InstanceID=0, Channel='Master'):
+        volume = self.get_volume(InstanceID=InstanceID, Channel=Channel) or 0
+        volume = min(max(volume + delta, 0), self.get_max_volume())
+        return self.set_volume(DesiredVolume=volume, InstanceID=InstanceID, Channel=Channel)
+
+    def get_renderer_capabilities(self):
+        return self.capabilities.get(self.device, lambda: self.get_protocol_info().get('Sink'))
+
+    def can_play_file(self, filepath):
+        ''' Whether the renderer can play the file without converting it, None if its capabilities are unknown '''
+
+        capabilities = self.get_renderer_capabilities()
+        if capabilities is None:
+            return
+
+        # The served mimetype may be overridden, the renderer might only list the original one
+        candidates = (HTTPTorrentServerHandler.guess_mimetype(filepath),
+                      mimetypes.guess_type(os.path.basename(filepath))[0])
+        return capabilities.can_play(candidates, probe_media(filepath))
+
+    def poll_position(self, InstanceID=0):
+        ''' Re-anchor the playback clock with the renderer's position '''
+
+        position_info = self.get_position_info(InstanceID=InstanceID)
+
+        try:
+            self.clock.anchor(clock_to_seconds(position_info.get('RelTime')))
+        except (AttributeError, ValueError):
+            LOGGER.info(f'Invalid position {position_info} from {self.device}')
+
+        try:
+            self.clock.set_duration(clock_to_seconds(position_info.get('TrackDuration')))
+        except (AttributeError, ValueError):
+            pass
+
+    def seek_relative(self, seconds, on_error=None, requester=None):
+        '''
+        Queue a relative seek, rapid consecutive calls are merged into one Seek
+
+        If the merged Seek fails on_error(exception) is called from the timer thread, once per requester
+        '''
+
+        with self.lock:
+            self.pending_seek += seconds
+
+            if on_error is not None:
+                self.seek_error_callbacks[requester] = on_error
+
+            if self.seek_timer is not None:
+                self.seek_timer.cancel()
+
+            self.seek_timer = threading.Timer(self.SEEK_DEBOUNCE, self._flush_seek)
+            self.seek_timer.daemon = True
+            self.seek_timer.start()
+
+    def _flush_seek(self, InstanceID=0):
+        with self.lock:
+            seconds, self.pending_seek = self.pending_seek, 0
+            error_callbacks, self.seek_error_callbacks = self.seek_error_callbacks, {}
+            self.seek_timer = None
+
+            if not seconds:
+                return
+
+            try:
+                age = self.clock.age()
+                if age is None or age > self.POSITION_MAX_AGE:
+                    self.poll_position(InstanceID=InstanceID)
+
+                location = int(max(self.clock.position() + seconds, 0))
+                self.send_seek(seconds_to_clock(location), InstanceID=InstanceID)
+                self.clock.anchor(location)
+                return
+
+            except Exception as e:
+                LOGGER.exception(f'Failed seeking {seconds}s on {self.device}')
+                error = e
+
+        for on_error in error_callbacks.values():
+            try:
+                on_error(error)
+            except Exception:
+                LOGGER.exception(f'Seek error callback {on_error} failed')
 
+    def send_seek(self, location, relative=False, InstanceID=0, Unit='REL_TIME'):
         # pi = self.get_position_info()
         # pi.get('RelTime')
         if isinstance(location, int):
@@ -777,21 +3354,24 @@ class UPNPDeviceControl(object):
         LOGGER.info(f"SEEKING TO {location} on {self.device}")
         return self.get_action('Seek')(InstanceID=InstanceID, Unit=Unit, Target=location) or {}
 
-    def play_file(self, filepath):
+    def play_file(self, filepath, size_cb=None):
+        ''' size_cb() is used to serve the file while it's still being written, see HTTPTorrentServer.register_growing_file() '''
+
         self.unregister_video_file()
-        self.send_stop()
+        self.stop()
 
         video_href = make_href(HTTPTorrentServerHandler.HREF_FILE,
                                 random_identifier(),
                                 'video.mp4')
 
         self.cast_state = 'registered'
-        self.register_video_file(video_href, filepath)
-        self.resubscribe_avtransport()
+        self.register_video_file(video_href, filepath, size_cb=size_cb)
+        self.prepare_video_metadata(filepath, probe=size_cb is None)
+        self.start_cast()
 
     def play_torrent_file(self, torrent_file):
         self.unregister_video_file()
-        self.send_stop()
+        self.stop()
 
         fp = transmission_utils.torrent_file_to_path(torrent_file)
 
@@ -801,81 +3381,491 @@ class UPNPDeviceControl(object):
 
         self.cast_state = 'registered'
         self.register_video_file(video_href, fp)
-        self.resubscribe_avtransport()
+        self.prepare_video_metadata(fp)
+        self.start_cast()
+
+    def play_torrent_file_transcoded(self, torrent_file):
+        ''' Cast a live transcode of the torrent file, nothing is written to disk '''
+
+        self.unregister_video_file()
+        self.stop()
+
+        self.video_href = make_href(HTTPTorrentServerHandler.HREF_TRANSCODE,
+                                    torrent_file.torrent_id, torrent_file.file_id,
+                                    'video.mp4')
+
+        self.cast_state = 'registered'
+        self.prepare_video_metadata(transmission_utils.torrent_file_to_path(torrent_file), transcoded=True)
+        self.start_cast()
 
-    def register_video_file(self, video_href, filepath):
+    def register_video_file(self, video_href, filepath, size_cb=None):
         self.video_href = video_href
+        self.video_filepath = filepath
         self.server.register_file_mapping(video_href, filepath)
 
+        if size_cb is not None:
+            self.server.register_growing_file(filepath, size_cb)
+
+    def prepare_video_metadata(self, filepath, transcoded=False, probe=True):
+        self.video_didl_metadata, self.subtitle_hrefs = self.make_video_metadata(self.video_href, filepath,
+                                                                                 transcoded=transcoded, probe=probe)
+
+    def make_video_metadata(self, video_href, filepath, transcoded=False, probe=True):
+        '''
+        Build the DIDL-Lite sent with the video url from a (cached) probe of the file and register its subtitle sidecars
+
+        Files which are still being written aren't probed since their size and duration aren't final
+
+        Returns (DIDL-Lite, subtitle hrefs)
+        '''
+
+        if transcoded:
+            mimetype = self.server.live_transcoder.content_type
+            content_features = HTTPTorrentServerHandler.TRANSCODE_CONTENT_FEATURES
+        else:
+            mimetype = HTTPTorrentServerHandler.guess_mimetype(filepath) or 'video/mp4'
+            content_features = HTTPTorrentServerHandler.CONTENT_FEATURES
+
+        media_probe = None
+        if probe:
+            try:
+                media_probe = probe_media(filepath)
+            except OSError:
+                LOGGER.info(f'Failed probing {filepath}')
+
+        if media_probe is not None and transcoded:
+            # Only the duration and resolution are kept by the live transcode
+            media_probe = MediaProbe(duration=media_probe.duration, resolution=media_probe.resolution)
+
+        subtitles = []
+        subtitle_hrefs = []
+        for subtitle_path in find_subtitle_sidecars(filepath):
+            ext = os.path.splitext(subtitle_path)[1].lower()
+            href = make_href(HTTPTorrentServerHandler.HREF_FILE, random_identifier(), f'subtitle{ext}')
+
+            self.server.register_file_mapping(href, subtitle_path)
+            subtitle_hrefs.append(href)
+            subtitles.append((self.make_url(href), SUBTITLE_MIMETYPES[ext]))
+
+        didl_metadata = make_DIDL_lite(os.path.basename(filepath), self.make_url(video_href),
+                                       mimetype, content_features=content_features,
+                                       probe=media_probe, subtitles=subtitles)
+        return didl_metadata, subtitle_hrefs
+
     def unregister_video_file(self):
+        for href in self.subtitle_hrefs:
+            self.server.unregister_file_mapping(href)
+        self.subtitle_hrefs = []
+        self.video_didl_metadata = ''
+
         if not self.video_href:
             return
         self.server.unregister_file_mapping(self.video_href)
-        self.video_href = ''
+        self.server.unregister_growing_file(self.video_filepath)
+        self.server.media_requests.stop(self.video_href)
+        self.video_href = self.video_filepath = ''
 
-    def resubscribe_avtransport(self):
-        self.unsubscribe_avtransport()
-        self.subscribe_avtransport()
+    ###############
+    # Play queue
+    def prepare_cast_item(self, torrent_file):
+        ''' Serve the file (or its live transcode if the renderer can't play it), build its metadata and warm its data '''
 
-    def subscribe_avtransport(self):
-        if self.avtransport_href:
-            return
+        fp = transmission_utils.torrent_file_to_path(torrent_file)
 
-        if not self.server.started:
-            self.server.start_threads()
+        try:
+            transcoded = self.can_play_file(fp) is False
+        except Exception:
+            LOGGER.exception(f'Failed checking if {self.device} can play {fp}')
+            transcoded = False
+
+        if transcoded:
+            href = make_href(HTTPTorrentServerHandler.HREF_TRANSCODE,
+                             torrent_file.torrent_id, torrent_file.file_id,
+                             'video.mp4')
+        else:
+            # Mapped files are served without asking transmission for the torrent file's path on every request
+            href = make_href(HTTPTorrentServerHandler.HREF_FILE,
+                             random_identifier(),
+                             'video.mp4')
+            self.server.register_file_mapping(href, fp)
 
-        self.avtransport_href = make_href(HTTPTorrentServerHandler.HREF_AVTRANSPORT, random_identifier())
+            threading.Thread(target=warm_file, args=[fp], daemon=True).start()
 
-        url = self.make_url(self.avtransport_href)
-        self.server.register_NOTIFY_callback(self.avtransport_href, self.AVTransport_cb)
-        self.avtransport_sid, self.avtransport_timeout = self.device.AVTransport.subscribe(url)
+        didl_metadata, subtitle_hrefs = self.make_video_metadata(href, fp, transcoded=transcoded)
+        return CastItem(torrent_file, fp, href, transcoded=transcoded,
+                        didl_metadata=didl_metadata, subtitle_hrefs=subtitle_hrefs)
 
-        self.avtransport_start = time.time()
-        
-    def unsubscribe_avtransport(self):
-        if not self.avtransport_href:
+    def release_cast_item(self, item: CastItem):
+        for href in [item.href] + item.subtitle_hrefs:
+            self.server.unregister_file_mapping(href)
+
+    def play_cast_item(self, item: CastItem):
+        self.unregister_video_file()
+        self.stop()
+
+        self.video_href = item.href
+        self.video_filepath = '' if item.transcoded else item.filepath
+        self.video_didl_metadata = item.didl_metadata
+        self.subtitle_hrefs = item.subtitle_hrefs
+
+        self.cast_state = 'registered'
+        self.start_cast()
+
+    def enqueue_torrent_files(self, torrent_files):
+        ''' Add files to the play queue, playing the first one if nothing is being cast '''
+
+        self.queue.extend(torrent_files)
+
+        if self.cast_state in ('', 'stopped'):
+            self.play_next()
+        elif self.cast_state == 'playing':
+            self.preload_next()
+
+    def clear_queue(self):
+        self.queue.clear()
+
+        if self.next_item is not None:
+            self.release_cast_item(self.next_item)
+            self.next_item = None
+
+    def play_next(self):
+        if not self.queue:
+            return False
+
+        torrent_file = self.queue.popleft()
+        item, self.next_item = self.next_item, None
+
+        if item is None:
+            item = self.prepare_cast_item(torrent_file)
+
+        self.play_cast_item(item)
+        return True
+
+    def prepare_next_item(self):
+        ''' Prepare the next queued file once casting started, without holding the lock while it's probed '''
+
+        with self.lock:
+            if self.next_item is not None or not self.queue or self.cast_state not in ('sent_play', 'playing'):
+                return
+            torrent_file = self.queue[0]
+
+        item = self.prepare_cast_item(torrent_file)
+
+        with self.lock:
+            # The queue may have changed while the lock was released
+            if self.next_item is None and self.queue and self.queue[0] is torrent_file:
+                self.next_item = item
+                return
+
+        self.release_cast_item(item)
+
+    def preload_next(self):
+        ''' Prepare the next queued file and send it with SetNextAVTransportURI if the renderer supports it '''
+
+        if not self.queue:
             return
-        
-        self.server.unregister_NOTIFY_callback(self.avtransport_href)
-        ret = self.device.AVTransport.cancel_subscription(self.avtransport_sid)
-        self.avtransport_sid = self.avtransport_timeout = self.avtransport_href = ''
 
-        return ret
-    
-    def AVTransport_cb(self, httphandler: HTTPTorrentServerHandler):
-        # TODO: Refactor
+        if self.next_item is None:
+            self.next_item = self.prepare_cast_item(self.queue[0])
 
-        url = httphandler.path
-        LOGGER.info(f'NOTIFY callback for {url} in state {self.cast_state}')
+        if self.next_item.preloaded or self.device.find_action('SetNextAVTransportURI') is None:
+            return
 
         try:
-            size = int(httphandler.headers.get('Content-Length'))
-            data = httphandler.rfile.read(size)
-            
-            xml_soup = bs4.BeautifulSoup(data, 'xml')
-            lastchange = bs4.BeautifulSoup(xml_soup.find('LastChange').text, 'xml')
-            instance = lastchange.find("InstanceID", val=0)
-            assert instance
-        except:
-            httphandler._send_default_headers('error_callback', 0)
-            return
+            self.send_next_uri(self.make_url(self.next_item.href), NextURIMetaData=self.next_item.didl_metadata)
+            self.next_item.preloaded = True
+        except Exception:
+            LOGGER.exception(f'Failed preloading {self.next_item.filepath} on {self.device}')
 
-        httphandler._send_default_headers('callback', 0)
+    def _promote_next_item(self):
+        ''' The renderer moved on to the preloaded file by itself '''
+
+        self.queue.popleft()
+        item, self.next_item = self.next_item, None
+
+        self.unregister_video_file()
+        self.video_href = item.href
+        self.video_filepath = '' if item.transcoded else item.filepath
+        self.video_didl_metadata = item.didl_metadata
+        self.subtitle_hrefs = item.subtitle_hrefs
+        self.clock.anchor(0)
+
+        LOGGER.info(f'{self.device} moved on to queued {item.filepath}')
+
+    def stop(self):
+        ''' Stop playing without advancing the play queue, the renderer's STOPPED event is ignored '''
 
-        curr_transport_actions = instance.find("CurrentTransportActions")
-        transport_state = instance.find("TransportState") 
+        self.cast_state = 'stopped'
+        return self.send_stop()
+
+    def start_cast(self):
+        ''' Send the registered video, the rest of the cast is driven by AVTransport events '''
+
+        self.subscribe_avtransport()
+        self.advance_cast()
+
+    def subscribe_avtransport(self):
+        if self.avtransport_subscribed:
+            return
+
+        self.subscriptions.subscribe(self.device, 'AVTransport', self.AVTransport_event_cb)
+        self.avtransport_subscribed = True
         
+    def unsubscribe_avtransport(self):
+        if not self.avtransport_subscribed:
+            return
+
+        self.avtransport_subscribed = False
+        self.subscriptions.unsubscribe(self.device, 'AVTransport', self.AVTransport_event_cb)
+
+    def advance_cast(self, transport_state=None, transport_actions='', current_uri=None):
         if self.cast_state == 'registered' and self.video_href:
             self.cast_state = 'sent_uri'
             url = self.make_url(self.video_href)
-            self.send_uri(url)
+            self.server.media_requests.start(self.video_href)
+            self.send_uri(url, CurrentURIMetaData=self.video_didl_metadata)
+
+            # Setting the current URI resets the renderer's next URI
+            if self.next_item is not None:
+                self.next_item.preloaded = False
 
         if self.cast_state == 'sent_uri' and \
-            transport_state and transport_state.attrs.get('val') == 'STOPPED' and \
-            curr_transport_actions and "Play" in curr_transport_actions.attrs.get('val'):
+            transport_state == 'STOPPED' and "Play" in transport_actions:
             self.cast_state = 'sent_play'
-            self.send_play()    
+            self.clock.anchor(0)
+            self.send_play()
+
+        if self.cast_state == 'sent_play' and transport_state == 'PLAYING':
+            self.cast_state = 'playing'
+
+            stats = self.server.media_requests.stop(self.video_href)
+            if stats is not None:
+                LOGGER.info(f"Playing {self.video_href} on {self.device}: first GET after {stats['first_get']}s, "
+                            f"{len(stats['requests'])} requests {stats['requests']}")
+
+            self.preload_next()
+
+        if self.cast_state == 'playing' and self.next_item is not None and self.next_item.preloaded and \
+            current_uri == self.make_url(self.next_item.href):
+            self._promote_next_item()
+            self.preload_next()
+
+        # Renderers without SetNextAVTransportURI stop at the end of the file
+        elif self.cast_state == 'playing' and transport_state == 'STOPPED' and self.queue:
+            self.play_next()
+
+    def update_clock(self, event: AVTransportEvent):
+        if event.transport_state:
+            self.clock.set_transport_state(event.transport_state)
+
+        # Most renderers only send RelativeTimePosition when polled, some send it with every event
+        for value, update_cb in ((event.relative_time_position, self.clock.anchor),
+                                 (event.current_track_duration, self.clock.set_duration)):
+            if not value:
+                continue
+
+            try:
+                update_cb(clock_to_seconds(value))
+            except ValueError:
+                pass
+
+    def AVTransport_event_cb(self, data):
+        '''
+        Runs on an HTTP server thread while the renderer waits for the NOTIFY response, so it only updates the clock
+        and queues the event. Advancing the cast sends SOAP actions back to the renderer and may probe the next file,
+        the executor does it with the device's lock
+        '''
+
+        event = parse_AVTransport_event(data)
+        if event is None:
+            return
+
+        self.update_clock(event)
+
+        with self.events_lock:
+            self.events.append(event)
+            if self.processing_events:
+                return
+            self.processing_events = True
+
+        self.executor.submit(contextvars.copy_context().run, self._process_events)
+
+    def _process_events(self):
+        ''' Apply the queued AVTransport events in arrival order, serialized with the menu's actions by the lock '''
+
+        while True:
+            with self.events_lock:
+                if not self.events:
+                    self.processing_events = False
+                    return
+                event = self.events.popleft()
+
+            try:
+                self.prepare_next_item()
+
+                with self.lock:
+                    LOGGER.info(f'AVTransport event for {self.device} in state {self.cast_state}')
+                    self.advance_cast(transport_state=event.transport_state,
+                                      transport_actions=event.current_transport_actions or '',
+                                      current_uri=event.av_transport_uri)
+            except Exception:
+                LOGGER.exception(f'Failed handling AVTransport event for {self.device}')
+
+
+
+######################################################################
+# UPNP cast sessions
+######################################################################
+
+@dataclasses.dataclass
+class CastSession:
+    controller: UPNPDeviceControl
+    users: dict = dataclasses.field(default_factory=dict)  # userid -> time.monotonic() of their last action
+    last_activity: float = dataclasses.field(default_factory=time.monotonic)
+    muted: bool = False
+
+
+class CastSessionRegistry(object):
+    '''
+    One UPNPDeviceControl per renderer UDN, shared by all the users controlling the renderer
+
+    Users attach to a renderer's session and are dropped after user_timeout seconds without an action,
+    unless the session is casting, then they're only dropped with it after idle_timeout seconds without an action.
+    A session without users is released (its subscription, file mappings and queue are dropped)
+    as soon as nothing is being cast, or after idle_timeout seconds without an action if something still is.
+    Dropped users are attached to their device again on their next action, until they detach themselves
+    '''
+
+    def __init__(self, server: HTTPTorrentServer, subscriptions: GENASubscriptionManager = None,
+                 capabilities: RendererCapabilityCache = None,
+                 user_timeout=getattr(config, 'USERDATA_TIMEOUT', 5 * 60),
+                 idle_timeout=getattr(config, 'CAST_SESSION_IDLE_TIMEOUT', 3 * 60 * 60),
+                 reap_interval=60):
+        self.server = server
+        self.subscriptions = subscriptions or GENASubscriptionManager(server)
+        self.capabilities = capabilities or RendererCapabilityCache()
+        self.user_timeout = user_timeout
+        self.idle_timeout = idle_timeout
+        self.reap_interval = reap_interval
+
+        self.lock = threading.RLock()
+        self.sessions = {}  # udn -> CastSession
+        self.user_sessions = {}  # userid -> udn
+        self.user_devices = {}  # userid -> device they attached to, until they detach
+
+        self.should_run = False
+        self.thread = None
+
+    def attach(self, device: 'dlna_cast_ssdp.Device', userid):
+        ''' Attach the user to the device's session, creating it if needed '''
+
+        self.detach(userid, keep_udn=device.udn)
+
+        with self.lock:
+            session = self.sessions.get(device.udn)
+
+            if session is None:
+                LOGGER.info(f'New cast session for {device}')
+                controller = UPNPDeviceControl(self.server, device, subscriptions=self.subscriptions,
+                                               capabilities=self.capabilities)
+                session = self.sessions[device.udn] = CastSession(controller)
+
+            session.users[userid] = session.last_activity = time.monotonic()
+            self.user_sessions[userid] = device.udn
+            self.user_devices[userid] = device
+            return session
+
+    def get(self, userid):
+        ''' The user's session, None if they didn't select a device '''
+
+        with self.lock:
+            session = self.sessions.get(self.user_sessions.get(userid))
+            if session is not None:
+                session.users[userid] = session.last_activity = time.monotonic()
+                return session
+
+            device = self.user_devices.get(userid)
+            if device is None:
+                return
+
+        # Dropped after user_timeout or with their released session, attach them to the same device again
+        LOGGER.info(f'Attaching user {userid} to {device} again')
+        return self.attach(device, userid)
+
+    def detach(self, userid, keep_udn=None):
+        with self.lock:
+            udn = self.user_sessions.get(userid)
+            if keep_udn is not None and udn == keep_udn:
+                return
+
+            self.user_devices.pop(userid, None)
+            if udn is None:
+                return
+
+            del self.user_sessions[userid]
+            self.sessions[udn].users.pop(userid, None)
+
+        self.release_idle()
+
+    def _is_idle(self, session, now):
+        if session.users:
+            return False
+
+        if now - session.last_activity > self.idle_timeout:
+            return True
+
+        return not session.controller.is_casting()
+
+    def release_idle(self):
+        ''' Drop inactive users and release idle sessions, returns the released sessions '''
+
+        now = time.monotonic()
+        released = []
+
+        with self.lock:
+            for udn, session in list(self.sessions.items()):
+
+                # Users watching a cast stay attached to control it, until the session is idle for idle_timeout
+                user_timeout = self.user_timeout
+                if session.controller.is_casting() and now - session.last_activity <= self.idle_timeout:
+                    user_timeout = self.idle_timeout
 
+                for userid, last_action in list(session.users.items()):
+                    if now - last_action > user_timeout:
+                        del session.users[userid]
+                        self.user_sessions.pop(userid, None)
+
+                if self._is_idle(session, now):
+                    released.append(self.sessions.pop(udn))
+
+        # Closing sends UNSUBSCRIBE requests, don't hold the lock meanwhile
+        for session in released:
+            LOGGER.info(f'Releasing idle cast session for {session.controller.device}')
+            session.controller.close()
+
+        return released
+
+    def _release_idle_while_should_run(self):
+        while self.should_run:
+            time.sleep(self.reap_interval)
+
+            try:
+                self.release_idle()
+            except:
+                LOGGER.exception('Failed releasing idle cast sessions')
+
+    def start_reaper_thread(self):
+        if self.thread is not None:
+            return
+
+        self.should_run = True
+        self.thread = threading.Thread(target=self._release_idle_while_should_run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop_reaper_thread(self):
+        self.should_run = False
+        self.thread = None
 
 
 ######################################################################
@@ -884,34 +3874,121 @@ class UPNPDeviceControl(object):
 
 
 class UPNPTorrentCastMenu(TorrentMenu):
+    '''
+    Control the renderer of the user's session in a CastSessionRegistry,
+    a single menu serves all the users and renderers
+    '''
+
     DEFAULT_LAYOUT = [
         ['play', 'pause', 'stop'],
         ['volume_up', 'volume_down'],
         ['seek_back', 'seek_forward', 'seek_time'],
-        ['cast_torrent_file', 'cast_converted_file'],
+        ['cast_file', 'cast_torrent_file', 'cast_transcoded_file', 'cast_converted_file'],
+        ['queue_torrent', 'play_next', 'clear_queue'],
         ['back'],
     ]
 
-    def __init__(self, server: HTTPTorrentServer, file_converter: FileConverter, device: UPNPDevice, *args, on_complete=None, layout=DEFAULT_LAYOUT, **kwargs):
+    def __init__(self, sessions: CastSessionRegistry, file_converter: FileConverter, *args, on_complete=None, layout=DEFAULT_LAYOUT, **kwargs):
         super().__init__(*args, layout=layout, **kwargs)
 
         self.on_complete = on_complete
 
-        self.controller = UPNPDeviceControl(server, device)
+        self.sessions = sessions
         self.file_converter = file_converter
         
         self.volume_inc = 3
         self.time_inc = 30
-        self.muted = False
 
-        self.create_torrent_file_handler('cast_torrent_file', lambda update, tf: self.play_torrent_file(tf))
+        self.create_torrent_file_handler('cast_file', self._cast_file_cb)
+        self.create_torrent_handler('queue_torrent', self._queue_torrent_cb)
+        self.create_torrent_file_handler('cast_torrent_file', self._cast_torrent_file_cb)
+        self.create_torrent_file_handler('cast_transcoded_file', self._cast_transcoded_file_cb)
 
         _cast_converted_file_process_choice_cb = self.cancelable(self._cast_converted_file_process_choice)
         self.register_callback('_cast_converted_file_process_choice', _cast_converted_file_process_choice_cb)
 
+    def get_session(self, update) -> CastSession:
+        return self.sessions.get(get_userid(update))
+
+    async def run_action(self, update, method_name, *args, **kwargs):
+        ''' Run a method of the session's controller off the event loop, replying if the device fails or doesn't respond '''
+
+        session = self.get_session(update)
+        if session is None:
+            await reply(update, 'No device selected')
+            return
+
+        controller = session.controller
+
+        try:
+            return await controller.run(getattr(controller, method_name), *args, **kwargs)
+
+        except asyncio.TimeoutError:
+            msg = repr_action(update, f'{method_name} timed out on {controller.device}')
+            LOGGER.warning(msg)
+            await reply(update, msg)
+
+        except Exception as e:
+            msg = repr_action(update, f'{method_name} failed on {controller.device}: {e}')
+            LOGGER.exception(msg)
+            await reply(update, msg)
+
+    def find_finished_convertion(self, filepath):
+        for convertion in self.file_converter.iter_convertion_metadatas(
+                filter_cb=lambda m: m.get('original_file') == filepath and not self.file_converter.is_running(m)):
+
+            if os.path.isfile(convertion.get('converted_file')):
+                return convertion
+
+    async def _cast_file_cb(self, update, torrent_file):
+        ''' Cast the cheapest playable version of the file: itself, a finished convertion of it or a live transcode '''
+
+        fp = transmission_utils.torrent_file_to_path(torrent_file)
+
+        if await self.run_action(update, 'can_play_file', fp):
+            await reply(update, repr_action(update, f'casting {fp} directly'))
+            await self.run_action(update, 'play_torrent_file', torrent_file)
+            return
+
+        convertion = self.find_finished_convertion(fp)
+        if convertion is not None:
+            converted_file = convertion.get('converted_file')
+            await reply(update, repr_action(update, f'casting convertion {converted_file}'))
+            await self.run_action(update, 'play_file', converted_file)
+            self.file_converter.touch_convertion(converted_file)
+            return
+
+        await reply(update, repr_action(update, f'casting live transcode of {fp}'))
+        await self.run_action(update, 'play_torrent_file_transcoded', torrent_file)
+
+    async def _queue_torrent_cb(self, update, torrent):
+        ''' Queue the torrent's videos in name order '''
+
+        torrent_files = [tf for tf in iter_torrent_files(torrent)
+                         if (mimetypes.guess_type(tf.name)[0] or '').startswith('video/')]
+
+        await self.run_action(update, 'enqueue_torrent_files', torrent_files)
+
+        session = self.get_session(update)
+        if session is not None:
+            return '\n'.join(str(tf) for tf in session.controller.queue)
+
+    async def play_next(self, update, context):
+        if not await self.run_action(update, 'play_next'):
+            await reply(update, 'Queue is empty')
+
+    async def clear_queue(self, update, context):
+        await self.run_action(update, 'clear_queue')
+
+    async def _cast_torrent_file_cb(self, update, torrent_file):
+        await self.run_action(update, 'play_torrent_file', torrent_file)
+
+    async def _cast_transcoded_file_cb(self, update, torrent_file):
+        await self.run_action(update, 'play_torrent_file_transcoded', torrent_file)
+
     async def back(self, update, context):
-        self.controller.unsubscribe_avtransport()
-        self.controller.unregister_video_file()
+        # The session keeps casting for the other users, or until the cast ends if this was the last one
+        await asyncio.get_running_loop().run_in_executor(None, self.sessions.detach, get_userid(update))
         
         if self.on_complete:
             return await call_callback(self.on_complete, update, context)
@@ -921,11 +3998,19 @@ class UPNPTorrentCastMenu(TorrentMenu):
     async def cast_converted_file(self, update, context):
         userdata = self.get_userdata(update)
 
-        convertions = list(m for m in self.file_converter.iter_convertion_metadatas()
-                           if m.get('identifier', 'FAKEIFDSFDSFD') not in self.file_converter.running_identifiers)
+        # Running fragmented convertions can be cast while they're being written
+        is_running = self.file_converter.is_running
+        convertions = list(m for m in self.file_converter.iter_convertion_metadatas(
+                                filter_cb=lambda m: is_running(m) or os.path.exists(m.get('converted_file')))
+                           if not is_running(m) or m.get('fragmented'))
         userdata['ConvertedFiles_list'] = convertions
-        
-        await self.prompt_list(update, 'Choose converted file:', [c.get('converted_file') for c in convertions])
+
+        def repr_convertion(convertion):
+            if is_running(convertion):
+                return f'{convertion.get("converted_file")} (converting)'
+            return convertion.get('converted_file')
+
+        await self.prompt_list(update, 'Choose converted file:', [repr_convertion(c) for c in convertions])
         return self.prefix_menu('_cast_converted_file_process_choice')
 
     async def _cast_converted_file_process_choice(self, update, context):
@@ -938,55 +4023,63 @@ class UPNPTorrentCastMenu(TorrentMenu):
             convertion = convertions[i]
 
             converted_file = convertion.get('converted_file')
-            if os.path.isfile(converted_file):
+            running = self.file_converter.is_running(convertion)
+
+            if running or os.path.isfile(converted_file):
                 msg = repr_action(update, f'casting file {converted_file}')
                 LOGGER.info(msg)
                 await reply(update, msg)
 
-                self.controller.play_file(converted_file)
+                size_cb = None
+                if running:
+                    size_cb = functools.partial(self.file_converter.get_running_output_size, convertion)
+
+                await self.run_action(update, 'play_file', converted_file, size_cb=size_cb)
+                self.file_converter.touch_convertion(converted_file)
 
         return await self._main_menu(update, context)
 
     async def play(self, update, context):
-        self.controller.send_play()
+        await self.run_action(update, 'send_play')
 
     async def pause(self, update, context):
-        self.controller.send_pause()
+        await self.run_action(update, 'send_pause')
 
     async def stop(self, update, context):
-        self.controller.send_stop()
+        await self.run_action(update, 'stop')
 
     async def volume_up(self, update, context):
-        volume = self.controller.get_volume() or 0
-        volume += self.volume_inc
-        self.controller.set_volume(DesiredVolume=volume)
+        await self.run_action(update, 'change_volume', self.volume_inc)
 
     async def volume_down(self, update, context):
-        volume = self.controller.get_volume() or 0
-        volume -= self.volume_inc
-        self.controller.set_volume(DesiredVolume=volume)
+        await self.run_action(update, 'change_volume', -self.volume_inc)
 
     async def toggle_mute(self, update, context):
-        # TODO: This doesn't work
-        self.controller.send_mute(DesiredMute=int(self.muted))
-        self.muted = not self.muted
+        session = self.get_session(update)
+        if session is None:
+            return
 
-    async def seek_back(self, update, context):
         # TODO: This doesn't work
-        RelTime = self.controller.get_position_info().get('RelTime') or '00:00:00'
+        await self.run_action(update, 'send_mute', DesiredMute=int(session.muted))
+        session.muted = not session.muted
 
-        seconds = clock_to_seconds(RelTime)
-        seconds -= self.time_inc
-        
-        location = seconds_to_clock(seconds)
-        self.controller.send_seek(location)
+    async def _seek_relative(self, update, seconds):
+        ''' Queue a merged relative seek, replying to the user if the Seek sent after the debounce fails '''
 
-    async def seek_forward(self, update, context):
-        # TODO: This doesn't work
-        RelTime = self.controller.get_position_info().get('RelTime') or '00:00:00'
+        loop = asyncio.get_running_loop()
 
-        seconds = clock_to_seconds(RelTime)
-        seconds += self.time_inc
-        
-        location = seconds_to_clock(seconds)
-        self.controller.send_seek(location)
+        # The callback runs on the debounce timer thread, looking the session up there could attach the user again
+        session = self.get_session(update)
+        device = session.controller.device if session is not None else 'device'
+
+        def on_error(e):
+            msg = repr_action(update, f'seek_relative failed on {device}: {e}')
+            asyncio.run_coroutine_threadsafe(reply(update, msg), loop)
+
+        await self.run_action(update, 'seek_relative', seconds, on_error=on_error, requester=get_chat_id(update))
+
+    async def seek_back(self, update, context):
+        await self._seek_relative(update, -self.time_inc)
+
+    async def seek_forward(self, update, context):
+        await self._seek_relative(update, self.time_inc)
@@ -1,11 +1,64 @@
 #!/usr/bin/python3
 
-from bot_utils import *
-from stream_utils import *
+import asyncio
+import logging
+
+from telegram import Update
+from telegram.ext import (
+    Application,
+    CommandHandler,
+    ConversationHandler,
+    MessageHandler,
+    filters,
+)
+
+import config
+import transmission_utils
+from tracing import TRACER
+from bot_utils import (
+    AuthenticatedMenu,
+    AuthenticatedTorrentMenu,
+    PerUserUpdateProcessor,
+    REMOVE_MARKUP,
+    TorrentMenu,
+    WATCHES,
+    get_free_size,
+    get_text,
+    get_used_size,
+    get_userid,
+    iter_torrent_files,
+    iter_torrent_reprs,
+    menus_to_states,
+    multi_reply,
+    reply,
+    reply_lines,
+    repr_action,
+)
+from stream_utils import (
+    CastSessionRegistry,
+    ConvertionCatalog,
+    FileConverter,
+    FileConvertionMenu,
+    GENASubscriptionManager,
+    HTTPTorrentServer,
+    RendererCapabilityCache,
+    TelegramWebhookServer,
+    UPNPDeviceRegistry,
+    UPNPTorrentCastMenu,
+    iter_UPNP_devices,
+)
+
+
+LOGGER = logging.getLogger(__name__)
 
 
 SERVER = HTTPTorrentServer()
-FILE_CONVERTER = FileConverter(ffmpeg_path=getattr(config, 'FFMPEG_PATH', 'ffmpeg'))
+SUBSCRIPTIONS = GENASubscriptionManager(SERVER)
+RENDERER_CAPABILITIES = RendererCapabilityCache()
+CAST_SESSIONS = CastSessionRegistry(SERVER, subscriptions=SUBSCRIPTIONS, capabilities=RENDERER_CAPABILITIES)
+CONVERTION_CATALOG = ConvertionCatalog()
+UPNP_REGISTRY = UPNPDeviceRegistry()
+FILE_CONVERTER = FileConverter(ffmpeg_path=getattr(config, 'FFMPEG_PATH', 'ffmpeg'), catalog=CONVERTION_CATALOG, server=SERVER)
 
 
 ######################################################################
@@ -19,7 +72,7 @@ MAIN_MENU = AuthenticatedTorrentMenu(
     layout=[
     ['add_tv_show', 'add_movie'], 
     ['start_torrent','stop_torrent', 'delete_torrent'],
-    ['list_torrents', 'list_torrent_files'],
+    ['list_torrents', 'watch_torrents', 'list_torrent_files'],
     ['disable_all_torrent_files', 'toggle_torrent_files'],
     ['more', 'exit']
 ])
@@ -48,6 +101,7 @@ ADMIN_MENU = AuthenticatedMenu(
     ['get_password', 'set_password'],
     ['list_admins', 'add_admin'],
     ['list_authenticated_users', 'add_authenticated_user'],
+    ['trace_stats'],
     ['back']
 ])
 
@@ -55,6 +109,10 @@ CONVERTION_MENU = FileConvertionMenu(FILE_CONVERTER,
                                      name='fileconvert',
                                      on_complete=SECOND_MENU._main_menu)
 
+UPNP_CAST_MENU = UPNPTorrentCastMenu(CAST_SESSIONS, FILE_CONVERTER,
+                                     name='upnpcast',
+                                     on_complete=CAST_MENU._start)
+
 STATES = {}
 
 
@@ -66,8 +124,14 @@ STATES = {}
 # Basic command handlers
 @MAIN_MENU.callback(menu_on_exit=True)
 async def list_torrents(update, context):
-    for torrent_repr in iter_torrent_reprs(status=True):
-        await reply(update, torrent_repr)
+    torrent_reprs = await asyncio.to_thread(list, iter_torrent_reprs(status=True))
+    await reply_lines(update, torrent_reprs, separator='\n\n')
+
+# Edits one status message in place instead of replying again on every press
+MAIN_MENU.create_watch_handler('watch_torrents',
+    lambda: '\n\n'.join(iter_torrent_reprs(status=True)) or 'No torrents',
+    key='torrents'
+)
 
 ##############################
 # Enter different menus
@@ -87,28 +151,28 @@ MAIN_MENU.create_magnet_handler('add_movie', lambda update, magnet: transmission
 
 ##############################
 # Torrent command handlers
-MAIN_MENU.create_torrent_handler('start_torrent', lambda update, torrent_id: transmission_utils.start_torrent(torrent_id))
-MAIN_MENU.create_torrent_handler('stop_torrent', lambda update, torrent_id: transmission_utils.stop_torrent(torrent_id))
-MAIN_MENU.create_torrent_handler('delete_torrent', lambda update, torrent_id: transmission_utils.delete_torrent(torrent_id))
+MAIN_MENU.create_torrent_handler('start_torrent', lambda update, torrent: transmission_utils.start_torrent(torrent))
+MAIN_MENU.create_torrent_handler('stop_torrent', lambda update, torrent: transmission_utils.stop_torrent(torrent))
+MAIN_MENU.create_torrent_handler('delete_torrent', lambda update, torrent: transmission_utils.delete_torrent(torrent))
 
 MAIN_MENU.create_torrent_handler('list_torrent_files',
 
     # Map torrent files to their representation
-    lambda update, torrent_id: map(
+    lambda update, torrent: map(
         repr,
-        iter_torrent_files(torrent_id)
+        iter_torrent_files(torrent)
         )
 )
 MAIN_MENU.create_torrent_handler('disable_all_torrent_files',
-    lambda update, torrent_id: transmission_utils.update_torrent_files( torrent_id, update_cb = lambda tf: {'selected': False} )
+    lambda update, torrent: transmission_utils.update_torrent_files( torrent, update_cb = lambda tf: {'selected': False} )
 )
 
 MAIN_MENU.create_torrent_handler('toggle_torrent_files',
 
     # Save chosen torrent and create new list to store chosen files in the userdata
-    lambda update, torrent_id: MAIN_MENU.get_userdata(update).update(
+    lambda update, torrent: MAIN_MENU.get_userdata(update).update(
         {
-            'toggle_torrent_files_chosen_torrent': torrent_id,
+            'toggle_torrent_files_chosen_torrent': torrent.id,
             'toggle_torrent_files_chosen_files': set()
         }
     ),
@@ -122,7 +186,7 @@ async def toggle_torrent_files_prompt_files(update, context):
     if torrent_id is None:
         return await MAIN_MENU.get_callback('toggle_torrent_files')(update, context)
 
-    await MAIN_MENU.prompt_torrent_files(update, torrent_id, prepend_layout=[["Cancel", "Done"]])
+    await MAIN_MENU.prompt_torrent_files(update, torrent_id, prepend_layout=[["Cancel", "Done"]], keep_page=True)
     return 'toggle_torrent_files_choose_files'
 
 @MAIN_MENU.callback()
@@ -148,7 +212,7 @@ async def toggle_torrent_files_choose_files(update, context):
         await multi_reply(update, 'Updated torrent files', ret)
         return await MAIN_MENU._main_menu(update, context)
     
-    torrent_id2, file_id = MAIN_MENU.choice_to_torrent_file_id(text)
+    torrent_id2, file_id = MAIN_MENU.choice_to_torrent_file_id(text, update)
 
     if file_id is not None and torrent_id2 == torrent_id:
         torrent_files.add(file_id)
@@ -223,6 +287,11 @@ async def list_admins(update, context):
 async def list_authenticated_users(update, context):
     await multi_reply(update, 'Authenticated users', MAIN_MENU.authenticated_user_ids, with_index=True)
 
+@ADMIN_MENU.callback(menu_on_exit=True)
+async def trace_stats(update, context):
+    lines = TRACER.report(count=getattr(config, 'TRACE_REPORT_COUNT', 10), kinds=('handler', 'transmission', 'soap'))
+    await reply_lines(update, lines)
+
 @ADMIN_MENU.callback(menu_on_exit=True)
 async def get_password(update, callback):
     await reply(update, MAIN_MENU.password)
@@ -294,17 +363,29 @@ async def back_to_second_from_cast(update, context):
 
 ##############################
 # UPnP commands
+async def get_UPNP_devices(update):
+    ''' Devices from the registry, waiting briefly for a search if none are known yet '''
+
+    devices = list(iter_UPNP_devices(registry=UPNP_REGISTRY))
+
+    if not devices:
+        await reply(update, 'Please wait..')
+        UPNP_REGISTRY.request_search()
+        await asyncio.get_running_loop().run_in_executor(None, UPNP_REGISTRY.wait_for_search, 10)
+        devices = list(iter_UPNP_devices(registry=UPNP_REGISTRY))
+
+    return devices
+
 @CAST_MENU.callback(menu_on_exit=True)
 async def UPNP_discover(update, context):
-    await reply(update, 'Please wait..')
-    devices = list(iter_UPNP_devices())
+    UPNP_REGISTRY.request_search()
+    devices = await get_UPNP_devices(update)
     await multi_reply(update, 'UPNP device', devices, with_index=True)  
 
 @CAST_MENU.callback()
 async def control_UPNP_device(update, context):
     userdata = CAST_MENU.get_userdata(update)
-    await reply(update, 'Please wait..')
-    devices = list(iter_UPNP_devices())
+    devices = await get_UPNP_devices(update)
     userdata['UPNP_devices'] = devices
     await CAST_MENU.prompt_list(update, 'Select device:', devices)
     return '_control_UPNP_device_process_device_choice'
@@ -318,46 +399,9 @@ async def _control_UPNP_device_process_device_choice(update, context):
     devices = userdata.get("UPNP_devices", [])
 
     if i is not None and 0 <= i < len(devices):
-        device=devices[i]
-        upnp_cast_menu = UPNPTorrentCastMenu(SERVER, FILE_CONVERTER, device, name=f'upnpcast_{userid}', on_complete=_control_UPNP_device_exit_cast_menu)
-        userdata['UPNPTorrentCastMenu'] = upnp_cast_menu
-        STATES.update(upnp_cast_menu.create_message_handlers())
-        
-        return await _control_UPNP_device_enter_cast_menu(update, context)
-
-    return await CAST_MENU._start(update, context)
-
-@CAST_MENU.callback(prefix_menu=False)
-async def _control_UPNP_device_enter_cast_menu_existing(update, context):
-    upnp_cast_menu = CAST_MENU.get_userdata(update).get('UPNPTorrentCastMenu')
-
-    if upnp_cast_menu:
-        return await upnp_cast_menu._process_main_menu_choice(update, context)
-
-    return await CAST_MENU._main_menu(update, context)
-
-@CAST_MENU.callback(prefix_menu=False)
-async def _control_UPNP_device_exit_cast_menu(update, context):
-    userdata = CAST_MENU.get_userdata(update)
-    upnp_cast_menu = userdata.get('UPNPTorrentCastMenu')
-
-    if upnp_cast_menu:
-
-        states = upnp_cast_menu.create_message_handlers()
-        for state in states:
-            del conv_handler.states[state]
-
-        del upnp_cast_menu
-        CAST_MENU.del_userdata_entries(update, 'UPNPTorrentCastMenu')
-    
-    return await CAST_MENU._start(update, context)
-
-@CAST_MENU.callback(prefix_menu=False)
-async def _control_UPNP_device_enter_cast_menu(update, context):
-    upnp_cast_menu = CAST_MENU.get_userdata(update).get('UPNPTorrentCastMenu')
-
-    if upnp_cast_menu is not None:
-        return await upnp_cast_menu._start(update, context)
+        # Users controlling the same renderer share its session
+        CAST_SESSIONS.attach(devices[i], userid)
+        return await UPNP_CAST_MENU._start(update, context)
 
     return await CAST_MENU._start(update, context)
 
@@ -398,10 +442,15 @@ async def status_file_server(update, context):
 # Bot creation
 ######################################################################
 
-if __name__ == '__main__':
-    application = Application.builder().token(config.API_TOKEN).build()
+def create_application(builder=None):
+    ''' The bot's Application with every menu's handlers, builder defaults to a Bot API one for config.API_TOKEN '''
+
+    if builder is None:
+        builder = Application.builder().token(config.API_TOKEN)
+
+    application = builder.concurrent_updates(PerUserUpdateProcessor()).build()
 
-    STATES.update(menus_to_states(MAIN_MENU, SECOND_MENU, ADMIN_MENU, CAST_MENU, CONVERTION_MENU))
+    STATES.update(menus_to_states(MAIN_MENU, SECOND_MENU, ADMIN_MENU, CAST_MENU, CONVERTION_MENU, UPNP_CAST_MENU))
 
     conv_handler = ConversationHandler(
         entry_points=[MessageHandler(filters.Regex('.*'), MAIN_MENU._start)],
@@ -412,4 +461,22 @@ if __name__ == '__main__':
     )  
 
     application.add_handler(conv_handler)
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    application.add_handler(WATCHES.create_handler())
+
+    return application
+
+
+if __name__ == '__main__':
+    application = create_application()
+
+    CONVERTION_CATALOG.start_reconcile_thread()
+    UPNP_REGISTRY.start_threads()
+    CAST_SESSIONS.start_reaper_thread()
+
+    if getattr(config, 'WEBHOOK_ENABLED', False):
+        try:
+            asyncio.run(TelegramWebhookServer(application).run())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
@@ -0,0 +1,198 @@
+import time
+import math
+import logging
+import functools
+import itertools
+import threading
+import contextlib
+import contextvars
+import collections
+import dataclasses
+import inspect
+
+import config
+
+LOGGER = logging.getLogger(__name__)
+
+
+######################################################################
+# Spans
+######################################################################
+
+# Context variables follow asyncio tasks, asyncio.to_thread() and contextvars.copy_context().run(),
+# so spans opened while handling a Telegram update are linked to it even when they run in worker threads
+CURRENT_UPDATE_ID = contextvars.ContextVar('CURRENT_UPDATE_ID', default=None)
+CURRENT_SPAN_ID = contextvars.ContextVar('CURRENT_SPAN_ID', default=None)
+
+
+@dataclasses.dataclass
+class Span:
+    ''' A timed operation, optionally linked to the Telegram update and parent span it ran under '''
+
+    span_id: int
+    name: str
+    kind: str
+    start: float
+    duration: float = 0
+    update_id: int = None
+    parent_id: int = None
+    error: str = None
+    attributes: dict = dataclasses.field(default_factory=dict)
+
+    def __repr__(self):
+        attributes = ' '.join(f'{k}={v}' for k, v in self.attributes.items())
+        update = f' update={self.update_id}' if self.update_id is not None else ''
+        error = f' ERROR {self.error}' if self.error else ''
+        return f'{self.duration * 1000:.1f}ms [{self.kind}] {self.name}{update} {attributes}{error}'.rstrip()
+
+
+def percentile(sorted_values, p):
+    ''' Nearest-rank percentile of an already sorted list '''
+
+    if not sorted_values:
+        return 0
+
+    index = max(0, min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+######################################################################
+# Tracer
+######################################################################
+
+class Tracer(object):
+    '''
+    Records finished spans into a bounded ring buffer, old spans fall off as new ones arrive
+
+    Recording is a deque append under a lock, cheap enough to leave on for every handler,
+    RPC, SOAP action, ffmpeg job and HTTP request
+    '''
+
+    def __init__(self, size=getattr(config, 'TRACE_BUFFER_SIZE', 4096)):
+        self.spans = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def clear(self):
+        with self.lock:
+            self.spans.clear()
+
+    @contextlib.contextmanager
+    def span(self, name, kind='internal', update_id=None, **attributes):
+        '''
+        Time the enclosed block as a span
+
+        Passing update_id links this span and every span opened under it to that update
+        '''
+
+        update_token = None
+        if update_id is not None:
+            update_token = CURRENT_UPDATE_ID.set(update_id)
+        else:
+            update_id = CURRENT_UPDATE_ID.get()
+
+        span = Span(next(self.ids), name, kind, time.time(),
+                    update_id=update_id, parent_id=CURRENT_SPAN_ID.get(), attributes=attributes)
+        span_token = CURRENT_SPAN_ID.set(span.span_id)
+        start = time.perf_counter()
+
+        try:
+            yield span
+        except BaseException as e:
+            span.error = repr(e)[:200]
+            raise
+        finally:
+            span.duration = time.perf_counter() - start
+            CURRENT_SPAN_ID.reset(span_token)
+            if update_token is not None:
+                CURRENT_UPDATE_ID.reset(update_token)
+            self.add(span)
+
+    def record(self, name, kind, start, duration, error=None, **attributes):
+        ''' Record an operation timed elsewhere (start is a time.time() timestamp) '''
+
+        span = Span(next(self.ids), name, kind, start, duration,
+                    update_id=CURRENT_UPDATE_ID.get(), parent_id=CURRENT_SPAN_ID.get(),
+                    error=error, attributes=attributes)
+        self.add(span)
+        return span
+
+    def traced(self, name=None, kind='internal'):
+        ''' Decorator tracing every call of a sync or async function '''
+
+        def decorator(func):
+            span_name = name or func.__qualname__
+
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def wrapper(*args, **kwargs):
+                    with self.span(span_name, kind):
+                        return await func(*args, **kwargs)
+            else:
+                @functools.wraps(func)
+                def wrapper(*args, **kwargs):
+                    with self.span(span_name, kind):
+                        return func(*args, **kwargs)
+
+            return wrapper
+        return decorator
+
+    ##############################
+    # Queries
+    def get_spans(self, kind=None, update_id=None, since=None):
+        with self.lock:
+            spans = list(self.spans)
+
+        return [span for span in spans
+                if (kind is None or span.kind == kind)
+                and (update_id is None or span.update_id == update_id)
+                and (since is None or span.start >= since)]
+
+    def slowest(self, count=10, kind=None, since=None):
+        return sorted(self.get_spans(kind=kind, since=since), key=lambda span: span.duration, reverse=True)[:count]
+
+    def percentiles(self, kind=None, since=None, ps=(50, 95, 99)):
+        ''' {(kind, name): (count, [duration percentiles])} over the buffered spans '''
+
+        durations = collections.defaultdict(list)
+        for span in self.get_spans(kind=kind, since=since):
+            durations[(span.kind, span.name)].append(span.duration)
+
+        ret = {}
+        for key, values in durations.items():
+            values.sort()
+            ret[key] = (len(values), [percentile(values, p) for p in ps])
+
+        return ret
+
+    def report(self, count=10, kinds=('handler',)):
+        '''
+        Text lines of the slowest recent spans and per-name percentiles of each of the given kinds
+
+        Spans are ranked within their kind, long streaming http and ffmpeg spans would outrank every handler
+        '''
+
+        lines = []
+        for kind in kinds:
+            spans = self.get_spans(kind=kind)
+            if lines:
+                lines.append('')
+
+            lines.append(f'Slowest {min(count, len(spans))} of {len(spans)} recent {kind} spans:')
+            lines += [repr(span) for span in sorted(spans, key=lambda span: span.duration, reverse=True)[:count]]
+
+            stats = self.percentiles(kind=kind)
+            lines.append(f'\n{kind} p50 / p95 / p99 (count):')
+
+            for (_, name), (n, values) in sorted(stats.items(), key=lambda item: item[1][1][-1], reverse=True):
+                values_str = ' / '.join(f'{v * 1000:.0f}' for v in values)
+                lines.append(f'{name}: {values_str}ms ({n})')
+
+        return lines
+
+
+TRACER = Tracer()
@@ -1,9 +1,10 @@
 import os
 import math
-
-import transmissionrpc  # python3 -m pip install transmissionrpc
+import functools
 
 import config
+from tracing import TRACER
+from lazy_import import lazy_import
 
 
 ######################################################################
@@ -40,12 +41,31 @@ added_torrent_fields = {
     'sequentialDownload': ('boolean', 18, None, None, None, 'Download torrent pieces sequentially (first parts first).')
 }
 
-transmissionrpc.constants.TORRENT_ARGS['get'].update(added_torrent_fields)
-transmissionrpc.constants.TORRENT_ARGS['set'].update(added_torrent_fields)
+def add_torrent_fields(module):
+    module.constants.TORRENT_ARGS['get'].update(added_torrent_fields)
+    module.constants.TORRENT_ARGS['set'].update(added_torrent_fields)
+
+# Imported (and patched) on the first RPC instead of when the bot starts
+transmissionrpc = lazy_import('transmissionrpc', on_import=add_torrent_fields)  # python3 -m pip install transmissionrpc
+
+
+def traced_request(request):
+    ''' Wrap a transmissionrpc.Client._request to record every RPC call as a span '''
+
+    @functools.wraps(request)
+    def wrapper(method, *args, **kwargs):
+        with TRACER.span(f'transmission {method}', 'transmission'):
+            return request(method, *args, **kwargs)
+
+    return wrapper
+
 
+def create_transmission_rpc(http_handler=None):
+    ''' http_handler replaces transmissionrpc's HTTP transport, load_test.py passes a MockTransmission '''
 
-def create_transmission_rpc():
-    return transmissionrpc.Client(getattr(config, 'TRANSMISSION_IP', '127.0.0.1'))
+    client = transmissionrpc.Client(getattr(config, 'TRANSMISSION_IP', '127.0.0.1'), http_handler=http_handler)
+    client._request = traced_request(client._request)
+    return client
 
 def get_transmission_rpc():
     global TRANSMISSION_RPC_OBJECT